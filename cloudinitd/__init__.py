@@ -1,4 +1,5 @@
 import logging
+import logging.handlers
 from cloudinitd.exceptions import *
 #from cloudinitd.user_api import *
 from cloudinitd.statics import *
@@ -157,6 +158,23 @@ def close_log_handlers():
     for l in g_open_loggers:
         l.close()
 
+def remove_log_handlers(since=0):
+    """
+    Close the handlers made by make_logger, from the since'th one on, and detach them from their loggers.  Long
+    running processes use this to drop the handlers made for a piece of work once it is done.
+    """
+    global g_open_loggers
+    old = g_open_loggers[since:]
+    for logger in logging.Logger.manager.loggerDict.values():
+        if not isinstance(logger, logging.Logger):
+            continue
+        for h in logger.handlers[:]:
+            if h in old:
+                logger.removeHandler(h)
+    for h in old:
+        h.close()
+    g_open_loggers = g_open_loggers[:since]
+
 
 def parse_url(url):
     ndx = url.find("://")
@@ -0,0 +1,314 @@
+"""
+Static analysis of a launch plan.  The plan is read the same way a boot reads it, into a throw away in memory
+database, so neither the run databases nor the cloud are touched.  From it the ${svc.attr} references between
+services are turned into a dependency graph that is checked for references that cannot be resolved, references to
+services that are not booted first and cycles.
+
+When the event journal of past runs is available the boot of each service is timed from it and used to estimate
+how long the plan takes with its levels as they are, how long it would take with no levels at all (the critical
+path) and which services could be moved to an earlier level to make it faster.
+"""
+import os
+import logging
+
+import cloudinitd
+from cloudinitd.global_deps import get_global
+from cloudinitd.persistence import CloudInitDDB, g_service_columns
+from cloudinitd.services import get_service_refs
+
+# the attrs every service has before any deps file is read
+g_builtin_attrs = ["hostname", "instance_id", "run_name"]
+
+
+def load_plan(conf_file):
+    """Return the ServiceRecords of each level of the plan, in level order"""
+    db = CloudInitDDB("sqlite://")
+    try:
+        bo = db.load_from_conf(conf_file)
+        return db.get_service_records(bo)
+    finally:
+        db.close()
+
+
+def read_events(dburl, stage="boot"):
+    """
+    Return the journal rows of one stage from every run in the db at dburl, in the order they were written.  The
+    db is only read: no tables are created or upgraded, and a db with no journal gives an empty list.
+    """
+    import sqlalchemy
+
+    engine = sqlalchemy.create_engine(dburl)
+    try:
+        md = sqlalchemy.MetaData()
+        try:
+            t = sqlalchemy.Table("service_event", md, autoload=True, autoload_with=engine)
+        except sqlalchemy.exc.NoSuchTableError:
+            return []
+        sel = t.select().where(t.c.stage == stage).order_by(t.c.id)
+        return engine.execute(sel).fetchall()
+    finally:
+        engine.dispose()
+
+
+def get_stage_timings(journals, stage="boot"):
+    """
+    Return a dict of service name to the list of times, in seconds, that stage took in the given journals, each
+    a list of rows as returned by read_events().  A stage is timed from its first starting event to its complete
+    event, one that ended in an error is not counted.
+    """
+    durations = {}
+    for events in journals:
+        started = {}
+        for e in events:
+            if e.stage != stage:
+                continue
+            key = (e.run_name, e.service_name)
+            if e.event == cloudinitd.callback_action_started:
+                if key not in started:
+                    started[key] = e.timestamp
+            elif e.event == cloudinitd.callback_action_complete:
+                if key in started:
+                    durations.setdefault(e.service_name, []).append(e.timestamp - started.pop(key))
+            elif e.event == cloudinitd.callback_action_error:
+                started.pop(key, None)
+    return durations
+
+
+def load_timings(db_dir, dburl=None, stage="boot", log=logging):
+    """
+    Return a dict of service name to the median time its stage took in the past runs kept in db_dir, or in the
+    shared store at dburl when it is given.  A db that cannot be read (locked by a running boot, corrupt) is
+    skipped with a warning.
+    """
+    from cloudinitd.user_api import list_runs
+
+    if dburl:
+        urls = [dburl]
+    else:
+        urls = ["sqlite:///%s" % (os.path.join(db_dir, "cloudinitd-%s.db" % (name))) for name in list_runs(db_dir)]
+    journals = []
+    for url in urls:
+        try:
+            journals.append(read_events(url, stage=stage))
+        except Exception, ex:
+            cloudinitd.log(log, logging.WARN, "Skipping the timings in %s, it cannot be read: %s" % (url, str(ex)))
+    durations = get_stage_timings(journals, stage=stage)
+
+    timings = {}
+    for (name, l) in durations.items():
+        l.sort()
+        timings[name] = l[len(l) / 2]
+    return timings
+
+
+class PlanAnalysis(object):
+
+    def __init__(self, conf_file, timings=None):
+        """
+        conf_file: the top level file of the plan
+
+        timings: a dict of service name to the seconds it takes to boot, as returned by load_timings().  Services
+        that are not in it are given the median of those that are, or 1 second when nothing is known.
+        """
+        self._records = load_plan(conf_file)
+        self.levels = [[s.name for s in level] for level in self._records]
+        self._level_of = {}
+        self._by_name = {}
+        for (ndx, level) in enumerate(self._records):
+            for s in level:
+                self._level_of[s.name] = ndx
+                self._by_name[s.name] = s
+
+        if timings is None:
+            timings = {}
+        self.timed = [name for name in self._by_name if name in timings]
+        known = sorted([timings[name] for name in self.timed])
+        default = 1.0
+        if known:
+            default = known[len(known) / 2]
+        self.durations = {}
+        for name in self._by_name:
+            self.durations[name] = timings.get(name, default)
+
+        self.edges = []
+        self.problems = []
+        self._providers = {}
+        for level in self._records:
+            for s in level:
+                self._providers[s.name] = []
+                self._check_refs(s)
+        self.cycles = self._find_cycles()
+        for cycle in self.cycles:
+            self.problems.append(("error", "The services %s use each other's attributes in a cycle" % (" -> ".join(cycle + [cycle[0]]))))
+
+    def _check_refs(self, s):
+        for (svc_name, attr_name) in get_service_refs(s):
+            if not svc_name or svc_name == s.name:
+                continue
+            if svc_name == "global":
+                if get_global(attr_name) is None:
+                    self.problems.append(("warning", "%s uses the global %s which is not set by the plan, it must be given when booting" % (s.name, attr_name)))
+                continue
+            provider = self._by_name.get(svc_name)
+            if provider is None:
+                self.problems.append(("error", "%s uses %s.%s but there is no service %s" % (s.name, svc_name, attr_name, svc_name)))
+                continue
+
+            self.edges.append((svc_name, s.name, attr_name))
+            if svc_name not in self._providers[s.name]:
+                self._providers[s.name].append(svc_name)
+            known = attr_name in g_builtin_attrs or attr_name in g_service_columns or attr_name in [k for (k, v) in provider.get_all_attrs()]
+            if not known:
+                if provider.bootpgm:
+                    self.problems.append(("warning", "%s uses %s.%s which can only come from the output of the boot program of %s" % (s.name, svc_name, attr_name, svc_name)))
+                else:
+                    self.problems.append(("error", "%s uses %s.%s but %s has no such attribute" % (s.name, svc_name, attr_name, svc_name)))
+            if self._level_of[svc_name] >= self._level_of[s.name]:
+                self.problems.append(("error", "%s (level %d) uses %s.%s but %s is not booted before it (level %d)" % (s.name, self._level_of[s.name] + 1, svc_name, attr_name, svc_name, self._level_of[svc_name] + 1)))
+
+    def _find_cycles(self):
+        cycles = []
+        seen = {}
+        for start in self._by_name:
+            if start in seen:
+                continue
+            # depth first, the path is kept so that the services of a cycle can be reported
+            path = []
+            on_path = {}
+            stack = [(start, iter(self._providers[start]))]
+            path.append(start)
+            on_path[start] = True
+            while stack:
+                (name, it) = stack[-1]
+                next_name = None
+                for p in it:
+                    if p in on_path:
+                        cycle = path[path.index(p):]
+                        if sorted(cycle) not in [sorted(c) for c in cycles]:
+                            cycles.append(cycle)
+                    elif p not in seen:
+                        next_name = p
+                        break
+                if next_name is None:
+                    stack.pop()
+                    path.pop()
+                    del on_path[name]
+                    seen[name] = True
+                else:
+                    stack.append((next_name, iter(self._providers[next_name])))
+                    path.append(next_name)
+                    on_path[next_name] = True
+        return cycles
+
+    def has_errors(self):
+        return len([p for p in self.problems if p[0] == "error"]) > 0
+
+    def get_levels_duration(self, levels=None):
+        """The time a boot takes when each level waits for the one before it to finish"""
+        if levels is None:
+            levels = self.levels
+        total = 0.0
+        for level in levels:
+            if level:
+                total = total + max([self.durations[name] for name in level])
+        return total
+
+    def get_critical_path(self):
+        """
+        Return (seconds, [service names]) for the longest chain of services that use each other's attributes.  No
+        arrangement of the levels can boot the plan faster than this.
+        """
+        if self.cycles:
+            return (None, [])
+        finish = {}
+        before = {}
+        def _finish(name):
+            if name not in finish:
+                start = 0.0
+                before[name] = None
+                for p in self._providers[name]:
+                    if _finish(p) > start:
+                        start = finish[p]
+                        before[name] = p
+                finish[name] = start + self.durations[name]
+            return finish[name]
+
+        last = None
+        for name in self._by_name:
+            if _finish(name) > finish.get(last, -1.0):
+                last = name
+        if last is None:
+            return (0.0, [])
+        path = []
+        name = last
+        while name is not None:
+            path.insert(0, name)
+            name = before[name]
+        return (finish[last], path)
+
+    def get_suggested_levels(self):
+        """
+        Return the levels rearranged so that the plan boots faster, and a list of (service name, from level,
+        to level) for the services that were moved (levels are counted from 1).  Services are moved, in level
+        order, to the level just after the last of the services they use when that does not make the boot slower.
+        The moves are only suggested if together they make it faster.  Only the ${svc.attr} references are
+        known here, a plan may rely on the order of its levels for other reasons.
+        """
+        if self.cycles or self.has_errors():
+            return (self.levels, [])
+        levels = [list(level) for level in self.levels]
+        level_of = dict(self._level_of)
+        for ndx in range(len(self.levels)):
+            for name in self.levels[ndx]:
+                earliest = 0
+                for p in self._providers[name]:
+                    earliest = max(earliest, level_of[p] + 1)
+                if earliest >= level_of[name]:
+                    continue
+                trial = [list(level) for level in levels]
+                trial[level_of[name]].remove(name)
+                trial[earliest].append(name)
+                if self.get_levels_duration(trial) <= self.get_levels_duration(levels):
+                    levels = trial
+                    level_of[name] = earliest
+
+        # levels left empty are dropped, the moves are reported with the level numbers of the new plan
+        new_levels = [level for level in levels if level]
+        if self.get_levels_duration(new_levels) >= self.get_levels_duration():
+            return (self.levels, [])
+        moves = []
+        for (ndx, level) in enumerate(new_levels):
+            for name in level:
+                if level_of[name] != self._level_of[name]:
+                    moves.append((name, self._level_of[name] + 1, ndx + 1))
+        return (new_levels, moves)
+
+    def get_json_doc(self):
+        (cp_time, cp_path) = self.get_critical_path()
+        (new_levels, moves) = self.get_suggested_levels()
+        services = {}
+        for (name, s) in self._by_name.items():
+            services[name] = {"level": self._level_of[name] + 1, "duration": self.durations[name], "timed": name in self.timed, "uses": self._providers[name]}
+        return {
+            "levels": self.levels,
+            "services": services,
+            "edges": [{"from": p, "to": c, "attr": a} for (p, c, a) in self.edges],
+            "problems": [{"severity": sev, "message": msg} for (sev, msg) in self.problems],
+            "estimate": {"levels": self.get_levels_duration(), "critical_path": cp_time, "critical_path_services": cp_path, "suggested_levels": self.get_levels_duration(new_levels)},
+            "suggested_levels": new_levels,
+            "moves": [{"service": n, "from": f, "to": t} for (n, f, t) in moves],
+            }
+
+    def get_dot(self):
+        """Return the dependency graph in the DOT format, an edge goes from a service to the services using it"""
+        lines = ["digraph plan {", "    rankdir=LR;"]
+        for (ndx, level) in enumerate(self.levels):
+            lines.append("    subgraph cluster_level%d {" % (ndx + 1))
+            lines.append('        label="level%d";' % (ndx + 1))
+            for name in level:
+                lines.append('        "%s" [label="%s\\n%.1fs"];' % (name, name, self.durations[name]))
+            lines.append("    }")
+        for (p, c, a) in self.edges:
+            lines.append('    "%s" -> "%s" [label="%s"];' % (p, c, a))
+        lines.append("}")
+        return "\n".join(lines) + "\n"
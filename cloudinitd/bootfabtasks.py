@@ -1,7 +1,8 @@
 import shutil
 import urllib
+import uuid
 import os
-from fabric.api import env, run, put, cd, get, local
+from fabric.api import env, run, put, cd, get, local, settings
 from cloudinitd.statics import *
 
 def _iftar(filename):
@@ -39,6 +40,90 @@ def _tartask(directory, basename, tarball, run_pgm=run):
 
     return destpgm
 
+def _use_cache(digest, cachedir, local_exe):
+    return not local_exe and digest and digest != "None" and cachedir and cachedir != "None"
+
+def _tmp_entry(entry):
+    """A directory next to entry that a cache entry can be built in without anyone else seeing it"""
+    return "%s.tmp-%s" % (entry, uuid.uuid4().hex)
+
+def _move_into_place(tmp, entry):
+    """Rename a finished entry built in tmp to entry.
+
+    The rename is atomic so an entry is never seen half built.  If another copy got there first it is the one
+    used and ours is dropped, an entry in place is never removed since others may be copying from it.
+    """
+    with settings(warn_only=True):
+        if not run("mv -T %s %s" % (tmp, entry)).succeeded:
+            run("rm -rf %s" % (tmp))
+
+def _peer_copy(peer, entry, cachedir):
+    """Copy a complete cache entry from another VM.  Return True on success"""
+    ssh_opts = "-o BatchMode=yes -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o PasswordAuthentication=no"
+    tmp = _tmp_entry(entry)
+    with settings(warn_only=True, forward_agent=True):
+        run("mkdir -p %s" % (cachedir))
+        if not run("scp -r -p %s %s:%s %s" % (ssh_opts, peer, entry, tmp)).succeeded:
+            run("rm -rf %s" % (tmp))
+            return False
+    _move_into_place(tmp, entry)
+    return True
+
+def _cached_put(pgm, stagedir, digest, cachedir, peer=None):
+    """Copy pgm into stagedir by way of the remote content cache.
+
+    The cache entry <cachedir>/<digest>-<name> holds the program and, for tarballs, its
+    expanded directory.  The program is kept under its name, so two programs with the same
+    bytes but different names get entries of their own.  The upload and the expansion only
+    happen when the entry is not already there.  If peer is given the entry is first fetched
+    from that VM instead of being uploaded from here.  Return the path to the program to run.
+    """
+    relpgm = os.path.basename(pgm)
+    tarname = _iftar(relpgm)
+    entry = "%s/%s-%s" % (cachedir, digest, relpgm)
+    marker = "%s.complete" % (entry)
+
+    with settings(warn_only=True):
+        hit = run("test -f %s" % (marker)).succeeded
+    if not hit and peer and peer != "None":
+        hit = _peer_copy(peer, entry, cachedir)
+        if hit:
+            run("touch %s" % (marker))
+    if not hit:
+        tmp = _tmp_entry(entry)
+        run("mkdir -p %s" % (tmp))
+        put(pgm, "%s/%s" % (tmp, relpgm), mode=0755)
+        if tarname:
+            _tartask(tmp, tarname, "%s/%s" % (tmp, relpgm))
+        _move_into_place(tmp, entry)
+        run("touch %s" % (marker))
+
+    # a tarball is run from its expanded directory, the tarball itself is not needed in the stage directory
+    run("mkdir -p %s" % (stagedir))
+    if tarname:
+        run("cp -pR %s/%s %s" % (entry, tarname, stagedir))
+        return os.path.join(stagedir, tarname, "run.sh")
+    run("cp -p %s/%s %s" % (entry, relpgm, stagedir))
+    return "%s/%s" % (stagedir, relpgm)
+
+def _put_conf_bundle(bundle, digest, stagedir):
+    """Expand a tarball of rendered config files into stagedir.
+
+    The files often hold credentials so they are never kept in the shared cache.  The
+    digest of the last bundle expanded is left in the stage directory instead and the
+    upload is skipped when the same files are already there.
+    """
+    stamp = "%s/.confdigest" % (stagedir)
+    if digest and digest != "None":
+        with settings(warn_only=True):
+            if run('test "`cat %s 2>/dev/null`" = "%s"' % (stamp, digest)).succeeded:
+                return
+    dest = "%s/%s" % (stagedir, os.path.basename(bundle))
+    put(bundle, dest, mode=0600)
+    run("tar -xzf %s -C %s && rm -f %s" % (dest, stagedir, dest))
+    if digest and digest != "None":
+        run("echo %s > %s" % (digest, stamp))
+
 def _make_ssh(pgm, args="", local_exe=None):
 
     if local_exe:
@@ -51,6 +136,7 @@ def _make_ssh(pgm, args="", local_exe=None):
             ssh_opts = os.environ['CLOUDINITD_SSH_OPTS']
     except:
         pass
+    ssh_opts = ssh_opts + " " + get_ssh_control_opts()
 
     sshexec = "ssh"
     try:
@@ -75,7 +161,7 @@ def _make_ssh(pgm, args="", local_exe=None):
     return cmd
 
 
-def readypgm(pgm=None, args=None, stagedir=None, local_exe=None):
+def readypgm(pgm=None, args=None, stagedir=None, local_exe=None, digest=None, cachedir=None):
     local_exe = str(local_exe).lower() == 'true'
     pgm_to_use = run
     put_pgm = put
@@ -85,20 +171,23 @@ def readypgm(pgm=None, args=None, stagedir=None, local_exe=None):
 
     args = urllib.unquote(args)
     env.warn_only = True
-    pgm_to_use('mkdir -p %s' % stagedir)
-    relpgm = os.path.basename(pgm)
-    destpgm = "%s/%s" % (stagedir, relpgm)
-
-    if local_exe:
-        os.chdir(stagedir)
-        put_pgm(pgm, destpgm)
-        os.chmod(destpgm, 0755)
+    if _use_cache(digest, cachedir, local_exe):
+        destpgm = _cached_put(pgm, stagedir, digest, cachedir)
     else:
-        put_pgm(pgm, destpgm, mode=0755)
+        pgm_to_use('mkdir -p %s' % stagedir)
+        relpgm = os.path.basename(pgm)
+        destpgm = "%s/%s" % (stagedir, relpgm)
 
-    tarname = _iftar(relpgm)
-    if tarname:
-         destpgm = _tartask(stagedir, tarname, destpgm)
+        if local_exe:
+            os.chdir(stagedir)
+            put_pgm(pgm, destpgm)
+            os.chmod(destpgm, 0755)
+        else:
+            put_pgm(pgm, destpgm, mode=0755)
+
+        tarname = _iftar(relpgm)
+        if tarname:
+             destpgm = _tartask(stagedir, tarname, destpgm)
     env.warn_only = False
     destpgm = destpgm + " " + args
     with cd(stagedir):
@@ -109,17 +198,14 @@ def cleanup_dirs(stagedir=None, local_exe=None):
     local(cmd)
 
 
-def bootpgm(pgm=None, args=None, conf=None, env_conf=None, output=None, stagedir=None, remotedir=None, local_exe=None):
-    local_exe = str(local_exe).lower() == 'true'
-    pgm_to_use = run
-    put_pgm = put
-    if local_exe:
-        pgm_to_use = local
-        put_pgm = shutil.copy
-
-    args = urllib.unquote(args)
+def _stagepgm(pgm, stagedir, remotedir, local_exe, pgm_to_use, put_pgm, digest=None, cachedir=None, peer=None):
+    """Upload the boot program to the stage directory, expanding it if it is a tarball.
+    Return the path to the program to run.
+    """
     pgm_to_use('mkdir %s' % remotedir)
     pgm_to_use('chmod 777 %s' % remotedir)
+    if _use_cache(digest, cachedir, local_exe):
+        return _cached_put(pgm, stagedir, digest, cachedir, peer=peer)
     pgm_to_use('mkdir -p %s' % stagedir)
     relpgm = os.path.basename(pgm)
     destpgm = "%s/%s" % (stagedir, relpgm)
@@ -132,6 +218,42 @@ def bootpgm(pgm=None, args=None, conf=None, env_conf=None, output=None, stagedir
     tarname = _iftar(relpgm)
     if tarname:
         destpgm = _tartask(stagedir, tarname, destpgm, run_pgm=pgm_to_use)
+    return destpgm
+
+def _staged_path(pgm, stagedir):
+    """Return the path to the program that _stagepgm left in the stage directory"""
+    relpgm = os.path.basename(pgm)
+    tarname = _iftar(relpgm)
+    if tarname:
+        return os.path.join(stagedir, tarname, "run.sh")
+    return "%s/%s" % (stagedir, relpgm)
+
+def stagepgm(pgm=None, stagedir=None, remotedir=None, local_exe=None, digest=None, cachedir=None, peer=None):
+    """Upload the boot program ahead of time so that a later bootpgm call can be made with staged=True.
+    When peer is set (user@host) the program is copied from that VM's cache instead of from here.
+    """
+    local_exe = str(local_exe).lower() == 'true'
+    pgm_to_use = run
+    put_pgm = put
+    if local_exe:
+        pgm_to_use = local
+        put_pgm = shutil.copy
+    _stagepgm(pgm, stagedir, remotedir, local_exe, pgm_to_use, put_pgm, digest=digest, cachedir=cachedir, peer=peer)
+
+def bootpgm(pgm=None, args=None, conf=None, env_conf=None, output=None, stagedir=None, remotedir=None, local_exe=None, staged=None, digest=None, cachedir=None, confbundle=None, confdigest=None):
+    local_exe = str(local_exe).lower() == 'true'
+    staged = str(staged).lower() == 'true'
+    pgm_to_use = run
+    put_pgm = put
+    if local_exe:
+        pgm_to_use = local
+        put_pgm = shutil.copy
+
+    args = urllib.unquote(args)
+    if staged:
+        destpgm = _staged_path(pgm, stagedir)
+    else:
+        destpgm = _stagepgm(pgm, stagedir, remotedir, local_exe, pgm_to_use, put_pgm, digest=digest, cachedir=cachedir)
     if conf and conf != "None":
         destconf = "%s/bootconf.json" % stagedir
         put_pgm(conf, destconf)
@@ -140,6 +262,9 @@ def bootpgm(pgm=None, args=None, conf=None, env_conf=None, output=None, stagedir
         destenv = "%s/bootenv.sh" % stagedir
         put_pgm(env_conf, destenv)
         os.remove(env_conf)
+    if confbundle and confbundle != "None":
+        _put_conf_bundle(confbundle, confdigest, stagedir)
+        os.remove(confbundle)
     destpgm = destpgm + " " + args
 
     local_cmd = _make_ssh("(cd %s && %s)" %(stagedir, destpgm), local_exe=local_exe)
@@ -2,35 +2,20 @@ import warnings
 warnings.simplefilter('ignore')
 
 import os
+import re
+import sys
 import datetime
 import threading
+import time
 import uuid
-import boto
 import logging
-import boto.ec2
-try:
-    from libcloud.types import Provider
-    from libcloud.providers import get_driver
-    from libcloud.base import NodeImage, NodeAuthSSHKey
-except ImportError:
-    from libcloud.compute.types import Provider
-    from libcloud.compute.providers import get_driver
-    from libcloud.compute.base import NodeImage, NodeAuthSSHKey
-
-if os.environ.get('CLOUDINITD_NO_LIBCLOUD_VERIFY_SSL_CERT'):
-    import libcloud.security
-    libcloud.security.VERIFY_SSL_CERT = False
+import Queue
 
 from urlparse import urlparse
 from datetime import timedelta
 
-import boto.ec2
 #warnings.simplefilter('default')
 
-try:
-    from boto.regioninfo import RegionInfo
-except:
-    from boto.ec2.regioninfo import RegionInfo
 import cloudinitd
 from cloudinitd.exceptions import ConfigException, IaaSException, APIUsageException
 
@@ -40,6 +25,56 @@ g_fake_instance_table = {}
 
 g_lock = threading.Lock()
 
+# boto and libcloud are slow to import and most commands never talk to a cloud.  each is imported by the first
+# connection of its type, _import_boto() and _import_libcloud() fill in these names.  connections are only made
+# under g_lock so the imports are too.
+boto = None
+RegionInfo = None
+Provider = None
+get_driver = None
+NodeImage = None
+NodeAuthSSHKey = None
+
+def _import_boto():
+    global boto, RegionInfo
+
+    if boto is not None:
+        return
+    try:
+        from boto.regioninfo import RegionInfo
+    except:
+        from boto.ec2.regioninfo import RegionInfo
+    import boto.ec2
+
+def _import_libcloud():
+    global Provider, get_driver, NodeImage, NodeAuthSSHKey
+
+    if Provider is not None:
+        return
+    try:
+        from libcloud.providers import get_driver
+        from libcloud.base import NodeImage, NodeAuthSSHKey
+        from libcloud.types import Provider
+    except ImportError:
+        from libcloud.compute.providers import get_driver
+        from libcloud.compute.base import NodeImage, NodeAuthSSHKey
+        from libcloud.compute.types import Provider
+
+    if os.environ.get('CLOUDINITD_NO_LIBCLOUD_VERIFY_SSL_CERT'):
+        import libcloud.security
+        libcloud.security.VERIFY_SSL_CERT = False
+
+    for (name, const_name) in g_libcloud_provider_names.items():
+        if hasattr(Provider, const_name):
+            g_libcloud_providers[name] = getattr(Provider, const_name)
+
+def is_ec2_response_error(ex):
+    """
+    True if ex is the error boto raises when EC2 refuses a request.  If boto was never imported it cannot be one.
+    """
+    boto_ex = sys.modules.get("boto.exception")
+    return boto_ex is not None and isinstance(ex, boto_ex.EC2ResponseError)
+
 class IaaSTestCon(object):
     def __init__(self):
         pass
@@ -68,11 +103,52 @@ class IaaSTestCon(object):
         except Exception, ex:
             raise IaaSException(str(ex))
 
+    def check_auth(self):
+        pass
+
+    def find_instances(self, instance_ids):
+        global g_fake_instance_table
+
+        d = {}
+        for id in instance_ids:
+            if id in g_fake_instance_table:
+                d[id] = g_fake_instance_table[id]
+        return d
+
+    def terminate_instances(self, instances):
+        for i in instances:
+            i.terminate()
+
+
+g_boto_con_cache = None
+
+def enable_connection_cache():
+    """
+    Share the underlying EC2 connection between all IaaSBotoConn objects made with the same credentials and
+    endpoint, keeping it warm for the life of the process.
+    """
+    global g_boto_con_cache
+    if g_boto_con_cache is None:
+        g_boto_con_cache = {}
 
 class IaaSBotoConn(object):
     def __init__(self, svc, key, secret, iaasurl, iaas):
         self._svc = svc
 
+        self._con_lock = None
+        if g_boto_con_cache is None:
+            self._connect(key, secret, iaasurl, iaas)
+            return
+        # a shared connection is only ever used under the module lock
+        self._con_lock = g_lock
+        cache_key = (key, secret, iaasurl, iaas)
+        if cache_key not in g_boto_con_cache:
+            self._connect(key, secret, iaasurl, iaas)
+            g_boto_con_cache[cache_key] = self._con
+        self._con = g_boto_con_cache[cache_key]
+
+    def _connect(self, key, secret, iaasurl, iaas):
+        _import_boto()
         if not iaasurl:
             if not iaas:
                 iaas = "us-east-1"
@@ -99,11 +175,24 @@ class IaaSBotoConn(object):
             l = []
             for r in self._con.get_all_instances(instance_ids):
                 l = l + r.instances
-            cb_l = [IaaSBotoInstance(i, self._con) for i in l]
+            cb_l = [IaaSBotoInstance(i, self._con, lock=self._con_lock) for i in l]
             return cb_l
         finally:
             g_lock.release()
 
+    def check_auth(self):
+        """
+        Make the cheapest call that needs valid credentials.  Listing the zones does not grow with the size of the
+        account the way listing the instances does.  Only a connection shared between threads is locked.
+        """
+        if self._con_lock:
+            self._con_lock.acquire()
+        try:
+            self._con.get_all_zones()
+        finally:
+            if self._con_lock:
+                self._con_lock.release()
+
     def run_instance(self):
         global g_lock
         g_lock.acquire()
@@ -132,7 +221,7 @@ class IaaSBotoConn(object):
 
         reservation = self._con.run_instances(image, instance_type=instance_type, key_name=key_name, security_groups=sec_group)
         instance = reservation.instances[0]
-        return IaaSBotoInstance(instance, self._con)
+        return IaaSBotoInstance(instance, self._con, lock=self._con_lock)
 
     def find_instance(self, instance_id):
         global g_lock
@@ -152,47 +241,176 @@ class IaaSBotoConn(object):
             ex = IaaSException(Exception("There is no instance %s" % (instance_id)))
             raise ex
         instance = reservation[0].instances[0]
-        i = IaaSBotoInstance(instance, self._con)
+        i = IaaSBotoInstance(instance, self._con, lock=self._con_lock)
         return i
 
+    def find_instances(self, instance_ids):
+        """
+        Look up many instances with a single describe call.  A dictionary of instance id to instance is returned,
+        ids that the IaaS does not know about are left out of it.
+        """
+        global g_lock
+        g_lock.acquire()
+        try:
+            d = {}
+            if not instance_ids:
+                return d
+            try:
+                for r in self._con.get_all_instances(instance_ids):
+                    for i in r.instances:
+                        d[i.id] = IaaSBotoInstance(i, self._con, lock=self._con_lock)
+            except Exception, ex:
+                if not is_ec2_response_error(ex):
+                    raise
+                # ec2 fails the whole request if a single id is unknown, fall back to one at a time
+                for id in instance_ids:
+                    try:
+                        d[id] = self._find_instance(id)
+                    except IaaSException:
+                        pass
+                    except Exception, ex:
+                        if not is_ec2_response_error(ex) or ex.error_code != "InvalidInstanceID.NotFound":
+                            raise
+            return d
+        finally:
+            g_lock.release()
+
+    def terminate_instances(self, instances):
+        global g_lock
+        if not instances:
+            return
+        ids = [i.get_id() for i in instances]
+        g_lock.acquire()
+        try:
+            self._con.terminate_instances(instance_ids=ids)
+        finally:
+            g_lock.release()
+
+# the libcloud-<name> iaas types and the names of their libcloud Provider constants.  _import_libcloud() turns
+# this into g_libcloud_providers, leaving out the providers the installed libcloud does not have
+g_libcloud_provider_names = {
+    "dummy" : "DUMMY",
+    "ec2" : "EC2",
+    "ec2_us_east": "EC2_US_EAST",
+    "ec2_eu": "EC2_EU",
+    "ec2_eu_west": "EC2_EU_WEST",
+    "rackspace": "RACKSPACE",
+    "slicehost": "SLICEHOST",
+    "gogrid": "GOGRID",
+    "vpsnet": "VPSNET",
+    "linode": "LINODE",
+    "vcloud": "VCLOUD",
+    "rmuhosting": "RIMUHOSTING",
+    "ec2_us_west": "EC2_US_WEST",
+    "voxel": "VOXEL",
+    "softlayer": "SOFTLAYER",
+    "eucalyptus": "EUCALYPTUS",
+    "ecp": "ECP",
+    "ibm": "IBM",
+    "opennebula": "OPENNEBULA",
+    "dreamhost": "DREAMHOST",
+    "elastichosts": "ELASTICHOSTS",
+    "elastichosts_uk1": "ELASTICHOSTS_UK1",
+    "elastichosts_uk2": "ELASTICHOSTS_UK2",
+    "elastichosts_us1": "ELASTICHOSTS_US1",
+    "ec2_ap_southeast": "EC2_AP_SOUTHEAST",
+    "rackspace_uk": "RACKSPACE_UK",
+    "brightbox": "BRIGHTBOX",
+    "cloudsigma": "CLOUDSIGMA",
+    "nimbus": "NIMBUS",
+    }
+g_libcloud_providers = {}
+# Provider constant -> driver class, get_driver() is only called once for each
+g_libcloud_drivers = {}
+
+# how long, in seconds, the sizes listed from a libcloud provider are used before they are listed again
+g_libcloud_catalog_ttl = 300.0
+# (provider, key, secret, iaas url) -> LibCloudCatalog, shared by every connection made with the same credentials
+g_libcloud_catalogs = {}
+
+# the instances of a libcloud provider are updated from a list of its nodes that is at most this many seconds old
+g_libcloud_node_list_period = 1.0
+# (provider, key, secret, iaas url) -> LibCloudNodeList, shared like the catalogs
+g_libcloud_node_lists = {}
+
+class LibCloudCatalog(object):
+    """
+    The sizes offered by a libcloud provider.  Launching a VM needs the size object for its allocation and
+    listing them is a call to the cloud, so they are listed once and used for g_libcloud_catalog_ttl seconds.
+    """
+
+    def __init__(self):
+        self._sizes = None
+        self._listed = 0.0
+        self._lock = threading.Lock()
+
+    def _list_sizes(self, con):
+        self._sizes = dict([(s.id, s) for s in con.list_sizes()])
+        self._listed = time.time()
+
+    def get_size(self, con, size_id):
+        """Return the size with the given id, or None if the provider does not offer it"""
+        self._lock.acquire()
+        try:
+            if self._sizes is None or time.time() - self._listed > g_libcloud_catalog_ttl:
+                self._list_sizes(con)
+            elif size_id not in self._sizes:
+                # it may have been added since the sizes were listed
+                self._list_sizes(con)
+            return self._sizes.get(size_id)
+        finally:
+            self._lock.release()
+
+class LibCloudNodeList(object):
+    """
+    The last list of the nodes of a libcloud provider, indexed by uuid.  libcloud can only list all of the nodes,
+    so rather than each instance listing them to update itself they all read this list, which is listed again
+    when it is older than g_libcloud_node_list_period.
+    """
+
+    def __init__(self):
+        self._nodes = {}
+        self._listed = None
+        self._lock = threading.Lock()
+
+    def _list_nodes(self, con):
+        nodes = con.list_nodes()
+        self._nodes = dict([(n.get_uuid(), n) for n in nodes])
+        self._listed = time.time()
+        return nodes
+
+    def list_nodes(self, con):
+        """List the nodes now, the list is kept for the instances to update from"""
+        self._lock.acquire()
+        try:
+            return self._list_nodes(con)
+        finally:
+            self._lock.release()
+
+    def get_node(self, con, uuid):
+        """Return the node with the given uuid from a list that is recent enough, or None if it is not in it"""
+        self._lock.acquire()
+        try:
+            if self._listed is None or time.time() - self._listed > g_libcloud_node_list_period:
+                self._list_nodes(con)
+            return self._nodes.get(uuid)
+        finally:
+            self._lock.release()
+
+    def expire(self):
+        """Make the next get_node() list the nodes again, nodes were added or removed"""
+        self._lock.acquire()
+        try:
+            self._listed = None
+        finally:
+            self._lock.release()
+
 class IaaSLibCloudConn(object):
 
     def __init__(self, svc, key, secret, iaasurl, iaas):
         #cloudinitd.log(log, logging.INFO, "loading up a lobcloud driver %s" % (iaas))
         self._svc = svc
-
-        self._provider_lookup = {
-            "dummy" : Provider.DUMMY,
-            "ec2" : Provider.EC2,
-            "ec2_us_east": Provider.EC2_US_EAST,
-            "ec2_eu": Provider.EC2_EU,
-            "ec2_eu_west": Provider.EC2_EU_WEST,
-            "rackspace": Provider.RACKSPACE,
-            "slicehost": Provider.SLICEHOST,
-            "gogrid": Provider.GOGRID,
-            "vpsnet": Provider.VPSNET,
-            "linode": Provider.LINODE,
-            "vcloud": Provider.VCLOUD,
-            "rmuhosting": Provider.RIMUHOSTING,
-            "ec2_us_west": Provider.EC2_US_WEST,
-            "voxel": Provider.VOXEL,
-            "softlayer": Provider.SOFTLAYER,
-            "eucalyptus": Provider.EUCALYPTUS,
-            "ecp": Provider.ECP,
-            "ibm": Provider.IBM,
-            "opennebula": Provider.OPENNEBULA,
-            "dreamhost": Provider.DREAMHOST,
-            "elastichosts": Provider.ELASTICHOSTS,
-            "elastichosts_uk1": Provider.ELASTICHOSTS_UK1,
-            "elastichosts_uk2": Provider.ELASTICHOSTS_UK2,
-            "elastichosts_us1": Provider.ELASTICHOSTS_US1,
-            "ec2_ap_southeast": Provider.EC2_AP_SOUTHEAST,
-            "rackspace_uk": Provider.RACKSPACE_UK,
-            "brightbox": Provider.BRIGHTBOX,
-            "cloudsigma": Provider.CLOUDSIGMA,
-            "nimbus": Provider.NIMBUS,
-            }
-
+        _import_libcloud()
 
         if not iaas:
             raise ConfigException("the iaas type must be set")
@@ -202,15 +420,17 @@ class IaaSLibCloudConn(object):
         if self._iaas.isdigit():
             provider = int(self._iaas)
         else:
-            if self._iaas in self._provider_lookup:
-                provider = self._provider_lookup[self._iaas]
+            if self._iaas in g_libcloud_providers:
+                provider = g_libcloud_providers[self._iaas]
             else:
                 raise ConfigException("%s is not a known libcloud driver" % (self._iaas))
 
-        if provider == Provider.NIMBUS and not iaasurl:
+        if provider == g_libcloud_providers.get("nimbus") and not iaasurl:
             raise ConfigException("You must provide an IAAS URL to the Nimbus libcloud driver")
 
-        self._Driver = get_driver(provider)
+        if provider not in g_libcloud_drivers:
+            g_libcloud_drivers[provider] = get_driver(provider)
+        self._Driver = g_libcloud_drivers[provider]
 
         if iaasurl is not None:
             url = urlparse(iaasurl)
@@ -221,18 +441,47 @@ class IaaSLibCloudConn(object):
         else:
             self._con = self._Driver(key, secret)
 
+        catalog_key = (provider, key, secret, iaasurl)
+        if catalog_key not in g_libcloud_catalogs:
+            g_libcloud_catalogs[catalog_key] = LibCloudCatalog()
+            g_libcloud_node_lists[catalog_key] = LibCloudNodeList()
+        self._catalog = g_libcloud_catalogs[catalog_key]
+        self._node_list = g_libcloud_node_lists[catalog_key]
+
+    def check_auth(self):
+        # libcloud has no authenticated call common to every driver that is cheaper than listing the nodes
+        self._con.list_nodes()
+
     def find_instance(self, instance_id):
         i_a = self.get_all_instances([instance_id,])
         return i_a[0]
 
     def get_all_instances(self, instance_ids=None):
-        nodes = self._con.list_nodes()
+        nodes = self._node_list.list_nodes(self._con)
         if instance_ids:
             nodes = [IaaSLibCloudInstance(self, n, self._Driver, self._con) for n in nodes if n.name in instance_ids]
         else:
             nodes = [IaaSLibCloudInstance(self, n, self._Driver, self._con) for n in nodes]
         return nodes
 
+    def find_instances(self, instance_ids):
+        d = {}
+        for n in self._node_list.list_nodes(self._con):
+            if n.id in instance_ids:
+                d[n.id] = IaaSLibCloudInstance(self, n, self._Driver, self._con)
+        return d
+
+    def terminate_instances(self, instances):
+        # libcloud has no bulk destroy call
+        for i in instances:
+            i.terminate()
+
+    def get_node(self, uuid):
+        return self._node_list.get_node(self._con, uuid)
+
+    def expire_nodes(self):
+        self._node_list.expire()
+
     def run_instance(self):
         if self._svc is None:
             raise ConfigException("You can only launch instances if a service is associated with the connection")
@@ -246,15 +495,10 @@ class IaaSLibCloudConn(object):
 
         image = NodeImage(image, name, self._Driver)
 
-        sizes = self._con.list_sizes()
-        sz = None
-        for s in sizes:
-            if s.id == instance_type:
-                sz = s
-        if sz == None:
+        size = self._catalog.get_size(self._con, instance_type)
+        if size == None:
             raise Exception("The allocation size %s does not exist" % (instance_type))
 
-        size = sz
         node_data = {
             'name':name,
             'size':size,
@@ -273,6 +517,7 @@ class IaaSLibCloudConn(object):
         if security_groupname:
             node_data['ex_securitygroup'] = security_groupname
         node = self._con.create_node(**node_data)
+        self.expire_nodes()
 
         return IaaSLibCloudInstance(self, node, self._Driver, self._con)
 
@@ -288,14 +533,12 @@ class IaaSLibCloudInstance(object):
 
     def terminate(self):
         self._node.destroy()
+        self._con.expire_nodes()
 
     def update(self):
-        all_node = self._libcloud_con.list_nodes()
-
-        for n in all_node:
-            if n.get_uuid() == self._myid:
-                self._node = n
-                return
+        n = self._con.get_node(self._myid)
+        if n is not None:
+            self._node = n
 
     def get_hostname(self):
         return self._node.public_ip[0]
@@ -366,9 +609,12 @@ class IaaSTestInstance(object):
 
 class IaaSBotoInstance(object):
 
-    def __init__(self, instance, botocon):
+    def __init__(self, instance, botocon, lock=None):
         self._instance = instance
-        self._lock = threading.Lock()
+        # instances on a shared connection share its lock
+        if lock is None:
+            lock = threading.Lock()
+        self._lock = lock
         self._botocon = botocon
 
     def terminate(self):
@@ -414,6 +660,134 @@ class IaaSBotoInstance(object):
         finally:
             self._lock.release()
 
+    def get_update_key(self):
+        """Instances with the same key belong to one account on one endpoint and can be described together"""
+        return (self._botocon.host, self._botocon.port, self._botocon.path, self._botocon.aws_access_key_id)
+
+    def _set_described(self, instance):
+        self._lock.acquire()
+        try:
+            self._instance = instance
+        finally:
+            self._lock.release()
+
+def get_update_key(instance):
+    """
+    Return a key shared by the instances that update_instances() can refresh with a single describe call, or None
+    when the instance can only update itself.
+    """
+    if not isinstance(instance, IaaSBotoInstance):
+        return None
+    return instance.get_update_key()
+
+def update_instances(instances):
+    """
+    Refresh many instances that share an update key with one describe call.  The instances that were refreshed
+    are returned.  Those the describe did not return are left alone, their own update() deals with an id that ec2
+    does not know about yet.
+    """
+    if not instances:
+        return []
+    first = instances[0]
+    ids = [i.get_id() for i in instances]
+    first._lock.acquire()
+    try:
+        reservations = first._botocon.get_all_instances(ids)
+    finally:
+        first._lock.release()
+    found = {}
+    for r in reservations:
+        for i in r.instances:
+            found[i.id] = i
+    updated = []
+    for (id, instance) in zip(ids, instances):
+        if id in found:
+            instance._set_described(found[id])
+            updated.append(instance)
+    return updated
+
+
+class InstanceEventSource(object):
+    """
+    A feed of VM state changes pushed by the cloud, like an event queue or a webhook, instead of found by polling.
+    A source calls publish() with each change it is told about.  Pollables waiting on a VM subscribe to it and
+    look at the VM as soon as it changes.  Events can be lost so they keep polling, but much less often.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, instance_id, cb):
+        """cb(instance_id, state) is called, from the thread of the source, for every event about the VM"""
+        self._lock.acquire()
+        try:
+            self._subscribers.setdefault(instance_id, []).append(cb)
+        finally:
+            self._lock.release()
+
+    def unsubscribe(self, instance_id, cb):
+        self._lock.acquire()
+        try:
+            cbs = self._subscribers.get(instance_id, [])
+            if cb in cbs:
+                cbs.remove(cb)
+            if not cbs:
+                self._subscribers.pop(instance_id, None)
+        finally:
+            self._lock.release()
+
+    def publish(self, instance_id, state):
+        self._lock.acquire()
+        try:
+            cbs = list(self._subscribers.get(instance_id, []))
+        finally:
+            self._lock.release()
+        for cb in cbs:
+            try:
+                cb(instance_id, state)
+            except Exception, ex:
+                cloudinitd.log(logging, logging.ERROR, "instance event callback failed: %s" % (str(ex)))
+
+    def close(self):
+        pass
+
+class InstanceEventQueue(InstanceEventSource):
+    """
+    An event source fed through a queue.  Whatever receives the events from the cloud (a message queue consumer,
+    a webhook handler) calls put() and a thread of its own publishes them.
+    """
+
+    def __init__(self):
+        InstanceEventSource.__init__(self)
+        self._q = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, instance_id, state):
+        self._q.put((instance_id, state))
+
+    def _run(self):
+        while True:
+            e = self._q.get()
+            if e is None:
+                return
+            self.publish(e[0], e[1])
+
+    def close(self):
+        self._q.put(None)
+        self._thread.join()
+
+g_instance_event_source = None
+
+def set_instance_event_source(source):
+    """Make source the InstanceEventSource that VMs launched from now on are watched with, None to only poll"""
+    global g_instance_event_source
+    g_instance_event_source = source
+
+def get_instance_event_source():
+    return g_instance_event_source
 
 def iaas_get_con(svc, key=None, secret=None, iaasurl=None, iaas=None):
     # type check the port
@@ -466,10 +840,24 @@ def _iaas_nimbus_validate(svc, log):
 def _ec2_nimbus_validate(svc, log):
     return (0, None)
 
+g_ec2_image_re = re.compile(r"^ami-([0-9a-f]{8}|[0-9a-f]{17})$")
+
+def _ec2_validate(svc, log):
+    rc = 0
+    msg = None
+    # only images on amazon itself are known to look like this, other clouds speaking ec2 have their own names
+    image = svc._s.image
+    iaas = svc._s.iaas or ""
+    if image and image.find("${") < 0 and not svc._s.iaas_url and iaas.find("libcloud-") != 0 and not g_ec2_image_re.match(image):
+        rc = 1
+        msg = "The image %s does not look like an EC2 image id (ami-xxxxxxxx)" % (image)
+        cloudinitd.log(log, logging.WARN, msg)
+    return (rc, msg)
+
 
 g_validate_funcs = {}
 g_validate_funcs['nimbus'] = _iaas_nimbus_validate
-g_validate_funcs['ec2'] = _ec2_nimbus_validate
+g_validate_funcs['ec2'] = _ec2_validate
 g_validate_funcs['eucalyptus'] = _ec2_nimbus_validate
 
 def iaas_validate(svc, log=logging):
@@ -490,6 +878,8 @@ def iaas_validate(svc, log=logging):
             raise ConfigException("If you are using a readypgm or a bootpgm you must have an ssh key.  Either in the launch plan or via ssh forwarding")
         msgs.append("You have no localsshkeyname set for this plan.")
         rc = 1
+    if svc._s.localkey and not os.access(svc._s.localkey, os.R_OK):
+        raise ConfigException("The ssh key %s of %s cannot be read" % (svc._s.localkey, svc.name))
 
     if not svc._s.username:
         if svc._s.readypgm or svc._s.bootpgm:
@@ -507,6 +897,6 @@ def iaas_validate(svc, log=logging):
     if msg1:
         msgs.append(msg1)
 
-    return (rc, str(msgs))
+    return (rc, "  ".join(msgs))
 
 
@@ -8,11 +8,15 @@ import stat
 import logging
 from cloudinitd.cli.cmd_opts import bootOpts
 from cloudinitd.global_deps import set_global_var, set_global_var_file, global_merge_down
-from cloudinitd.user_api import CloudInitD, CloudServiceException
+from cloudinitd.user_api import CloudInitD, CloudServiceException, MultiRunDriver, list_runs, get_fleet_iaas_history, terminate_iaas_history
 from cloudinitd.exceptions import MultilevelException, APIUsageException, ConfigException, ServiceException
 import cloudinitd
 import os
 import cloudinitd.cli.output
+import cloudinitd.pollables
+from cloudinitd.cli.daemon import serve
+from cloudinitd.pool import WarmPool
+from cloudinitd.analyze import PlanAnalysis, load_timings
 from optparse import SUPPRESS_HELP
 import simplejson as json
 
@@ -25,6 +29,7 @@ g_repair = False
 g_outfile = None
 g_commands = {}
 g_options = None # just a lame way to thread info to callbacks.
+g_multirun = False
 
 def _return_key_val(var_str):
     l_a = var_str.split("=", 1)
@@ -53,9 +58,7 @@ def print_chars(lvl, msg, color="default", bg_color="default", bold=False, under
     cloudinitd.cli.output.write_output(lvl, g_verbose, msg, color=color, bg_color=bg_color, bold=bold, underline=underline, inverse=inverse)
 
 # setup and validate options
-def parse_commands(argv):
-    global g_verbose
-
+def _make_parser():
     u = """[options] <command> [<top level launch plan> | <run name>]
 Boot and manage a launch plan
 Run with the command 'commands' to see a list of all possible commands
@@ -97,7 +100,7 @@ Run with the command 'commands' to see a list of all possible commands
     opt = bootOpts("safeclean", "C", "Do not delete the database on failed terminate, only relevant for the terminate command", False, flag=True)
     opt.add_opt(parser)
     all_opts.append(opt)
-    opt = bootOpts("kill", "k", "This option only applies to the iceage command.  When on it will terminate all VMs started with IaaS associated with this run to date.  This should be considered an extreme measure to prevent IaaS resource leaks.", False, flag=True)
+    opt = bootOpts("kill", "k", "This option only applies to the history and pool commands.  When on it will terminate all VMs started with IaaS associated with this run to date.  This should be considered an extreme measure to prevent IaaS resource leaks.", False, flag=True)
     opt.add_opt(parser)
     all_opts.append(opt)
     opt = bootOpts("outstream", "O", SUPPRESS_HELP, None)
@@ -115,8 +118,39 @@ Run with the command 'commands' to see a list of all possible commands
     opt = bootOpts("globalvarfile", "G", "Add a file to global variable space", None, append_list=True)
     opt.add_opt(parser)
     all_opts.append(opt)
+    opt = bootOpts("pipeline", "P", "Wait for VMs and upload boot programs for later levels while earlier levels are still booting.  Only relevant for boot and resume", False, flag=True)
+    opt.add_opt(parser)
+    all_opts.append(opt)
+    opt = bootOpts("fanout", "F", "Upload each boot program once and let the VMs copy it from each other, each VM serving at most this many copies at a time.  0 uploads to every VM from here.  Only relevant for boot and resume", 0, range=(0, -1))
+    opt.add_opt(parser)
+    all_opts.append(opt)
+    opt = bootOpts("pool", "w", "Keep this many idle VMs ready for each kind of VM (cloud, image, allocation, key and security groups) the plan boots.  Services take one of them instead of launching a new VM and the pool is topped up in the background.  0 does not use the pool.  Only relevant for boot, resume and repair", 0, range=(0, -1))
+    opt.add_opt(parser)
+    all_opts.append(opt)
+    opt = bootOpts("dburl", "u", "A SQLAlchemy url of a store shared by all runs (e.g. sqlite:////path/runs.db).  When set runs are kept there instead of in a file per run in the database directory", None)
+    opt.add_opt(parser)
+    all_opts.append(opt)
+    opt = bootOpts("graph", "e", "Write the service dependency graph found by analyze to this file.  A file name ending in .dot gets the DOT format, any other gets json", None)
+    opt.add_opt(parser)
+    all_opts.append(opt)
+    opt = bootOpts("maxage", "a", "Let status skip the ssh check and the ready program of a service whose full check passed less than this many seconds ago, as long as its VM is running and its ssh port answers.  0 always runs the full check", 0, range=(0, -1))
+    opt.add_opt(parser)
+    all_opts.append(opt)
+    opt = bootOpts("parallel", "p", "The most services that status (and repair) checks or boots at the same time without waiting on the levels before them.  0 works one level at a time", 32, range=(0, -1))
+    opt.add_opt(parser)
+    all_opts.append(opt)
+    opt = bootOpts("maxprocs", "m", "The most ready and terminate programs to run at the same time when status or terminate is given more than one run name.  0 means no limit", 0, range=(0, -1))
+    opt.add_opt(parser)
+    all_opts.append(opt)
+    opt = bootOpts("watchers", "W", "The number of threads that wait for launched VMs to get their hostnames.  Each makes one describe call at a time for all of the VMs of an IaaS connection that are due", 4, range=(1, -1))
+    opt.add_opt(parser)
+    all_opts.append(opt)
+    return (parser, all_opts)
 
+def parse_commands(argv):
+    global g_verbose
 
+    (parser, all_opts) = _make_parser()
     homedir = os.path.expanduser("~/.cloudinitd")
     try:
         if not os.path.exists(homedir):
@@ -131,6 +165,7 @@ Run with the command 'commands' to see a list of all possible commands
 
     for opt in all_opts:
         opt.validate(options)
+    cloudinitd.pollables.set_hostname_watcher_count(int(options.watchers))
 
     if not options.name:
         options.name = str(uuid.uuid4()).split("-")[0]
@@ -198,22 +233,30 @@ def friendly_timedelta(td):
         s = 0
     return "%.1fs" % s
 
+def _run_prefix(cb):
+    global g_multirun
+    if g_multirun:
+        return "[%s] " % (cb.run_name)
+    return ""
+
 def level_callback(cb, action, current_level):
     global g_action
 
     if action == cloudinitd.callback_action_started:
-        print_chars(2, "Begin %s level %d...\n" % (g_action, current_level))
+        print_chars(2, "%sBegin %s level %d...\n" % (_run_prefix(cb), g_action, current_level))
     elif action == cloudinitd.callback_action_transition:
         #print_chars(1, ".")
         pass
     elif action == cloudinitd.callback_action_complete:
         runtime_str = friendly_timedelta(cb.get_level_runtime(current_level))
+        print_chars(1, _run_prefix(cb))
         print_chars(1, "SUCCESS", color="green", bold=True)
         print_chars(1, " level %d" % (current_level))
         print_chars(4, " (%s)" % runtime_str)
         print_chars(1, "\n")
 
     elif action == cloudinitd.callback_action_error:
+        print_chars(1, _run_prefix(cb))
         print_chars(1, "Level %d ERROR.\n" % (current_level), color="red", bold=True)
 
 def service_callback(cb, cloudservice, action, msg):
@@ -223,7 +266,7 @@ def service_callback(cb, cloudservice, action, msg):
         print_chars(3, "\t%s\n" % (msg))
 
         global g_options
-        print_chars(3, "\tlogging to %s%s/%s.log\n" % (g_options.logdir, g_options.name, cloudservice.name))
+        print_chars(3, "\tlogging to %s%s/%s.log\n" % (g_options.logdir, cb.run_name, cloudservice.name))
         sys.stdout.flush()
     elif action == cloudinitd.callback_action_transition:
         print_chars(5, "\t%s\n" % (msg))
@@ -255,19 +298,29 @@ def reload_conf(options, args):
     config_file = args[1]
     print_chars(1, "Loading the launch plan for run ")
     print_chars(1, "%s\n" % (options.name), inverse=True, color="green", bold=True)
-    cb = CloudInitD(options.database, log_level=options.loglevel, db_name=options.name, config_file=config_file, level_callback=level_callback, service_callback=service_callback, logdir=options.logdir, fail_if_db_present=False, terminate=False, boot=False, ready=False)
+    cb = CloudInitD(options.database, log_level=options.loglevel, db_name=options.name, config_file=config_file, level_callback=level_callback, service_callback=service_callback, logdir=options.logdir, fail_if_db_present=False, terminate=False, boot=False, ready=False, dburl=options.dburl)
     if options.validate:
-        print_chars(1, "Validating the launch plan.\n")
-        errors = cb.boot_validate()
-        if len(errors) > 0:
-            print_chars(0, "The boot plan is not valid.\n", color = "red")
-            for (svc, ex) in errors:
-                print_chars(1, "Service %s had the error:\n" % (svc.name))
-                print_chars(1, "\t%s" %(str(ex)))
+        if not _validate_plan(cb):
             return 1
     return 0
 
 
+def _validate_plan(cb):
+    """Print the problems boot_validate finds in the plan, False is returned if it cannot boot"""
+    print_chars(1, "Validating the launch plan.\n")
+    warnings = []
+    errors = cb.boot_validate(warnings=warnings)
+    for (svc, msg) in warnings:
+        print_chars(1, "Service %s had the warning:\n" % (svc.name))
+        print_chars(1, "\t%s\n" % (msg))
+    if len(errors) > 0:
+        print_chars(0, "The boot plan is not valid.\n", color = "red")
+        for (svc, ex) in errors:
+            print_chars(1, "Service %s had the error:\n" % (svc.name))
+            print_chars(1, "\t%s" %(str(ex)))
+        return False
+    return True
+
 def _getenv_or_none(k):
     try:
         return os.environ[k]
@@ -276,7 +329,9 @@ def _getenv_or_none(k):
 
 def _setenv_or_none(k, v):
     if v is None:
-        os.unsetenv(k)
+        # os.unsetenv() leaves the value in os.environ, where the rest of the process still sees it
+        if k in os.environ:
+            del os.environ[k]
     else:
         os.environ[k] = v
 
@@ -302,17 +357,11 @@ def launch_new(options, args):
     print_chars(1, "Starting up run ")
     print_chars(1, "%s\n" % (options.name), inverse=True, color="green", bold=True)
 
-    cb = CloudInitD(options.database, log_level=options.loglevel, db_name=options.name, config_file=config_file, level_callback=level_callback, service_callback=service_callback, logdir=options.logdir, terminate=False, boot=True, ready=True, fail_if_db_present=True)
+    cb = CloudInitD(options.database, log_level=options.loglevel, db_name=options.name, config_file=config_file, level_callback=level_callback, service_callback=service_callback, logdir=options.logdir, terminate=False, boot=True, ready=True, fail_if_db_present=True, pipeline=options.pipeline, fanout=int(options.fanout), pool_size=int(options.pool), dburl=options.dburl)
     print_chars(3, "Logging to: %s%s.log\n"  % (options.logdir, options.name))
 
     if options.validate:
-        print_chars(1, "Validating the launch plan.\n")
-        errors = cb.boot_validate()
-        if len(errors) > 0:
-            print_chars(0, "The boot plan is not valid.\n", color = "red")
-            for (svc, ex) in errors:
-                print_chars(1, "Service %s had the error:\n" % (svc.name))
-                print_chars(1, "\t%s" %(str(ex)))
+        if not _validate_plan(cb):
             return 1
 
     if options.dryrun:
@@ -336,10 +385,7 @@ def launch_new(options, args):
             _setenv_or_none('CLOUDINITD_FAB', fab_env)
             _setenv_or_none('CLOUDINITD_SSH', ssh_env)
             if not options.noclean:
-                path = "%s/cloudinitd-%s.db" % (options.database, cb.run_name)
-                if not os.path.exists(path):
-                    raise Exception("That DB does not seem to exist: %s" % (path))
-                os.remove(path)
+                cb.remove_db()
 
         return rc
 
@@ -347,6 +393,22 @@ def launch_new(options, args):
     return rc
 
 
+def resume(options, args):
+    """
+    Finish a boot that was interrupted (for example because the cloudinitd process died).  You must supply the run name.  Services get back the VMs already launched for them instead of new ones and services that were already configured are only checked.
+    """
+    if len(args) < 2:
+        print "The resume command requires a run name.  See --help"
+        return 1
+    options.name = args[1]
+    print_chars(1, "Resuming run ")
+    print_chars(1, "%s\n" % (options.name), inverse=True, color="green", bold=True)
+
+    cb = CloudInitD(options.database, db_name=options.name, log_level=options.loglevel, level_callback=level_callback, service_callback=service_callback, logdir=options.logdir, terminate=False, boot=True, ready=True, pipeline=options.pipeline, fanout=int(options.fanout), pool_size=int(options.pool), resume=True, dburl=options.dburl)
+    (rc, cb) = _launch_new(options, args, cb)
+    return rc
+
+
 def _launch_new(options, args, cb):
     cb.pre_start_iaas()
 
@@ -384,24 +446,78 @@ def _launch_new(options, args, cb):
 
 def status(options, args):
     """
-    Check on the status of an already booted plan.  You must supply the run name of the booted plan.
+    Check on the status of an already booted plan.  You must supply the run name of the booted plan.  When more than one run name is given they are all checked at the same time.
     """
     if len(args) < 2:
         print "The status command requires a run name.  See --help"
         return 1
+    if len(args) > 2:
+        return _multi_run(options, args[1:], _start_status, _finish_status)
     rc = _status(options, args)
     return rc
 
-def _status(options, args):
-    global g_repair
+def _get_ready_max_age(options):
+    max_age = int(options.maxage)
+    if max_age == 0:
+        return None
+    return max_age
+
+def _start_status(options, dbname):
+    cb = CloudInitD(options.database, db_name=dbname, log_level=options.loglevel, level_callback=level_callback, service_callback=service_callback, logdir=options.logdir, terminate=False, boot=False, ready=True, continue_on_error=True, ready_max_age=_get_ready_max_age(options), parallel=int(options.parallel), dburl=options.dburl)
+    print_chars(1, "Checking status on %s\n" % (cb.run_name))
+    cb.start()
+    return cb
+
+def _finish_status(options, cb, ex):
+    clean_ice(options, ["clean", cb.run_name])
+    if ex is None:
+        ex = cb.get_exception()
+    if ex is None:
+        ex_list = cb.get_all_exceptions()
+        if ex_list:
+            ex = ex_list[-1]
+    if ex:
+        print_chars(4, "%sAn error occured %s" % (_run_prefix(cb), str(ex)))
+        return 1
+    return 0
+
+def _multi_run(options, run_names, start_func, finish_func):
+    """
+    Load every run, start it with start_func and then drive them all from one poll loop.  finish_func is called
+    on each run once all of them are complete and returns that run's exit code.
+    """
+    global g_multirun
+    g_multirun = True
+
+    driver = MultiRunDriver(max_processes=int(options.maxprocs))
+    rc = 0
+    for dbname in run_names:
+        try:
+            driver.add(start_func(options, dbname))
+        except CloudServiceException, svcex:
+            print svcex
+            rc = 1
+        except Exception, ex:
+            print_chars(1, "Could not load the run %s: %s\n" % (dbname, str(ex)))
+            rc = 1
+
+    try:
+        driver.block_until_complete(poll_period=0.1)
+    except KeyboardInterrupt:
+        print_chars(1, "Canceling...")
+        driver.cancel()
+        return 1
 
+    for cb in driver.get_runs():
+        if finish_func(options, cb, driver.get_exception(cb.run_name)) != 0:
+            rc = 1
+    return rc
+
+def _status(options, args):
     dbname = args[1]
-    c_on_e = not g_repair
     options.name = dbname
 
-    cb = CloudInitD(options.database, db_name=dbname, log_level=options.loglevel, level_callback=level_callback, service_callback=service_callback, logdir=options.logdir, terminate=False, boot=False, ready=True, continue_on_error=c_on_e)
-    print_chars(1, "Checking status on %s\n" % (cb.run_name))
-    cb.start()
+    cb = _start_status(options, dbname)
     try:
         try:
             cb.block_until_complete(poll_period=0.1)
@@ -419,14 +535,11 @@ def _status(options, args):
         clean_ice(options, fake_args)
 
     rc = 0
-    if g_repair:
-        ex = cb.get_last_exception()
-    else:
-        ex = cb.get_exception()
-        if ex is None:
-            ex_list = cb.get_all_exceptions()
-            if ex_list:
-                ex = ex_list[-1]
+    ex = cb.get_exception()
+    if ex is None:
+        ex_list = cb.get_all_exceptions()
+        if ex_list:
+            ex = ex_list[-1]
     if ex:
         print_chars(4, "An error occured %s" % (str(ex)))
         rc = 1
@@ -437,50 +550,66 @@ def _status(options, args):
 
 def terminate(options, args):
     """
-    Terminate an already booted plan.  You must supply the run name of the booted plan.
+    Terminate an already booted plan.  You must supply the run name of the booted plan.  When more than one run name is given they are all terminated at the same time.
     """
     if len(args) < 2:
         print "The terminate command requires a run name.  See --help"
         return 1
+    if len(args) > 2:
+        return _multi_run(options, args[1:], _start_terminate, _finish_terminate)
 
-    for dbname in args[1:]:
-        options.name = dbname
-        rc = 0
+    dbname = args[1]
+    options.name = dbname
+    try:
+        cb = _start_terminate(options, dbname)
         try:
-            cb = CloudInitD(options.database, log_level=options.loglevel, db_name=dbname, level_callback=level_callback, service_callback=service_callback, logdir=options.logdir, terminate=True, boot=False, ready=False, continue_on_error=True)
-            print_chars(1, "Terminating %s\n" % (cb.run_name))
-            cb.shutdown()
-
             cb.block_until_complete(poll_period=0.1)
-            if not options.noclean:
-                path = "%s/cloudinitd-%s.db" % (options.database, dbname)
-                if not os.path.exists(path):
-                    raise Exception("That DB does not seem to exist: %s" % (path))
-                if not options.safeclean or (cb.get_exception() is None and not cb.get_all_exceptions()):
-                    print_chars(1, "Deleting the db file %s\n" % (path))
-                    os.remove(path)
-                else:
-                    print_chars(4, "There were errors when terminating %s, keeping db\n" % (cb.run_name))
-
-            ex = cb.get_exception()
-            if ex is None:
-                ex_list = cb.get_all_exceptions()
-                if ex_list:
-                    ex = ex_list[-1]
-            if ex is not None:
-                print_chars(4, "An error occured %s" % (str(ex)))
-                raise ex
-        except CloudServiceException, svcex:
-            print svcex
-            rc = 1
-        except Exception, mex:
-            rc = 1
         except KeyboardInterrupt:
             print_chars(1, "Canceling...")
             cb.cancel()
             return 1
+    except CloudServiceException, svcex:
+        print svcex
+        return 1
+    except Exception, mex:
+        return 1
+    return _finish_terminate(options, cb, None)
 
-    return rc
+def _start_terminate(options, dbname):
+    cb = CloudInitD(options.database, log_level=options.loglevel, db_name=dbname, level_callback=level_callback, service_callback=service_callback, logdir=options.logdir, terminate=True, boot=False, ready=False, continue_on_error=True, dburl=options.dburl)
+    print_chars(1, "Terminating %s\n" % (cb.run_name))
+    cb.shutdown()
+    return cb
+
+def _finish_terminate(options, cb, ex):
+    if ex is not None:
+        # the run stopped part way through, keep the db so that it can be terminated again
+        print_chars(4, "%sAn error occured %s" % (_run_prefix(cb), str(ex)))
+        return 1
+
+    if not options.noclean:
+        path = cb.get_db_file()
+        if path is not None and not os.path.exists(path):
+            print_chars(4, "That DB does not seem to exist: %s\n" % (path))
+            return 1
+        if not options.safeclean or (cb.get_exception() is None and not cb.get_all_exceptions()):
+            if path is None:
+                print_chars(1, "Deleting %s from %s\n" % (cb.run_name, options.dburl))
+            else:
+                print_chars(1, "Deleting the db file %s\n" % (path))
+            cb.remove_db()
+        else:
+            print_chars(4, "There were errors when terminating %s, keeping db\n" % (cb.run_name))
+
+    ex = cb.get_exception()
+    if ex is None:
+        ex_list = cb.get_all_exceptions()
+        if ex_list:
+            ex = ex_list[-1]
+    if ex is not None:
+        print_chars(4, "%sAn error occured %s" % (_run_prefix(cb), str(ex)))
+        return 1
+    return 0
 
 def reboot(options, args):
     """
@@ -490,7 +619,7 @@ def reboot(options, args):
         print "The reboot command requires a run name.  See --help"
         return 1
     dbname = args[1]
-    cb = CloudInitD(options.database, db_name=dbname, log_level=options.loglevel, level_callback=level_callback, service_callback=service_callback, logdir=options.logdir, terminate=True, boot=False, ready=False, continue_on_error=True)
+    cb = CloudInitD(options.database, db_name=dbname, log_level=options.loglevel, level_callback=level_callback, service_callback=service_callback, logdir=options.logdir, terminate=True, boot=False, ready=False, continue_on_error=True, dburl=options.dburl)
     print_chars(1, "Rebooting %s\n" % (cb.run_name))
     cb.shutdown()
     try:
@@ -499,7 +628,7 @@ def reboot(options, args):
             options.logger.info("Terminating all services")
             cb.block_until_complete(poll_period=0.1)
             options.logger.info("Starting services back up")
-            cb = CloudInitD(options.database, db_name=dbname, log_level=options.loglevel, level_callback=level_callback, service_callback=service_callback, logdir=options.logdir, terminate=False, boot=True, ready=True, continue_on_error=False)
+            cb = CloudInitD(options.database, db_name=dbname, log_level=options.loglevel, level_callback=level_callback, service_callback=service_callback, logdir=options.logdir, terminate=False, boot=True, ready=True, continue_on_error=False, dburl=options.dburl)
             print_chars(1, "Booting all services %s\n" % (cb.run_name))
             cb.start()
             cb.block_until_complete(poll_period=0.1)
@@ -543,27 +672,39 @@ def list(options, args):
     """
     List all existing booted plans.
     """
-    l = os.listdir(options.database)
-
-    for db in l:
-        if db.find("cloudinitd-") == 0 and db[-3:] == ".db":
-            name = db.replace("cloudinitd-", "")
-            print_chars(0, name[:-3] + "\n")
+    for name in list_runs(options.database, dburl=options.dburl):
+        print_chars(0, name + "\n")
     return 0
 
 
-def iceage(options, args):
+def _get_history(options, args, cmd, orphans=False):
+    """
+    Return (cb, history).  With --dburl and no run name the history of every run in the shared store is returned
+    and cb is None.
+    """
     if len(args) < 2:
-        print "The iceage command requires a run name.  See --help"
-        return 1
+        if options.dburl:
+            return (None, get_fleet_iaas_history(options.dburl, log=options.logger, orphans=orphans))
+        print "The %s command requires a run name.  See --help" % (cmd)
+        return (None, None)
     dbname = args[1]
 
-    cb = CloudInitD(options.database, db_name=dbname, log_level=options.loglevel, logdir=options.logdir, terminate=False, boot=False, ready=True)
-    ha = cb.get_iaas_history()
+    cb = CloudInitD(options.database, db_name=dbname, log_level=options.loglevel, logdir=options.logdir, terminate=False, boot=False, ready=True, dburl=options.dburl)
+    return (cb, cb.get_iaas_history(orphans=orphans))
+
+
+def iceage(options, args):
+    (cb, ha) = _get_history(options, args, "iceage")
+    if ha is None:
+        return 1
 
     print_chars(0, "ID      \t:\tstate:\tassociated service\n")
+    kill_list = []
     for h in ha:
-        print_chars(1, "%s\t:\t%s\t:\t" % (h.get_id(), h.get_service_name()))
+        name = h.get_service_name()
+        if cb is None:
+            name = "%s/%s" % (h.get_run_name(), name)
+        print_chars(1, "%s\t:\t%s\t:\t" % (h.get_id(), name))
         state = h.get_state()
         clean = False
         color = None
@@ -579,7 +720,9 @@ def iceage(options, args):
         print_chars(1, ": %s\n" % (state), color=color)
         if options.kill and clean:
             print_chars(1, "Terminating %s\n" % (h.get_id()), bold=True)
-            h.terminate()
+            kill_list.append(h)
+
+    terminate_iaas_history(kill_list)
 
     return 0
 
@@ -587,40 +730,162 @@ def iceage(options, args):
 
 def clean_ice(options, args):
     """
-    Clean all orphaned VMs
+    Clean all orphaned VMs.  With --dburl and no run name the orphans of every run in the shared store are cleaned.
     """
-    if len(args) < 2:
-        print "The iceage command requires a run name.  See --help"
+    (cb, ha) = _get_history(options, args, "clean", orphans=True)
+    if ha is None:
         return 1
-    dbname = args[1]
-
-    cb = CloudInitD(options.database, db_name=dbname, log_level=options.loglevel, logdir=options.logdir, terminate=False, boot=False, ready=True)
-    ha = cb.get_iaas_history()
 
+    kill_list = []
     for h in ha:
         state = h.get_state()
         handle = h.get_service_iaas_handle()
         if state == "running":
             if handle != h.get_id():
                 print_chars(2, "Terminating an orphaned VM %s\n" % (h.get_id()), bold=True)
-                h.terminate()
+                kill_list.append(h)
             elif h.get_context_state() == cloudinitd.service_state_initial:
                 print_chars(2, "Terminating pre-staged VM %s\n" % (h.get_id()), bold=True)
-                h.terminate()
+                kill_list.append(h)
+    terminate_iaas_history(kill_list)
 
     return 0
 
 
+def analyze(options, args):
+    """
+    Check a launch plan without booting it.  You must supply the path to a top level configuration file.  The attribute references between services are checked and the boot time of the plan is estimated from the past runs in the database (or --dburl), along with the levels services could be moved to so that it boots faster.  With --graph the dependency graph is written out.
+    """
+    if len(args) < 2:
+        print "The analyze command requires a top level file.  See --help"
+        return 1
+
+    timings = load_timings(options.database, dburl=options.dburl)
+    a = PlanAnalysis(args[1], timings=timings)
+
+    for (ndx, level) in enumerate(a.levels):
+        print_chars(1, "level%d:\n" % (ndx + 1), bold=True)
+        for name in level:
+            note = ""
+            if name not in a.timed:
+                note = " (no past runs)"
+            print_chars(1, "\t%s\t%.1fs%s\n" % (name, a.durations[name], note))
+
+    for (severity, msg) in a.problems:
+        color = "yellow"
+        if severity == "error":
+            color = "red"
+        print_chars(0, "%s: " % (severity), color=color, bold=True)
+        print_chars(0, "%s\n" % (msg))
+
+    print_chars(1, "Estimated boot time: %.1fs\n" % (a.get_levels_duration()))
+    (cp_time, cp_path) = a.get_critical_path()
+    if cp_time is not None:
+        print_chars(1, "Critical path: %.1fs (%s)\n" % (cp_time, " -> ".join(cp_path)))
+    (new_levels, moves) = a.get_suggested_levels()
+    if moves:
+        print_chars(1, "Booting in %.1fs is possible by moving:\n" % (a.get_levels_duration(new_levels)), bold=True)
+        for (name, from_level, to_level) in moves:
+            print_chars(1, "\t%s from level%d to level%d\n" % (name, from_level, to_level))
+        print_chars(2, "Only attribute references were considered, check that nothing else relies on the order of these services\n")
+
+    if options.graph:
+        f = open(options.graph, "w")
+        try:
+            if options.graph.endswith(".dot"):
+                f.write(a.get_dot())
+            else:
+                f.write(json.dumps(a.get_json_doc(), indent=4))
+        finally:
+            f.close()
+
+    if a.has_errors():
+        return 1
+    return 0
+
+
+def pool(options, args):
+    """
+    List the idle VMs in the warm pool kept in the database directory.  With --kill they are all terminated and the pool is emptied.
+    """
+    p = WarmPool(options.database, 0)
+    rows = p.get_instances()
+    print_chars(0, "ID      \t:\timage\t:\tallocation\t:\tsince\n")
+    for r in rows:
+        print_chars(1, "%s\t:\t%s\t:\t%s\t:\t%s\n" % (r.instance_id, r.image, r.allocation, str(r.timestamp)))
+    if options.kill and rows:
+        print_chars(1, "Terminating %d pooled VMs\n" % (len(rows)), bold=True)
+        p.drain()
+    return 0
+
+
 def repair(options, args):
     """
-    Check the status of all services.  If any services fail, reboot them.
+    Check the status of all services.  The services that fail are rebooted along with every service that uses their attributes.  The rest of the plan is left alone.
     """
-    global g_repair
-    g_repair = True
     if len(args) < 2:
         print "The repair command requires a run name.  See --help"
         return 1
-    return _status(options, args)
+    return _repair(options, args)
+
+def _repair(options, args):
+    global g_repair
+
+    dbname = args[1]
+    options.name = dbname
+
+    # check everything at once, the same way status would
+    g_repair = False
+    cb = _start_status(options, dbname)
+    try:
+        cb.block_until_complete(poll_period=0.1)
+    except KeyboardInterrupt:
+        print_chars(1, "Canceling...")
+        cb.cancel()
+        return 1
+
+    failed = cb.get_failed_services()
+    if not failed:
+        clean_ice(options, ["clean", dbname])
+        _write_json_doc(options, cb)
+        return 0
+
+    names = cb.get_dependent_services(failed)
+    print_chars(1, "Repairing %s\n" % (", ".join(names)))
+    # only the failed services get new VMs, the services using them are booted again on the VMs they have
+    consumers = [n for n in names if n not in failed]
+
+    # the failed subtree is redone at once, each service waiting only on the ones it uses.  a service that fails
+    # again is restarted by the callback
+    g_repair = True
+    try:
+        cb = CloudInitD(options.database, db_name=dbname, log_level=options.loglevel, level_callback=level_callback, service_callback=service_callback, logdir=options.logdir, terminate=True, boot=True, ready=True, continue_on_error=False, services=names, keep_vm=consumers, parallel=int(options.parallel), pool_size=int(options.pool), dburl=options.dburl)
+        cb.start()
+        try:
+            cb.block_until_complete(poll_period=0.1)
+        except CloudServiceException, svcex:
+            print svcex
+            return 1
+        except MultilevelException, mex:
+            print mex
+            return 1
+        except KeyboardInterrupt:
+            print_chars(1, "Canceling...")
+            cb.cancel()
+            return 1
+    finally:
+        clean_ice(options, ["clean", dbname])
+
+    rc = 0
+    ex = cb.get_last_exception()
+    if ex:
+        print_chars(4, "An error occured %s" % (str(ex)))
+        rc = 1
+
+    if options.output:
+        cb = CloudInitD(options.database, db_name=dbname, log_level=options.loglevel, logdir=options.logdir, terminate=False, boot=False, ready=False, dburl=options.dburl)
+        _write_json_doc(options, cb)
+    return rc
 
 
 def main(argv=sys.argv[1:]):
@@ -640,8 +905,12 @@ def main(argv=sys.argv[1:]):
     # process the command
     global g_action
     global g_outfile
+    global g_repair
+    global g_multirun
 
     command = args[0]
+    g_repair = False
+    g_multirun = False
     g_action = command
 
     g_commands["boot"] = launch_new
@@ -654,6 +923,10 @@ def main(argv=sys.argv[1:]):
     g_commands["reload"] = reload_conf
     g_commands["history"] = iceage
     g_commands["clean"] = clean_ice
+    g_commands["serve"] = serve
+    g_commands["pool"] = pool
+    g_commands["resume"] = resume
+    g_commands["analyze"] = analyze
 
     if command not in g_commands:
         print "Invalid command.  Run with --help"
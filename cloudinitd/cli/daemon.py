@@ -0,0 +1,346 @@
+"""
+cloudinitd serve: a long running process that keeps runs, IaaS connections and ssh master connections warm and
+runs cloudinitd commands handed to it over a local unix socket.
+
+The protocol is one json line from the client:
+
+    {"argv": [...], "cwd": "...", "env": {...}, "isatty": true}
+
+answered by any number of {"out": "..."} lines carrying the command's output and a final {"rc": N} line.
+
+Commands are handled at the same time.  The environment, working directory and stdout a command runs with are
+process wide, so the commands that only read run state (g_read_commands) run in the server one after another and
+every other command runs in a child forked for it.  Commands that name the same run wait on each other.
+
+This module is also the console entry point.  When a server is listening the command line is forwarded to it,
+otherwise the command runs in this process.  Only light modules are imported until it is known which of the two it
+is.
+"""
+import os
+import sys
+import signal
+import socket
+import SocketServer
+import threading
+import simplejson as json
+
+SOCKET_ENV_STR = "CLOUDINITD_SOCKET"
+
+# short commands that do not change run state, these run inside the server and keep its loaded runs warm
+g_read_commands = ["status", "list", "commands", "history", "analyze"]
+# the commands whose arguments after the command word are run names
+g_run_commands = ["terminate", "reboot", "repair", "reload", "resume"]
+
+# set while this process is serving, a forwarded 'serve' is refused
+g_serving = False
+# held while a command runs inside the server, and while a child is forked
+g_inproc_lock = threading.Lock()
+# (db dir, run name) -> lock held by the forked command working on that run
+g_run_locks = {}
+g_run_locks_lock = threading.Lock()
+
+
+def get_socket_path():
+    if SOCKET_ENV_STR in os.environ:
+        return os.environ[SOCKET_ENV_STR]
+    return os.path.expanduser("~/.cloudinitd/cloudinitd.sock")
+
+
+class _SocketWriter(object):
+    """A file like object that sends everything written to it to the client"""
+
+    def __init__(self, wfile, isatty):
+        self._wfile = wfile
+        self._isatty = isatty
+
+    def write(self, msg):
+        if not msg:
+            return
+        if isinstance(msg, str):
+            msg = msg.decode("utf8", "replace")
+        self._wfile.write(json.dumps({"out": msg}) + "\n")
+
+    def flush(self):
+        self._wfile.flush()
+
+    def isatty(self):
+        return self._isatty
+
+
+def _run_request(req, out):
+    """Run one forwarded command line as though it were its own cloudinitd process"""
+    import traceback
+    import cloudinitd
+    import cloudinitd.cli.boot
+    from cloudinitd.global_deps import reset_globals
+    from cloudinitd.statics import SSH_CONTROL_DIR_ENV_STR
+    from cloudinitd.user_api import flush_db_cache
+
+    saved_env = dict(os.environ)
+    saved_cwd = os.getcwd()
+    saved_out = (sys.stdout, sys.stderr)
+    saved_loggers = len(cloudinitd.g_open_loggers)
+
+    env = dict(req.get("env", {}))
+    if SSH_CONTROL_DIR_ENV_STR not in env and SSH_CONTROL_DIR_ENV_STR in saved_env:
+        env[SSH_CONTROL_DIR_ENV_STR] = saved_env[SSH_CONTROL_DIR_ENV_STR]
+    os.environ.clear()
+    os.environ.update(env)
+    reset_globals()
+    try:
+        os.chdir(req.get("cwd", saved_cwd))
+        sys.stdout = out
+        sys.stderr = out
+        try:
+            rc = cloudinitd.cli.boot.main(list(req.get("argv", [])))
+        except SystemExit, ex:
+            rc = ex.code
+        except Exception, ex:
+            out.write(traceback.format_exc())
+            rc = 1
+    finally:
+        (sys.stdout, sys.stderr) = saved_out
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+        flush_db_cache()
+        cloudinitd.remove_log_handlers(since=saved_loggers)
+    if rc is None:
+        rc = 0
+    return rc
+
+
+def _client_expanduser(path, env):
+    """os.path.expanduser() with the HOME of the client rather than the one of the server"""
+    home = env.get("HOME")
+    if home and (path == "~" or path.startswith("~/")):
+        return home + path[1:]
+    return os.path.expanduser(path)
+
+def _classify_request(req):
+    """Return (read only, run lock keys) for a forwarded command line"""
+    import cloudinitd.cli.boot
+
+    (parser, all_opts) = cloudinitd.cli.boot._make_parser()
+    # bad options and --help only print, the command run in the server reports them
+    saved_err = sys.stderr
+    sys.stderr = open(os.devnull, "w")
+    try:
+        try:
+            (options, args) = parser.parse_args(args=list(req.get("argv", [])))
+        except SystemExit:
+            return (True, [])
+    finally:
+        sys.stderr.close()
+        sys.stderr = saved_err
+    if not args:
+        return (True, [])
+    command = args[0]
+    # a nested serve only has to be refused
+    if command == "serve" or (command in g_read_commands and not options.kill):
+        return (True, [])
+
+    dbdir = _client_expanduser(options.database or "~/.cloudinitd", req.get("env", {}))
+    dbdir = os.path.normpath(os.path.join(req.get("cwd", ""), dbdir))
+    names = []
+    if command == "boot" and options.name:
+        names = [options.name]
+    elif command in g_run_commands:
+        names = args[1:]
+    keys = sorted(set([(dbdir, n) for n in names]))
+    return (False, keys)
+
+def _lock_runs(keys):
+    locks = []
+    g_run_locks_lock.acquire()
+    try:
+        for k in keys:
+            if k not in g_run_locks:
+                g_run_locks[k] = threading.Lock()
+            locks.append(g_run_locks[k])
+    finally:
+        g_run_locks_lock.release()
+    # always taken in sorted key order so two commands naming the same runs cannot deadlock
+    for l in locks:
+        l.acquire()
+    return locks
+
+def _forget_parent_state():
+    """
+    In a freshly forked child: drop the sqlite connections, IaaS connections and watcher threads inherited from the
+    server.  They belong to the server and are still in use there, the child makes its own.
+    """
+    import cloudinitd.cb_iaas
+    import cloudinitd.pollables
+    import cloudinitd.user_api
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    if cloudinitd.user_api.g_db_cache is not None:
+        cloudinitd.user_api.g_db_cache = {}
+    if cloudinitd.cb_iaas.g_boto_con_cache is not None:
+        cloudinitd.cb_iaas.g_boto_con_cache = {}
+    cloudinitd.cb_iaas.g_libcloud_node_lists = {}
+    cloudinitd.cb_iaas.g_lock = threading.Lock()
+    cloudinitd.pollables.g_hostname_watchers = None
+    cloudinitd.pollables.g_hostname_watchers_lock = threading.Lock()
+    cloudinitd.pollables.g_process_slots_lock = threading.RLock()
+    cloudinitd.pollables.g_slot_holders = set()
+
+def _fork_request(req, out, wfile):
+    """Run a command in a child of the server, the child answers the client itself.  Returns once it is done"""
+    # nothing runs inside the server while it forks, the locks a command takes are all free in the child
+    g_inproc_lock.acquire()
+    try:
+        pid = os.fork()
+    finally:
+        g_inproc_lock.release()
+    if pid == 0:
+        # the client sees the connection close without an rc if this fails
+        try:
+            _forget_parent_state()
+            rc = _run_request(req, out)
+            wfile.write(json.dumps({"rc": rc}) + "\n")
+            wfile.flush()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+def serve(options, args):
+    """
+    Run in the foreground as a server for other cloudinitd commands.  While it runs, every cloudinitd command is handed to it over the unix socket $CLOUDINITD_SOCKET (default ~/.cloudinitd/cloudinitd.sock).  Loaded runs, IaaS connections and ssh connections are kept between commands.  Commands are run at the same time, a status is not held up by a boot.
+    """
+    import cloudinitd
+    import cloudinitd.cb_iaas
+    import cloudinitd.cli.boot
+    from cloudinitd.statics import SSH_CONTROL_DIR_ENV_STR
+    from cloudinitd.user_api import enable_db_cache
+
+    global g_serving
+
+    path = get_socket_path()
+    if g_serving:
+        cloudinitd.cli.boot.print_chars(0, "A server is already listening on %s\n" % (path))
+        return 1
+    if os.path.exists(path):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                s.connect(path)
+                cloudinitd.cli.boot.print_chars(0, "A server is already listening on %s\n" % (path))
+                return 1
+            except socket.error:
+                os.remove(path)
+        finally:
+            s.close()
+
+    if SSH_CONTROL_DIR_ENV_STR not in os.environ:
+        ssh_dir = os.path.join(options.database, "ssh")
+        if not os.path.exists(ssh_dir):
+            os.mkdir(ssh_dir, 0700)
+        os.environ[SSH_CONTROL_DIR_ENV_STR] = ssh_dir
+    enable_db_cache()
+    cloudinitd.cb_iaas.enable_connection_cache()
+
+    class _Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                return
+            req = json.loads(line)
+            out = _SocketWriter(self.wfile, req.get("isatty", False))
+            # the server only logs while holding g_inproc_lock, a child must not be forked while a logging handler
+            # lock is held by another thread
+            g_inproc_lock.acquire()
+            try:
+                options.logger.info("running %s" % (str(req.get("argv"))))
+                (read_only, keys) = _classify_request(req)
+                if read_only:
+                    rc = _run_request(req, out)
+                    self.wfile.write(json.dumps({"rc": rc}) + "\n")
+                    return
+            finally:
+                g_inproc_lock.release()
+            locks = _lock_runs(keys)
+            try:
+                _fork_request(req, out, self.wfile)
+            finally:
+                for l in locks:
+                    l.release()
+
+    class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+    old_umask = os.umask(0077)
+    try:
+        server = _Server(path, _Handler)
+    finally:
+        os.umask(old_umask)
+    g_serving = True
+    # stop between accepts.  an exception raised in the middle of one would be swallowed by SocketServer.  commands
+    # already running are not waited on, forked ones finish and answer their clients on their own
+    stop = []
+    def _stop_handler(signum, frame):
+        stop.append(signum)
+    signal.signal(signal.SIGTERM, _stop_handler)
+    signal.signal(signal.SIGINT, _stop_handler)
+
+    cloudinitd.cli.boot.print_chars(1, "Serving cloudinitd commands on %s\n" % (path))
+    server.timeout = 0.5
+    try:
+        while not stop:
+            server.handle_request()
+    finally:
+        g_serving = False
+        server.server_close()
+        os.remove(path)
+    return 0
+
+
+def forward(argv, path=None):
+    """
+    Hand a command line to a running server and copy its output to stdout.  Returns the exit code of the command
+    or None if no server could be reached.
+    """
+    if path is None:
+        path = get_socket_path()
+    if not os.path.exists(path):
+        return None
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error:
+        s.close()
+        return None
+
+    req = {"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ), "isatty": sys.stdout.isatty()}
+    f = s.makefile("rw")
+    try:
+        f.write(json.dumps(req) + "\n")
+        f.flush()
+        for line in f:
+            msg = json.loads(line)
+            if "rc" in msg:
+                return msg["rc"]
+            sys.stdout.write(msg["out"].encode("utf8"))
+            sys.stdout.flush()
+    finally:
+        f.close()
+        s.close()
+    # the server went away in the middle of the command
+    return 1
+
+
+def main(argv=sys.argv[1:]):
+    # a 'serve' that reaches a running server is refused by it
+    if argv:
+        rc = forward(argv)
+        if rc is not None:
+            return rc
+    import cloudinitd.cli.boot
+    return cloudinitd.cli.boot.main(argv)
+
+
+if __name__ == "__main__":
+    rc = main()
+    sys.exit(rc)
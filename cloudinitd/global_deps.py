@@ -2,7 +2,6 @@ import ConfigParser
 from cloudinitd.exceptions import ConfigException
 
 g_var_objects = {}
-g_global_obj = {}
 
 class CidVarObject(object):
 
@@ -13,6 +12,8 @@ class CidVarObject(object):
     def set_var(self, key, val):
         self.vars[key] = val
 
+g_global_obj = CidVarObject()
+
 def set_global_var_file(path, rank):
     parser = ConfigParser.ConfigParser()
     parser.read(path)
@@ -49,3 +50,10 @@ def get_global(key, default=None, raise_ex=False):
             raise ConfigException("The global variable %s is not set." % (key))
         return default
     return g_global_obj.vars[key]
+
+def reset_globals():
+    """Forget every global variable.  Lets one process handle many plans as if each was its own process"""
+    global g_var_objects
+    global g_global_obj
+    g_var_objects = {}
+    g_global_obj = CidVarObject()
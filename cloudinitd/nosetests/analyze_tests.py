@@ -0,0 +1,96 @@
+import cloudinitd
+import cloudinitd.nosetests
+import cloudinitd.cli.boot
+from cloudinitd.user_api import CloudInitD
+from cloudinitd.analyze import PlanAnalysis, load_timings
+import tempfile
+import simplejson as json
+import sqlite3
+
+
+
+import unittest
+import os
+
+class AnalyzeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.plan_basedir = cloudinitd.nosetests.g_plans_dir
+
+    def tearDown(self):
+        cloudinitd.close_log_handlers()
+
+    def test_suggest_levels(self):
+        timings = {"onelvl1": 5.0, "l2service": 30.0, "One_l3": 10.0, "Two_l3": 10.0}
+        a = PlanAnalysis(self.plan_basedir + "/multileveldeps/top.conf", timings=timings)
+        self.assertEqual(a.problems, [])
+        self.assertEqual(a.get_levels_duration(), 45.0)
+        (cp_time, cp_path) = a.get_critical_path()
+        self.assertEqual(cp_time, 35.0)
+        self.assertEqual(cp_path, ["onelvl1", "l2service"])
+
+        # the level3 services only use onelvl1 so they can boot next to l2service
+        (levels, moves) = a.get_suggested_levels()
+        self.assertEqual(levels, [["onelvl1"], ["l2service", "One_l3", "Two_l3"]])
+        self.assertEqual(sorted(moves), [("One_l3", 3, 2), ("Two_l3", 3, 2)])
+        self.assertEqual(a.get_levels_duration(levels), 35.0)
+
+        doc = a.get_json_doc()
+        self.assertEqual(doc["services"]["l2service"]["uses"], ["onelvl1"])
+        self.assertTrue({"from": "onelvl1", "to": "l2service", "attr": "hostname"} in doc["edges"])
+
+    def test_bad_refs(self):
+        a = PlanAnalysis(self.plan_basedir + "/baddeps/top.conf")
+        self.assertTrue(a.has_errors())
+        self.assertTrue(a.problems[0][1].find("XXXXX") >= 0, str(a.problems))
+
+        a = PlanAnalysis(self.plan_basedir + "/cycledeps/top.conf")
+        self.assertTrue(a.has_errors())
+        self.assertEqual(len(a.cycles), 1)
+        self.assertEqual(sorted(a.cycles[0]), ["first", "second"])
+        self.assertEqual(a.get_critical_path(), (None, []))
+
+    def test_timings_from_journal(self):
+        dir = tempfile.mkdtemp()
+        conf_file = self.plan_basedir + "/oneservice/top.conf"
+        cb = CloudInitD(dir, conf_file, terminate=False, boot=True, ready=True)
+        cb.start()
+        cb.block_until_complete(poll_period=0.1)
+
+        timings = load_timings(dir)
+        self.assertTrue(timings["sampleservice"] > 0.0)
+
+        # dbs with no journal or that cannot be read are skipped and left as they were
+        old_db = os.path.join(dir, "cloudinitd-old.db")
+        con = sqlite3.connect(old_db)
+        con.execute("CREATE TABLE boot (id INTEGER)")
+        con.commit()
+        con.close()
+        f = open(os.path.join(dir, "cloudinitd-junk.db"), "w")
+        f.write("not a database" * 100)
+        f.close()
+        self.assertEqual(load_timings(dir), timings)
+        con = sqlite3.connect(old_db)
+        tables = [r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        con.close()
+        self.assertEqual(tables, ["boot"])
+        os.remove(old_db)
+        os.remove(os.path.join(dir, "cloudinitd-junk.db"))
+
+        (osf, outfile) = tempfile.mkstemp()
+        os.close(osf)
+        graph = os.path.join(dir, "plan.json")
+        rc = cloudinitd.cli.boot.main(["-O", outfile, "-d", dir, "--graph", graph, "analyze", conf_file])
+        self.assertEqual(rc, 0)
+        f = open(graph, "r")
+        doc = json.load(f)
+        f.close()
+        self.assertTrue(doc["services"]["sampleservice"]["timed"])
+
+        cb = CloudInitD(dir, db_name=cb.run_name, terminate=True, boot=False, ready=False)
+        cb.shutdown()
+        cb.block_until_complete(poll_period=0.1)
+        os.remove(cb.get_db_file())
+
+if __name__ == '__main__':
+    unittest.main()
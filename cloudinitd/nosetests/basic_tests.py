@@ -59,5 +59,25 @@ class BasicUserAPITests(unittest.TestCase):
         tst_name = "localhostexe"
         self._start_one(tst_name)
 
+    def test_pipeline(self):
+        dir = tempfile.mkdtemp()
+        conf_file = self.plan_basedir + "/multilevelsimple/top.conf"
+        cb = CloudInitD(dir, conf_file, terminate=False, boot=True, ready=True, pipeline=True)
+        cb.start()
+        rc = cb.poll()
+        self.assertFalse(rc)
+        # the last level has not been started but its VM work has
+        svc = cb._boot_top.get_service("One_l3")
+        self.assertTrue(svc._early_started)
+        cb.block_until_complete(poll_period=0.1)
+        for s in cb.get_all_services():
+            self.assertEqual(s._svc._s.state, cloudinitd.service_state_contextualized)
+
+        cb = CloudInitD(dir, db_name=cb.run_name, terminate=True, boot=False, ready=False)
+        cb.shutdown()
+        cb.block_until_complete(poll_period=1.0)
+        fname = cb.get_db_file()
+        os.remove(fname)
+
 if __name__ == '__main__':
     unittest.main()
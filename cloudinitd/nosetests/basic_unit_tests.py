@@ -8,10 +8,35 @@ import unittest
 import cloudinitd
 import logging
 import traceback
+import subprocess
+import sys
+import time
+import simplejson as json
 
 class FakeSvc(object):
-    def __init__(self, n):
+    def __init__(self, n, deps=None):
         self.name = n
+        self._deps = deps or {}
+
+    def get_dep(self, key):
+        return self._deps.get(key)
+
+def make_counting_driver(calls):
+    """A libcloud dummy driver that records the name of each listing call it gets in calls"""
+    from libcloud.compute.drivers.dummy import DummyNodeDriver
+
+    class CountingDriver(DummyNodeDriver):
+        def __init__(self, key, secret, **kwargs):
+            DummyNodeDriver.__init__(self, 0)
+
+        def list_sizes(self, location=None):
+            calls.append("list_sizes")
+            return DummyNodeDriver.list_sizes(self, location)
+
+        def list_nodes(self):
+            calls.append("list_nodes")
+            return DummyNodeDriver.list_nodes(self)
+    return CountingDriver
 
 class BasicUnitTests(unittest.TestCase):
 
@@ -51,6 +76,92 @@ class BasicUnitTests(unittest.TestCase):
         ex = ConfigException("msg")
         ex = IaaSException(ex)
 
+    def test_startup(self):
+        # how long the cli takes to start.  the cloud drivers and the ORM must not be loaded by commands that do not
+        # use them
+        script = """
+import sys, time
+import simplejson as json
+start = time.time()
+import cloudinitd.cli.boot
+took = time.time() - start
+cloudinitd.cli.boot.main(["-O", "/dev/null", "commands"])
+heavy = sorted(set([m.split(".")[0] for m in sys.modules if m.split(".")[0] in ("boto", "libcloud", "sqlalchemy", "fabric")]))
+sys.stderr.write(json.dumps({"took": took, "heavy": heavy}))
+"""
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.abspath(cloudinitd.__file__)))
+        p = subprocess.Popen([sys.executable, "-c", script], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = p.communicate()
+        self.assertEqual(p.returncode, 0, err)
+        report = json.loads(err.strip().split("\n")[-1])
+        print "cli import took %f seconds" % (report["took"])
+        self.assertEqual(report["heavy"], [])
+
+
+    def test_libcloud_catalog(self):
+        import cloudinitd.cb_iaas as cb_iaas
+
+        calls = []
+        cb_iaas._import_libcloud()
+        provider = cb_iaas.g_libcloud_providers["dummy"]
+        cb_iaas.g_libcloud_drivers[provider] = make_counting_driver(calls)
+        ttl = cb_iaas.g_libcloud_catalog_ttl
+        try:
+            svc = FakeSvc("libcloudsvc", {"image": "1", "allocation": "2"})
+            secret = str(uuid.uuid4())
+            cons = [cb_iaas.IaaSLibCloudConn(svc, "0", secret, None, "libcloud-dummy") for i in range(3)]
+            self.assertTrue(cons[0]._catalog is cons[2]._catalog)
+
+            # the sizes are listed once for all of the connections with the same credentials
+            for con in cons:
+                con.run_instance()
+            self.assertEqual(calls.count("list_sizes"), 1)
+
+            # a size that is not in the list is looked for again before failing
+            svc._deps["allocation"] = "nosuchsize"
+            self.assertRaises(Exception, cons[0].run_instance)
+            self.assertEqual(calls.count("list_sizes"), 2)
+
+            cb_iaas.g_libcloud_catalog_ttl = 0.0
+            svc._deps["allocation"] = "2"
+            time.sleep(0.01)
+            cons[1].run_instance()
+            self.assertEqual(calls.count("list_sizes"), 3)
+        finally:
+            cb_iaas.g_libcloud_catalog_ttl = ttl
+            del cb_iaas.g_libcloud_drivers[provider]
+
+    def test_libcloud_node_list(self):
+        import cloudinitd.cb_iaas as cb_iaas
+
+        calls = []
+        cb_iaas._import_libcloud()
+        provider = cb_iaas.g_libcloud_providers["dummy"]
+        cb_iaas.g_libcloud_drivers[provider] = make_counting_driver(calls)
+        period = cb_iaas.g_libcloud_node_list_period
+        try:
+            cb_iaas.g_libcloud_node_list_period = 60.0
+            svc = FakeSvc("libcloudsvc", {"image": "1", "allocation": "2"})
+            secret = str(uuid.uuid4())
+            instances = []
+            for i in range(5):
+                con = cb_iaas.IaaSLibCloudConn(svc, "0", secret, None, "libcloud-dummy")
+                instances.append(con.run_instance())
+
+            # one list serves every instance of the provider
+            for i in range(3):
+                for inst in instances:
+                    inst.update()
+            self.assertEqual(calls.count("list_nodes"), 1)
+
+            cb_iaas.g_libcloud_node_list_period = 0.0
+            time.sleep(0.01)
+            instances[0].update()
+            self.assertEqual(calls.count("list_nodes"), 2)
+        finally:
+            cb_iaas.g_libcloud_node_list_period = period
+            del cb_iaas.g_libcloud_drivers[provider]
 
 if __name__ == '__main__':
     unittest.main()
@@ -223,6 +223,64 @@ class CloudInitDTests(unittest.TestCase):
         line = self._find_str(outfile, runname)
         self.assertEqual(line, None)
 
+    def test_serve(self):
+        import signal
+        import subprocess
+        import sys
+        import cloudinitd.cli.daemon
+
+        dbdir = tempfile.mkdtemp()
+        sockpath = os.path.join(dbdir, "test.sock")
+        env = dict(os.environ)
+        env[cloudinitd.cli.daemon.SOCKET_ENV_STR] = sockpath
+        pkgdir = os.path.dirname(os.path.dirname(os.path.abspath(cloudinitd.__file__)))
+        env['PYTHONPATH'] = pkgdir + os.pathsep + env.get('PYTHONPATH', "")
+        cmd = [sys.executable, "-c", "import sys, cloudinitd.cli.daemon; sys.exit(cloudinitd.cli.daemon.main(sys.argv[1:]))", "-d", dbdir, "serve"]
+        p = subprocess.Popen(cmd, env=env)
+        try:
+            for i in range(300):
+                if os.path.exists(sockpath):
+                    break
+                time.sleep(0.1)
+
+            (osf, outfile) = tempfile.mkstemp()
+            os.close(osf)
+            rc = cloudinitd.cli.daemon.forward(["-O", outfile, "-d", dbdir, "boot",  "%s/terminate/top.conf" % (self.plan_basedir)], path=sockpath)
+            self.assertEqual(rc, 0)
+            runname = self._get_runname(outfile)
+
+            # the second status is answered from the run the server already has loaded
+            for i in range(2):
+                rc = cloudinitd.cli.daemon.forward(["-O", outfile, "-d", dbdir, "status", runname], path=sockpath)
+                self.assertEqual(rc, 0)
+            rc = cloudinitd.cli.daemon.forward(["-O", outfile, "-d", dbdir, "list"], path=sockpath)
+            self.assertEqual(rc, 0)
+            self.assertNotEqual(self._find_str(outfile, runname), None)
+            # a second server is refused by the one already running
+            rc = cloudinitd.cli.daemon.forward(["-O", outfile, "-d", dbdir, "serve"], path=sockpath)
+            self.assertEqual(rc, 1)
+            rc = cloudinitd.cli.daemon.forward(["-O", outfile, "-d", dbdir, "terminate", runname], path=sockpath)
+            self.assertEqual(rc, 0)
+            self.assertFalse(os.path.exists(os.path.join(dbdir, "cloudinitd-%s.db" % (runname))))
+        finally:
+            os.kill(p.pid, signal.SIGTERM)
+            p.wait()
+        self.assertFalse(os.path.exists(sockpath))
+        self.assertEqual(cloudinitd.cli.daemon.forward(["list"], path=sockpath), None)
+
+    def test_serve_run_locks(self):
+        import cloudinitd.cli.daemon
+
+        # ~ in the db dir is the home of the client, not of the server
+        req = {"argv": ["-d", "~/runs", "terminate", "r2", "r1"], "cwd": "/tmp", "env": {"HOME": "/home/client"}}
+        (read_only, keys) = cloudinitd.cli.daemon._classify_request(req)
+        self.assertFalse(read_only)
+        self.assertEqual(keys, [("/home/client/runs", "r1"), ("/home/client/runs", "r2")])
+
+        # and a relative one is the same dir however it is spelled
+        req = {"argv": ["-d", "./runs/", "terminate", "r1"], "cwd": "/tmp", "env": {"HOME": "/home/client"}}
+        self.assertEqual(cloudinitd.cli.daemon._classify_request(req), (False, [("/tmp/runs", "r1")]))
+
     def test_reboot_simple(self):
         (osf, outfile) = tempfile.mkstemp()
         os.close(osf)
@@ -313,6 +371,29 @@ class CloudInitDTests(unittest.TestCase):
         rc = cloudinitd.cli.boot.main(["-O", outfile, "terminate",  "%s" % (runname)])
         self.assertEqual(rc, 0)
 
+    def iceage_kill_test(self):
+        (osf, outfile) = tempfile.mkstemp()
+        os.close(osf)
+        rc = cloudinitd.cli.boot.main(["-O", outfile, "boot",  "%s/terminate/top.conf" % (self.plan_basedir)])
+        self._dump_output(outfile)
+        self.assertEqual(rc, 0)
+        runname = self._get_runname(outfile)
+
+        rc = cloudinitd.cli.boot.main(["-O", outfile, "--kill", "history", runname])
+        self._dump_output(outfile)
+        self.assertEqual(rc, 0)
+
+        if 'CLOUDINITD_TESTENV' in os.environ:
+            dbdir = os.path.expanduser("~/.cloudinitd")
+            cb = CloudInitD(dbdir, db_name=runname, terminate=False, boot=False, ready=True)
+            ha = cb.get_iaas_history()
+            self.assertTrue(len(ha) > 0)
+            for h in ha:
+                self.assertNotEqual(h.get_state(), "running")
+
+        rc = cloudinitd.cli.boot.main(["-O", outfile, "terminate",  "%s" % (runname)])
+        self.assertEqual(rc, 0)
+
 
     def check_terminate_output_test(self):
         (osf, outfile) = tempfile.mkstemp()
@@ -446,6 +527,64 @@ class CloudInitDTests(unittest.TestCase):
         rc = cloudinitd.cli.boot.main(["terminate",  "%s" % (runname)])
         self.assertEqual(rc, 0)
 
+    def test_repair_subtree(self):
+        (osf, outfile) = tempfile.mkstemp()
+        os.close(osf)
+        dir = os.path.expanduser("~/.cloudinitd/")
+        conf_file = self.plan_basedir + "/multileveldeps/top.conf"
+        cb = CloudInitD(dir, conf_file, terminate=False, boot=True, ready=True)
+        cb.start()
+        cb.block_until_complete(poll_period=0.1)
+        runname = cb.run_name
+
+        self.assertEqual(cb.get_dependent_services(["l2service"]), ["l2service"])
+        self.assertEqual(cb.get_dependent_services(["onelvl1"]), ["onelvl1", "l2service", "One_l3", "Two_l3"])
+
+        # take down a single service behind cloudinitd's back
+        cb = CloudInitD(dir, db_name=runname, terminate=True, boot=False, ready=False, services=["l2service"])
+        cb.shutdown()
+        cb.block_until_complete(poll_period=0.1)
+
+        rc = cloudinitd.cli.boot.main(["-O", outfile, "repair", runname])
+        self._dump_output(outfile)
+        self.assertEqual(rc, 0)
+        line = self._find_str(outfile, "Repairing")
+        self.assertNotEqual(line, None)
+        self.assertEqual(line.strip(), "Repairing l2service")
+
+        rc = cloudinitd.cli.boot.main(["-O", outfile, "status", runname])
+        self.assertEqual(rc, 0)
+        rc = cloudinitd.cli.boot.main(["terminate", runname])
+        self.assertEqual(rc, 0)
+
+    def test_repair_keeps_consumer_vms(self):
+        (osf, outfile) = tempfile.mkstemp()
+        os.close(osf)
+        dir = os.path.expanduser("~/.cloudinitd/")
+        conf_file = self.plan_basedir + "/multileveldeps/top.conf"
+        cb = CloudInitD(dir, conf_file, terminate=False, boot=True, ready=True)
+        cb.start()
+        cb.block_until_complete(poll_period=0.1)
+        runname = cb.run_name
+        names = ["onelvl1", "l2service", "One_l3", "Two_l3"]
+        ids = dict([(n, cb.get_service(n).get_attr_from_bag("instance_id")) for n in names])
+
+        cb = CloudInitD(dir, db_name=runname, terminate=True, boot=False, ready=False, services=["onelvl1"])
+        cb.shutdown()
+        cb.block_until_complete(poll_period=0.1)
+
+        rc = cloudinitd.cli.boot.main(["-O", outfile, "repair", runname])
+        self._dump_output(outfile)
+        self.assertEqual(rc, 0)
+
+        # the failed service has a new VM, the services using it were booted again on the VMs they had
+        cb = CloudInitD(dir, db_name=runname, terminate=False, boot=False, ready=False)
+        self.assertNotEqual(cb.get_service("onelvl1").get_attr_from_bag("instance_id"), ids["onelvl1"])
+        for n in names[1:]:
+            self.assertEqual(cb.get_service(n).get_attr_from_bag("instance_id"), ids[n])
+        rc = cloudinitd.cli.boot.main(["terminate", runname])
+        self.assertEqual(rc, 0)
+
     def test_multiterminate(self):
         (osf, outfile) = tempfile.mkstemp()
         os.close(osf)
@@ -468,8 +607,46 @@ class CloudInitDTests(unittest.TestCase):
         runname2 = line[len(n):].strip()
 
         print "run name is %s and %s" % (runname1, runname2)
+        rc = cloudinitd.cli.boot.main(["-O", outfile, "-m", "1", "-a", "3600", "status",  runname1, runname2])
+        self.assertEqual(rc, 0)
         rc = cloudinitd.cli.boot.main(["-O", outfile, "terminate",  runname1, runname2])
         self.assertEqual(rc, 0)
+        for runname in [runname1, runname2]:
+            self.assertFalse(os.path.exists("%s/cloudinitd-%s.db" % (os.path.expanduser("~/.cloudinitd"), runname)))
+
+    def test_shared_store(self):
+        dbdir = tempfile.mkdtemp()
+        dburl = "sqlite:///%s/runs.db" % (dbdir)
+        runnames = []
+        for i in range(2):
+            (osf, outfile) = tempfile.mkstemp()
+            os.close(osf)
+            rc = cloudinitd.cli.boot.main(["-O", outfile, "-d", dbdir, "-u", dburl, "boot",  "%s/oneservice/top.conf" % (self.plan_basedir)])
+            self._dump_output(outfile)
+            self.assertEqual(rc, 0)
+            runnames.append(self._get_runname(outfile))
+        # the runs are kept in the shared store, not a file each
+        self.assertEqual(os.listdir(dbdir).count("cloudinitd-%s.db" % (runnames[0])), 0)
+
+        (osf, outfile) = tempfile.mkstemp()
+        os.close(osf)
+        rc = cloudinitd.cli.boot.main(["-O", outfile, "-d", dbdir, "-u", dburl, "list"])
+        self.assertEqual(rc, 0)
+        for runname in runnames:
+            self.assertNotEqual(self._find_str(outfile, runname), None)
+        rc = cloudinitd.cli.boot.main(["-O", outfile, "-d", dbdir, "-u", dburl, "history"])
+        self.assertEqual(rc, 0)
+        for runname in runnames:
+            self.assertNotEqual(self._find_str(outfile, "%s/sampleservice" % (runname)), None)
+
+        rc = cloudinitd.cli.boot.main(["-O", outfile, "-d", dbdir, "-u", dburl, "terminate"] + runnames)
+        self.assertEqual(rc, 0)
+        (osf, outfile) = tempfile.mkstemp()
+        os.close(osf)
+        rc = cloudinitd.cli.boot.main(["-O", outfile, "-d", dbdir, "-u", dburl, "list"])
+        self.assertEqual(rc, 0)
+        for runname in runnames:
+            self.assertEqual(self._find_str(outfile, runname), None)
 
     def check_service_log_test(self):
 
@@ -1,3 +1,4 @@
+import gc
 import unittest
 import uuid
 import cloudinitd
@@ -145,3 +146,171 @@ class PollableTests(unittest.TestCase):
             self.fail("Should have raised an exception")
         except ProcessException, pex:
             pass
+
+    def test_popen_max_processes(self):
+        # without a limit no slot is taken
+        pexe0 = PopenExecutablePollable(cloudinitd.find_true(), allowed_errors=0)
+        pexe0.start()
+        self.assertEqual(pexe0._slot, None)
+        pexe0._p.wait()
+
+        set_max_processes(1)
+        try:
+            # a pollable dropped before it is polled to the end does not keep its slot
+            pexe0 = PopenExecutablePollable("/bin/sleep 100000", allowed_errors=0)
+            pexe0.start()
+            self.assertEqual(len(cloudinitd.pollables.g_slot_holders), 1)
+            p = pexe0._p
+            del pexe0
+            gc.collect()
+            p.kill()
+            p.wait()
+            self.assertEqual(len(cloudinitd.pollables.g_slot_holders), 0)
+
+            pexe1 = PopenExecutablePollable("/bin/sleep 1", allowed_errors=0)
+            pexe2 = PopenExecutablePollable("/bin/sleep 1", allowed_errors=0)
+            pexe3 = PopenExecutablePollable("/bin/sleep 100000", allowed_errors=0)
+            pexe1.start()
+            pexe2.start()
+            pexe3.start()
+            self.assertNotEqual(pexe1._p, None)
+            self.assertEqual(pexe2._p, None)
+            self.assertEqual(pexe3._p, None)
+
+            # a pollable canceled while waiting for its turn never runs
+            pexe3.cancel()
+            self.assertRaises(ProcessException, pexe3.poll)
+
+            rc = pexe1.poll()
+            while not rc:
+                self.assertEqual(pexe2.poll(), False)
+                rc = pexe1.poll()
+            rc = pexe2.poll()
+            self.assertNotEqual(pexe2._p, None)
+            while not rc:
+                rc = pexe2.poll()
+            self.assertEqual(pexe3._p, None)
+        finally:
+            set_max_processes(0)
+
+    def test_fallback(self):
+        cmd = cloudinitd.find_true()
+        made = []
+        def factory():
+            p = PopenExecutablePollable(cmd, allowed_errors=0)
+            made.append(p)
+            return p
+
+        fp = FallbackPollable(PopenExecutablePollable(cmd, allowed_errors=0), factory)
+        fp.start()
+        rc = fp.poll()
+        while not rc:
+            rc = fp.poll()
+        self.assertFalse(fp.used_fallback())
+        self.assertEqual(len(made), 0)
+
+        fp = FallbackPollable(PopenExecutablePollable("NotACommand", allowed_errors=0), factory)
+        fp.start()
+        rc = fp.poll()
+        while not rc:
+            rc = fp.poll()
+        self.assertTrue(fp.used_fallback())
+        self.assertEqual(len(made), 1)
+
+    def test_parallel_levels(self):
+        cmd = "/bin/sleep 2"
+        done = []
+        def level_cb(mp, action, lvl):
+            if action == cloudinitd.callback_action_complete:
+                done.append(lvl)
+
+        mp = ParallelLevelPollable(callback=level_cb)
+        for i in range(0, 4):
+            mp.add_level([PopenExecutablePollable(cmd, allowed_errors=0)])
+        start = time.time()
+        mp.start()
+        rc = False
+        while not rc:
+            rc = mp.poll()
+            time.sleep(0.1)
+        self.assertTrue(time.time() - start < 6)
+        self.assertEqual(done, [1, 2, 3, 4])
+
+    def test_parallel_levels_error(self):
+        cmd = cloudinitd.find_true()
+        mp = ParallelLevelPollable(continue_on_error=True, max_parallel=1)
+        mp.add_level([PopenExecutablePollable(cmd, allowed_errors=0)])
+        mp.add_level([PopenExecutablePollable("NotACommand", allowed_errors=0)])
+        mp.add_level([PopenExecutablePollable(cmd, allowed_errors=0)])
+        mp.start()
+        rc = False
+        while not rc:
+            rc = mp.poll()
+        self.assertTrue(isinstance(mp.last_exception, MultilevelException))
+
+        mp = ParallelLevelPollable()
+        mp.add_level([PopenExecutablePollable("NotACommand", allowed_errors=0)])
+        mp.add_level([PopenExecutablePollable(cmd, allowed_errors=0)])
+        mp.start()
+        try:
+            rc = False
+            while not rc:
+                rc = mp.poll()
+            self.fail("Should have raised an exception")
+        except MultilevelException, ex:
+            pass
+
+    def test_artifact_fanout(self):
+        dist = ArtifactDistributor(fanout=2)
+        sources = {}
+        def factory(host):
+            def make_cmd(source):
+                sources[host] = source
+                return "/bin/true"
+            return make_cmd
+
+        hosts = ["host%d" % (i) for i in range(7)]
+        pollers = [ArtifactStagePollable(dist, "digest", h, factory(h)) for h in hosts]
+        mcp = MultiLevelPollable()
+        mcp.add_level(pollers)
+        mcp.start()
+        rc = False
+        while not rc:
+            rc = mcp.poll()
+
+        # only the first copy came from the launch host
+        from_here = [h for h in hosts if sources[h] is None]
+        self.assertEqual(len(from_here), 1)
+        self.assertEqual(sorted(dist.get_holders("digest")), sorted(hosts))
+
+    def test_artifact_peer_fallback(self):
+        dist = ArtifactDistributor(fanout=1)
+        dist.acquire("digest", "host0")
+        dist.release("digest", "host0", None, True)
+
+        def make_cmd(source):
+            if source:
+                return "/bin/false"
+            return "/bin/true"
+        p = ArtifactStagePollable(dist, "digest", "host1", make_cmd)
+        p.start()
+        self.assertEqual(p.get_source(), "host0")
+        rc = False
+        while not rc:
+            rc = p.poll()
+        self.assertEqual(p.get_source(), None)
+        self.assertTrue("host1" in dist.get_holders("digest"))
+
+    def test_artifact_cancel(self):
+        dist = ArtifactDistributor(fanout=1)
+        dist.acquire("digest", "host0")
+        dist.release("digest", "host0", None, True)
+
+        p = ArtifactStagePollable(dist, "digest", "host1", lambda source: "/bin/sleep 100000")
+        p.start()
+        self.assertEqual(p.get_source(), "host0")
+        p.cancel()
+        self.assertRaises(ProcessException, p.poll)
+
+        # the slot of the canceled copy is free for the next host
+        self.assertEqual(dist.acquire("digest", "host2"), (True, "host0"))
@@ -1,7 +1,9 @@
 import cloudinitd
-from cloudinitd.exceptions import ServiceException, APIUsageException
+from cloudinitd.exceptions import ServiceException, APIUsageException, IaaSException
 import cloudinitd.nosetests
 from cloudinitd.user_api import CloudInitD
+from cloudinitd.pool import WarmPool
+from cloudinitd import cb_iaas
 import tempfile
 import logging
 
@@ -9,6 +11,7 @@ import logging
 
 import unittest
 import os
+import stat
 
 class ServiceTests(unittest.TestCase):
 
@@ -100,6 +103,211 @@ class ServiceTests(unittest.TestCase):
         fname = cb.get_db_file()
         os.remove(fname)
 
+    def fast_status_test(self):
+        self.plan_basedir = cloudinitd.nosetests.g_plans_dir
+        dir = tempfile.mkdtemp()
+        conf_file = self.plan_basedir + "/oneservice/top.conf"
+        cb = CloudInitD(dir, conf_file, terminate=False, boot=True, ready=True)
+        cb.start()
+        cb.block_until_complete(poll_period=1.0)
+        run_name = cb.run_name
+
+        msgs = []
+        def svc_cb(cb, cloudservice, action, msg):
+            msgs.append(msg)
+            return cloudinitd.callback_return_default
+
+        # the boot ran the full ready check so the port probe is enough
+        cb = CloudInitD(dir, db_name=run_name, terminate=False, boot=False, ready=True, ready_max_age=3600, service_callback=svc_cb)
+        cb.start()
+        cb.block_until_complete(poll_period=0.1)
+        probed = [m for m in msgs if m.find("answered the port probe") >= 0]
+        self.assertEqual(len(probed), 1, str(msgs))
+
+        del msgs[:]
+        cb = CloudInitD(dir, db_name=run_name, terminate=False, boot=False, ready=True, service_callback=svc_cb)
+        cb.start()
+        cb.block_until_complete(poll_period=0.1)
+        probed = [m for m in msgs if m.find("answered the port probe") >= 0]
+        self.assertEqual(len(probed), 0, str(msgs))
+
+        cb = CloudInitD(dir, db_name=run_name, terminate=True, boot=False, ready=False)
+        cb.shutdown()
+        cb.block_until_complete(poll_period=1.0)
+        fname = cb.get_db_file()
+        os.remove(fname)
+
+    def warm_pool_test(self):
+        self.plan_basedir = cloudinitd.nosetests.g_plans_dir
+        dir = tempfile.mkdtemp()
+        conf_file = self.plan_basedir + "/oneservice/top.conf"
+        cb = CloudInitD(dir, conf_file, terminate=False, boot=True, ready=True, pool_size=1)
+        cb.start()
+        cb.block_until_complete(poll_period=1.0)
+        run_name1 = cb.run_name
+        cb._pool.wait()
+        pool = WarmPool(dir, 0)
+        pooled = pool.get_instances()
+        self.assertEqual(len(pooled), 1)
+        # the pool keeps IaaS secrets
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(dir, "cloudinitd-pool.db")).st_mode), 0600)
+
+        msgs = []
+        def svc_cb(cb, cloudservice, action, msg):
+            msgs.append(msg)
+            return cloudinitd.callback_return_default
+
+        cb = CloudInitD(dir, conf_file, terminate=False, boot=True, ready=True, pool_size=1, service_callback=svc_cb)
+        cb.start()
+        cb.block_until_complete(poll_period=1.0)
+        run_name2 = cb.run_name
+        claimed = [m for m in msgs if m.find("Claimed the pooled VM %s" % (pooled[0].instance_id)) >= 0]
+        self.assertEqual(len(claimed), 1, str(msgs))
+        svc = cb.get_service("sampleservice")
+        self.assertEqual(svc.get_attr_from_bag("instance_id"), pooled[0].instance_id)
+
+        # the claimed VM was replaced
+        cb._pool.wait()
+        self.assertEqual(len(pool.get_instances()), 1)
+        pool.drain()
+        self.assertEqual(len(pool.get_instances()), 0)
+
+        for run_name in [run_name1, run_name2]:
+            cb = CloudInitD(dir, db_name=run_name, terminate=True, boot=False, ready=False)
+            cb.shutdown()
+            cb.block_until_complete(poll_period=1.0)
+            fname = cb.get_db_file()
+            os.remove(fname)
+
+    def replica_attr_layer_test(self):
+        self.plan_basedir = cloudinitd.nosetests.g_plans_dir
+        dir = tempfile.mkdtemp()
+        conf_file = self.plan_basedir + "/replica_deps/top.conf"
+        cb = CloudInitD(dir, conf_file, terminate=False, boot=True, ready=True)
+        cb.start()
+        cb.block_until_complete(poll_period=1.0)
+
+        # the deps file is stored once for all of the replicas
+        layer_rows = cb._db._engine.execute("select count(*) from attrbag where layer_id is not null").scalar()
+        self.assertEqual(layer_rows, 2)
+        records = cb._records[0]
+        self.assertEqual(len(records), 4)
+        for r in records[1:]:
+            self.assertTrue(r.layer is records[0].layer)
+
+        ids = []
+        for r in records:
+            svc = cb.get_service(r.name)
+            self.assertEqual(svc.get_attr_from_bag("webmessage"), "hello world, love Mr. Cloud Boot")
+            instance_id = svc.get_attr_from_bag("instance_id")
+            self.assertEqual(svc.get_attr_from_bag("myid"), instance_id)
+            ids.append(instance_id)
+        self.assertEqual(len(set(ids)), 4)
+
+        cb = CloudInitD(dir, db_name=cb.run_name, terminate=True, boot=False, ready=False)
+        cb.shutdown()
+        cb.block_until_complete(poll_period=1.0)
+        fname = cb.get_db_file()
+        os.remove(fname)
+
+    def event_journal_test(self):
+        self.plan_basedir = cloudinitd.nosetests.g_plans_dir
+        dir = tempfile.mkdtemp()
+        conf_file = self.plan_basedir + "/oneservice/top.conf"
+        cb = CloudInitD(dir, conf_file, terminate=False, boot=True, ready=True)
+        cb.start()
+        cb.block_until_complete(poll_period=1.0)
+
+        events = cb._db.get_events(service_name="sampleservice")
+        names = [e.event for e in events]
+        self.assertTrue(cloudinitd.callback_action_started in names, str(names))
+        self.assertEqual(names[-1], cloudinitd.callback_action_complete)
+        states = [int(e.detail) for e in events if e.event == "state"]
+        self.assertEqual(states, [cloudinitd.service_state_launched, cloudinitd.service_state_contextualized])
+        for i in range(1, len(events)):
+            self.assertTrue(events[i].timestamp >= events[i-1].timestamp)
+
+        # the journal alone gives the state that is in the service table
+        (state, last_error, ts) = cb._db.replay_events()["sampleservice"]
+        self.assertEqual(state, cloudinitd.service_state_contextualized)
+        svc = cb.get_service("sampleservice")
+        self.assertEqual(svc._svc._s.state, state)
+
+        cb = CloudInitD(dir, db_name=cb.run_name, terminate=True, boot=False, ready=False)
+        cb.shutdown()
+        cb.block_until_complete(poll_period=1.0)
+        (state, last_error, ts) = cb._db.replay_events()["sampleservice"]
+        self.assertEqual(state, cloudinitd.service_state_terminated)
+        fname = cb.get_db_file()
+        os.remove(fname)
+
+    def resume_test(self):
+        self.plan_basedir = cloudinitd.nosetests.g_plans_dir
+        dir = tempfile.mkdtemp()
+        conf_file = self.plan_basedir + "/oneservice/top.conf"
+        cb = CloudInitD(dir, conf_file, terminate=False, boot=True, ready=True)
+        # the boot dies right after launching the VM
+        cb.pre_start_iaas()
+        run_name = cb.run_name
+        instance_id = cb.get_service("sampleservice").get_attr_from_bag("instance_id")
+
+        msgs = []
+        def svc_cb(cb, cloudservice, action, msg):
+            msgs.append(msg)
+            return cloudinitd.callback_return_default
+
+        for i in range(2):
+            del msgs[:]
+            cb = CloudInitD(dir, db_name=run_name, terminate=False, boot=True, ready=True, resume=True, service_callback=svc_cb)
+            cb.start()
+            cb.block_until_complete(poll_period=0.1)
+            self.assertEqual(len([m for m in msgs if m.find("Reattached sampleservice to the VM %s" % (instance_id)) >= 0]), 1, str(msgs))
+            svc = cb.get_service("sampleservice")
+            self.assertEqual(svc.get_attr_from_bag("instance_id"), instance_id)
+            self.assertEqual(len(cb.get_iaas_history()), 1)
+            # the boot program runs once, the second resume only checks the service
+            states = [e.detail for e in cb._db.get_events(service_name="sampleservice") if e.event == "state"]
+            self.assertEqual(states.count(str(cloudinitd.service_state_contextualized)), 1)
+
+        cb = CloudInitD(dir, db_name=run_name, terminate=True, boot=False, ready=False)
+        cb.shutdown()
+        cb.block_until_complete(poll_period=1.0)
+        fname = cb.get_db_file()
+        os.remove(fname)
+
+    def resume_lookup_fails_test(self):
+        self.plan_basedir = cloudinitd.nosetests.g_plans_dir
+        dir = tempfile.mkdtemp()
+        conf_file = self.plan_basedir + "/oneservice/top.conf"
+        cb = CloudInitD(dir, conf_file, terminate=False, boot=True, ready=True)
+        cb.pre_start_iaas()
+        run_name = cb.run_name
+        instance_id = cb.get_service("sampleservice").get_attr_from_bag("instance_id")
+
+        def find_instances(con, instance_ids):
+            raise Exception("describe timed out")
+        real_find_instances = cb_iaas.IaaSTestCon.find_instances
+        cb_iaas.IaaSTestCon.find_instances = find_instances
+        try:
+            cb = CloudInitD(dir, db_name=run_name, terminate=False, boot=True, ready=True, resume=True)
+            self.assertRaises(IaaSException, cb.start)
+        finally:
+            cb_iaas.IaaSTestCon.find_instances = real_find_instances
+        # nothing was reset or launched, the next resume still finds the VM
+        self.assertEqual(len(cb.get_iaas_history()), 1)
+
+        cb = CloudInitD(dir, db_name=run_name, terminate=False, boot=True, ready=True, resume=True)
+        cb.start()
+        cb.block_until_complete(poll_period=0.1)
+        self.assertEqual(cb.get_service("sampleservice").get_attr_from_bag("instance_id"), instance_id)
+        self.assertEqual(len(cb.get_iaas_history()), 1)
+
+        cb = CloudInitD(dir, db_name=run_name, terminate=True, boot=False, ready=False)
+        cb.shutdown()
+        cb.block_until_complete(poll_period=1.0)
+        fname = cb.get_db_file()
+        os.remove(fname)
+
 
 if __name__ == '__main__':
     unittest.main()
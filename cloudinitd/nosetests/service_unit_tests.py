@@ -1,8 +1,19 @@
+import hashlib
 import os
+import tarfile
+import tempfile
+import threading
+import time
 import uuid
-from cloudinitd.cb_iaas import IaaSTestInstance
+import cloudinitd
+import cloudinitd.nosetests
+from cloudinitd.cb_iaas import IaaSTestInstance, IaaSBotoInstance, InstanceEventQueue, set_instance_event_source
 from cloudinitd.exceptions import APIUsageException
+from cloudinitd.persistence import CloudInitDDB
+from sqlalchemy.engine.reflection import Inspector
+import cloudinitd.pollables
 from cloudinitd.pollables import InstanceHostnamePollable
+from cloudinitd.services import get_file_digest, bundle_files
 from cloudinitd.user_api import CloudInitD
 import unittest
 
@@ -46,6 +57,310 @@ class ServiceUnitTests(unittest.TestCase):
         else:
             del(os.environ['CLOUDINITD_TESTENV'])
 
+    def test_service_events(self):
+        source = InstanceEventQueue()
+        set_instance_event_source(source)
+        period = cloudinitd.pollables.g_event_fallback_poll_period
+        cloudinitd.pollables.g_event_fallback_poll_period = 60.0
+        try:
+            h1 = str(uuid.uuid1())
+            instance = IaaSTestInstance(h1, time_to_hostname=0.5)
+            updates = []
+            def counting_update(real=instance.update):
+                updates.append(1)
+                return real()
+            instance.update = counting_update
+
+            # a stand in for the cloud telling us the VM is up
+            feed = threading.Timer(1.0, source.put, [instance.get_id(), "running"])
+            feed.start()
+            start = time.time()
+            p = InstanceHostnamePollable(instance=instance)
+            p.start()
+            rc = False
+            while not rc:
+                rc = p.poll()
+                time.sleep(0.05)
+            self.assertTrue(time.time() - start < 10.0)
+            self.assertEquals(h1, p.get_hostname())
+            self.assertEqual(len(updates), 2)
+            self.assertEqual(source._subscribers, {})
+        finally:
+            cloudinitd.pollables.g_event_fallback_poll_period = period
+            set_instance_event_source(None)
+            source.close()
+
+    def test_hostname_watchers(self):
+        before = threading.active_count()
+        pollers = []
+        for i in range(300):
+            p = InstanceHostnamePollable(instance=IaaSTestInstance("host%d" % (i), time_to_hostname=1.0))
+            p.start()
+            pollers.append(p)
+        # the VMs are watched by a few shared threads, not one thread each
+        self.assertTrue(threading.active_count() <= before + cloudinitd.pollables.g_hostname_watcher_count)
+
+        while pollers:
+            pollers = [p for p in pollers if not p.poll()]
+            time.sleep(0.1)
+        # and they end once there is nothing left to watch
+        time.sleep(0.5)
+        self.assertTrue(threading.active_count() <= before)
+
+        # a canceled VM is dropped by the watchers
+        p = InstanceHostnamePollable(instance=IaaSTestInstance("canceled", time_to_hostname=60.0))
+        p.start()
+        p.cancel()
+        self.assertTrue(p._watched.is_set())
+
+        # a watch that blows up leaves the VM to be polled, it does not hang the poll or kill the thread
+        def broken_unsubscribe():
+            raise Exception("unsubscribe failed")
+        p = InstanceHostnamePollable(instance=IaaSTestInstance("broken", time_to_hostname=0.5))
+        p._unsubscribe = broken_unsubscribe
+        p.start()
+        start = time.time()
+        rc = False
+        while not rc and time.time() - start < 10.0:
+            try:
+                rc = p.poll()
+            except Exception:
+                break
+            time.sleep(0.05)
+        self.assertTrue(p._watched.is_set())
+        self.assertEqual(cloudinitd.pollables.get_hostname_watchers()._busy, set())
+
+        # a running VM is not handed over until the watcher lets go of it, without blocking poll
+        p = InstanceHostnamePollable(instance=IaaSTestInstance("held", time_to_hostname=0.0))
+        p._instance.state = "running"
+        p.start()
+        p._watched.clear()
+        self.assertEqual(p.poll(), False)
+        p._watched.set()
+        self.assertEqual(p.poll(), True)
+
+    def test_hostname_watchers_batch(self):
+        class FakeBotoInstance(object):
+            def __init__(self, id):
+                self.id = id
+                self.state = "pending"
+                self.public_dns_name = None
+            def update(self):
+                updates.append(self.id)
+
+        class FakeReservation(object):
+            def __init__(self, instances):
+                self.instances = instances
+
+        class FakeBotoCon(object):
+            host = "ec2.example.com"
+            port = 443
+            path = "/"
+            aws_access_key_id = "key"
+            def get_all_instances(self, instance_ids):
+                describes.append(len(instance_ids))
+                instances = []
+                for id in instance_ids:
+                    i = FakeBotoInstance(id)
+                    i.state = "running"
+                    i.public_dns_name = "host-" + id
+                    instances.append(i)
+                return [FakeReservation(instances)]
+
+        updates = []
+        describes = []
+        count = cloudinitd.pollables.g_hostname_watcher_count
+        cloudinitd.pollables.set_hostname_watcher_count(1)
+        try:
+            con = FakeBotoCon()
+            pollers = []
+            for i in range(50):
+                p = InstanceHostnamePollable(instance=IaaSBotoInstance(FakeBotoInstance("i-%d" % (i)), con))
+                p.start()
+                pollers.append(p)
+            start = time.time()
+            while pollers and time.time() - start < 10.0:
+                pollers = [p for p in pollers if not p.poll()]
+                time.sleep(0.1)
+            self.assertEqual(pollers, [])
+            # only the first update of each VM is its own, after that they are described together
+            self.assertEqual(len(updates), 50)
+            self.assertTrue(len(describes) < 5, str(describes))
+            self.assertEqual(sum(describes), 50)
+        finally:
+            cloudinitd.pollables.set_hostname_watcher_count(count)
+
+    def test_file_digest(self):
+        (osf, fname) = tempfile.mkstemp()
+        os.write(osf, "some boot program")
+        os.close(osf)
+        d1 = get_file_digest(fname)
+        self.assertEqual(d1, hashlib.sha1("some boot program").hexdigest())
+        self.assertEqual(d1, get_file_digest(fname))
+
+        time.sleep(1.1)
+        f = open(fname, "w")
+        f.write("a new boot program")
+        f.close()
+        d2 = get_file_digest(fname)
+        self.assertNotEqual(d1, d2)
+        os.remove(fname)
+        self.assertEqual(get_file_digest(fname), None)
+
+    def test_bundle_files(self):
+        paths = []
+        for content in ["{\"a\": 1}", "export a=\"1\""]:
+            (osf, fname) = tempfile.mkstemp()
+            os.write(osf, content)
+            os.close(osf)
+            paths.append(fname)
+        members = [("bootconf.json", paths[0]), ("bootenv.sh", paths[1])]
+        (b1, d1) = bundle_files(members)
+        time.sleep(1.1)
+        (b2, d2) = bundle_files(members)
+        self.assertEqual(d1, d2)
+        tar = tarfile.open(b1, "r:gz")
+        self.assertEqual(sorted(tar.getnames()), ["bootconf.json", "bootenv.sh"])
+        tar.close()
+
+        (b3, d3) = bundle_files(members[:1])
+        self.assertNotEqual(d1, d3)
+        for p in paths + [b1, b2, b3]:
+            os.remove(p)
+
+    def test_service_records(self):
+        (osf, fname) = tempfile.mkstemp()
+        os.close(osf)
+        dburl = "sqlite:///%s" % (fname)
+        db = CloudInitDDB(dburl)
+        bo = db.load_from_conf(cloudinitd.nosetests.g_plans_dir + "/multileveldeps/top.conf")
+        records = db.get_service_records(bo)
+        self.assertEqual(len(records), len(bo.levels))
+        for i in range(len(records)):
+            self.assertEqual([r.name for r in records[i]], [s.name for s in bo.levels[i].services])
+        rec = records[0][0]
+        self.assertFalse(hasattr(rec, "__dict__"))
+
+        rec.state = cloudinitd.service_state_contextualized
+        rec.hostname = "somehost"
+        rec.add_attr("key1", "value1")
+        db.save_record(rec)
+        db.add_iaas_history(rec, "i-1")
+        db.close()
+
+        db = CloudInitDDB(dburl)
+        bo = db.load_from_db()
+        rec2 = db.get_service_records(bo)[0][0]
+        self.assertEqual(rec2.id, rec.id)
+        self.assertEqual(rec2.state, cloudinitd.service_state_contextualized)
+        self.assertEqual(rec2.hostname, "somehost")
+        self.assertTrue(("key1", "value1") in rec2.attrs)
+        ha = db.get_iaas_history()
+        self.assertEqual([(h.instance_id, h.service.name) for h in ha], [("i-1", rec.name)])
+        db.close()
+        os.remove(fname)
+
+    def test_journal_replay(self):
+        (osf, fname) = tempfile.mkstemp()
+        os.close(osf)
+        dburl = "sqlite:///%s" % (fname)
+        db = CloudInitDDB(dburl)
+        bo = db.load_from_conf(cloudinitd.nosetests.g_plans_dir + "/oneservice/top.conf")
+        rec = db.get_service_records(bo)[0][0]
+
+        # state changes are only buffered in the journal
+        db.reset_query_count()
+        rec.state = cloudinitd.service_state_launched
+        rec.hostname = "somehost"
+        db.save_record(rec)
+        rec.state = cloudinitd.service_state_contextualized
+        db.save_record(rec)
+        self.assertEqual(db.get_query_count(), 0)
+
+        # once the journal is written the row is still behind it until a checkpoint
+        db.flush_events()
+        sel = "select state, hostname from service where id = %d" % (rec.id)
+        self.assertEqual(tuple(db._engine.execute(sel).fetchone()), (cloudinitd.service_state_initial, None))
+
+        # a process that died here is picked up from the journal
+        db2 = CloudInitDDB(dburl)
+        rec2 = db2.get_service_records(db2.load_from_db())[0][0]
+        self.assertEqual(rec2.state, cloudinitd.service_state_contextualized)
+        self.assertEqual(rec2.hostname, "somehost")
+        db2.close()
+        self.assertEqual(tuple(db._engine.execute(sel).fetchone()), (cloudinitd.service_state_contextualized, "somehost"))
+        db.close()
+        os.remove(fname)
+
+    def test_db_indexes(self):
+        (osf, fname) = tempfile.mkstemp()
+        os.close(osf)
+        dburl = "sqlite:///%s" % (fname)
+        db = CloudInitDDB(dburl)
+        # a db from before the indexes were added
+        db._engine.execute("DROP INDEX ix_service_name")
+        db.close()
+
+        db = CloudInitDDB(dburl)
+        names = [i['name'] for i in Inspector.from_engine(db._engine).get_indexes("service")]
+        self.assertTrue("ix_service_name" in names, str(names))
+        self.assertTrue("ix_service_level_id" in names, str(names))
+
+        conf_file = cloudinitd.nosetests.g_plans_dir + "/multileveldeps/top.conf"
+        bo = db.load_from_conf(conf_file)
+        names = [[r.name for r in l] for l in db.get_service_records(bo)]
+        # loading the plan again keeps the same service rows
+        ids = [r.id for l in db.get_service_records(bo) for r in l]
+        bo = db.load_from_conf(conf_file)
+        self.assertEqual([[r.name for r in l] for l in db.get_service_records(bo)], names)
+        self.assertEqual([r.id for l in db.get_service_records(bo) for r in l], ids)
+        db.close()
+        os.remove(fname)
+
+    def test_reload_layers(self):
+        (osf, fname) = tempfile.mkstemp()
+        os.close(osf)
+        db = CloudInitDDB("sqlite:///%s" % (fname))
+        conf_file = cloudinitd.nosetests.g_plans_dir + "/replica_deps/top.conf"
+        for i in range(3):
+            bo = db.load_from_conf(conf_file)
+        # the layers of the earlier loads are gone, along with their attrs
+        self.assertEqual(db._engine.execute("select name from attrlayer").fetchall(), [("deps.conf",)])
+        self.assertEqual(db._engine.execute("select count(*) from attrbag where layer_id is not null").scalar(), 2)
+        for rec in db.get_service_records(bo)[0]:
+            self.assertEqual(rec.layer["webmessage"], "hello world, love Mr. Cloud Boot")
+        db.close()
+        os.remove(fname)
+
+    def test_load_query_count(self):
+        counts = []
+        for plan in ["oneservice", "multileveldeps", "tenlevels"]:
+            (osf, fname) = tempfile.mkstemp()
+            os.close(osf)
+            dburl = "sqlite:///%s" % (fname)
+            db = CloudInitDDB(dburl)
+            bo = db.load_from_conf(cloudinitd.nosetests.g_plans_dir + "/%s/top.conf" % (plan))
+            for l in db.get_service_records(bo):
+                for rec in l:
+                    db.add_iaas_history(rec, "i-%d" % (rec.id))
+            db.close()
+
+            db = CloudInitDDB(dburl)
+            db.reset_query_count()
+            bo = db.load_from_db()
+            records = db.get_service_records(bo)
+            for h in db.get_iaas_history():
+                h.service.attrs
+                h.service.layer
+            counts.append(db.get_query_count())
+            db.close()
+            os.remove(fname)
+        # the same few selects no matter how many levels and services there are.  a select for the layer attrs
+        # is only made when there are layers, the records and the history each replay the journal with one more
+        self.assertEqual(counts[0], counts[1])
+        self.assertTrue(counts[2] <= counts[0], str(counts))
+        self.assertTrue(counts[0] <= 9, str(counts))
+
 
 if __name__ == '__main__':
     unittest.main()
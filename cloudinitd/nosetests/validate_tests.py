@@ -48,5 +48,35 @@ class ValidateTests(unittest.TestCase):
         fname = cb.get_db_file()
         os.remove(fname)
 
+    def test_validate_reports_iaas_warnings(self):
+        dir = tempfile.mkdtemp()
+        conf_file = self.plan_basedir + "/iaastypevalidate/top.conf"
+        cb = CloudInitD(dir, conf_file, terminate=False, boot=True, ready=True)
+        # the nimbus security group note is a warning, the plan is still valid
+        warnings = []
+        self.assertEqual(cb.boot_validate(warnings=warnings), [])
+        self.assertEqual([svc.name for (svc, msg) in warnings], ["badsvc"])
+        self.assertTrue(warnings[0][1].find("2.7") >= 0, warnings[0][1])
+        os.remove(cb.get_db_file())
+
+    def test_validate_credentials(self):
+        dir = tempfile.mkdtemp()
+        conf_file = self.plan_basedir + "/oneservice/top.conf"
+        cb = CloudInitD(dir, conf_file, terminate=False, boot=True, ready=True)
+        self.assertEqual(cb.boot_validate(), [])
+        os.remove(cb.get_db_file())
+
+        # the test cloud turns away this secret
+        old_secret = os.environ['CLOUDINITD_IAAS_SECRET_KEY']
+        os.environ['CLOUDINITD_IAAS_SECRET_KEY'] = "fail"
+        try:
+            cb = CloudInitD(dir, conf_file, terminate=False, boot=True, ready=True)
+        finally:
+            os.environ['CLOUDINITD_IAAS_SECRET_KEY'] = old_secret
+        errors = cb.boot_validate()
+        self.assertEqual([svc.name for (svc, ex) in errors], ["sampleservice"])
+        os.remove(cb.get_db_file())
+
+
 if __name__ == '__main__':
     unittest.main()
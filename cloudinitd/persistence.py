@@ -1,25 +1,14 @@
-import sqlalchemy
-from sqlalchemy import ForeignKey
-from sqlalchemy.orm import relation
-from sqlalchemy.orm import mapper
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import Table
-from sqlalchemy import Integer
-from sqlalchemy import Boolean
-from sqlalchemy import String, MetaData, Sequence
-from sqlalchemy import Column
 import ConfigParser
-from sqlalchemy import types
 from datetime import datetime
 import os
+import threading
+import time
 
 import cloudinitd
 from cloudinitd.exceptions import APIUsageException
 from cloudinitd.global_deps import set_global_var, global_merge_down
 
 
-metadata = MetaData()
-
 
 def config_get_or_none_bool(parser, s, v, default=None):
     try:
@@ -44,66 +33,10 @@ def config_get_or_none(parser, s, v, default=None):
     except:
         return default
 
-boot_table = Table('boot', metadata,
-    Column('id', Integer, Sequence('event_id_seq'), primary_key=True),
-    Column('topconf', String(1024)),
-    Column('timestamp', types.TIMESTAMP(), default=datetime.now()),
-    Column('status', Integer),
-    )
-
-level_table = Table('level', metadata,
-    Column('id', Integer, Sequence('event_id_seq'), primary_key=True),
-    Column('order', Integer),
-    Column('conf_file', String(1024)),
-    Column('name', String(64)),
-    Column('boot_id', Integer, ForeignKey('boot.id'))
-    )
-
-service_table = Table('service', metadata,
-    Column('id', Integer, Sequence('event_id_seq'), primary_key=True),
-    Column('name', String(64)),
-    Column('level_id', Integer, ForeignKey('level.id')),
-    Column('image', String(32)),
-    Column('iaas', String(32)),
-    Column('allocation', String(64)),
-    Column('keyname', String(32)),
-    Column('localkey', String(1024)),
-    Column('username', String(32)),
-    Column('scp_username', String(32)),
-    Column('readypgm', String(1024)),
-    Column('readypgm_args', String(1024), default=""),
-    Column('hostname', String(64)),
-    Column('bootconf', String(1024)),
-    Column('bootpgm', String(1024)),
-    Column('bootpgm_args', String(1024), default=""),
-    Column('securitygroups', String(1024)),
-    Column('deps', String(1024)),
-    Column('instance_id', String(64)),
-    Column('iaas_url', String(64)),
-    Column('iaas_key', String(64)),
-    Column('iaas_secret', String(64)),
-    Column('state', Integer, default=0),
-    Column('last_error', sqlalchemy.types.Text()),
-    Column('terminatepgm', String(1024)),
-    Column('terminatepgm_args', String(1024), default=""),
-    Column('iaas_launch', Boolean),
-    Column('pgm_timeout', Integer, default=1200),
-    Column('local_exe', Boolean, default=False),
-    )
-
-attrbag_table = Table('attrbag', metadata,
-    Column('id', Integer, Sequence('extra_id_seq'), primary_key=True),
-    Column('key', String(50)),
-    Column('value', String(50)),
-    Column('service_id', Integer, ForeignKey('service.id'))
-    )
-
-iaas_history_table = Table('iaas_history', metadata,
-    Column('id', Integer, Sequence('event_id_seq'), primary_key=True),
-    Column('instance_id', String(64)),
-    Column('timestamp', types.TIMESTAMP(), default=datetime.now()),
-    Column('service_id', Integer, ForeignKey('service.id'))
-    )
+# journal events are written in batches of this size, or once the oldest of them is g_event_flush_period seconds
+# old, or with the next checkpoint
+g_event_batch_size = 64
+g_event_flush_period = 1.0
 
 
 
@@ -192,6 +125,10 @@ class ServiceObject(object):
         self.state = cloudinitd.service_state_initial
         self.securitygroups = None
         self.iaas_launch = None
+        # the last time the full ready check passed and the last time any status check passed
+        self.last_ready = None
+        self.last_check = None
+        self.attr_layer_id = None
 
     def _load_from_conf(self, parser, section, db, conf_dir, cloud_confs, conf_file):
         """conf_dir is the directory of the particular level*conf file"""
@@ -332,25 +269,43 @@ class ServiceObject(object):
         if self.iaas_launch is False:
             self.image = None
 
-        item_list = parser.items(section)
-        deps_list = []
-        for (ka,val) in item_list:
-            ndx = ka.find("deps")
-            if ndx == 0:
-                deps_list.append(ka)
-        deps_list.sort()
-        for i in deps_list:
-            deps = config_get_or_none(parser, section, i)
-            deps_file = _resolve_file_or_none(conf_dir, deps, conf_file)
-            if deps_file:
-                parser2 = ConfigParser.ConfigParser()
-                parser2.read(deps_file)
-                keys_val = parser2.items("deps")
-                for (ka,val) in keys_val:
-                    val2 = config_get_or_none(parser2, "deps", ka)
-                    if val2 is not None:
-                        bao = BagAttrsObject(ka, val2)
-                        self.attrs.append(bao)
+
+def _get_deps_files(parser, section, conf_dir, conf_file):
+    """Return the paths of the deps* files of a service section in the order they are read"""
+    item_list = parser.items(section)
+    deps_list = []
+    for (ka,val) in item_list:
+        ndx = ka.find("deps")
+        if ndx == 0:
+            deps_list.append(ka)
+    deps_list.sort()
+    files = []
+    for i in deps_list:
+        deps = config_get_or_none(parser, section, i)
+        deps_file = _resolve_file_or_none(conf_dir, deps, conf_file)
+        if deps_file:
+            files.append(deps_file)
+    return files
+
+
+def _read_deps_files(files):
+    """Return the (key, value) pairs of the deps files.  A key found in more than one file takes its last value"""
+    attrs = []
+    for deps_file in files:
+        parser2 = ConfigParser.ConfigParser()
+        parser2.read(deps_file)
+        keys_val = parser2.items("deps")
+        for (ka,val) in keys_val:
+            val2 = config_get_or_none(parser2, "deps", ka)
+            if val2 is not None:
+                attrs.append((ka, val2))
+    return attrs
+
+
+class AttrLayerObject(object):
+
+    def __init__(self, name):
+        self.name = name
 
 
 
@@ -365,14 +320,226 @@ class IaaSHistoryObject(object):
         self.instance_id = iaas_id
         self.service_id = None
 
-mapper(IaaSHistoryObject, iaas_history_table)
-mapper(BagAttrsObject, attrbag_table)
-mapper(ServiceObject, service_table, properties={
-    'attrs': relation(BagAttrsObject), 'history': relation(IaaSHistoryObject, backref="service")})
-mapper(LevelObject, level_table, properties={
-    'services': relation(ServiceObject)})
-mapper(BootObject, boot_table, properties={
-    'levels': relation(LevelObject)})
+# SQLAlchemy is slow to import and many commands never open a db, so the tables and the mappings of the classes
+# above are only made by _load_orm() when the first CloudInitDDB is made
+metadata = None
+boot_table = None
+level_table = None
+attrlayer_table = None
+service_table = None
+attrbag_table = None
+iaas_history_table = None
+service_event_table = None
+g_orm_lock = threading.Lock()
+
+
+def _load_orm():
+    global metadata, boot_table, level_table, attrlayer_table, service_table
+    global attrbag_table, iaas_history_table, service_event_table
+
+    g_orm_lock.acquire()
+    try:
+        if metadata is not None:
+            return
+        import sqlalchemy
+        from sqlalchemy import ForeignKey, Table, Integer, Float, Boolean, String, MetaData, Sequence, Column, types
+        from sqlalchemy.orm import mapper, relation
+
+        md = MetaData()
+
+        boot_table = Table('boot', md,
+            Column('id', Integer, Sequence('event_id_seq'), primary_key=True),
+            Column('topconf', String(1024)),
+            Column('timestamp', types.TIMESTAMP(), default=datetime.now()),
+            Column('status', Integer),
+            Column('run_name', String(64), index=True),
+            )
+
+        level_table = Table('level', md,
+            Column('id', Integer, Sequence('event_id_seq'), primary_key=True),
+            Column('order', Integer),
+            Column('conf_file', String(1024)),
+            Column('name', String(64)),
+            Column('boot_id', Integer, ForeignKey('boot.id'), index=True),
+            Column('run_name', String(64), index=True),
+            )
+
+        # the attrs read from the deps files of one service section.  every replica made from the section shares it
+        attrlayer_table = Table('attrlayer', md,
+            Column('id', Integer, Sequence('layer_id_seq'), primary_key=True),
+            Column('name', String(64)),
+            Column('run_name', String(64), index=True),
+            )
+
+        service_table = Table('service', md,
+            Column('id', Integer, Sequence('event_id_seq'), primary_key=True),
+            Column('name', String(64), index=True),
+            Column('level_id', Integer, ForeignKey('level.id'), index=True),
+            Column('image', String(32)),
+            Column('iaas', String(32)),
+            Column('allocation', String(64)),
+            Column('keyname', String(32)),
+            Column('localkey', String(1024)),
+            Column('username', String(32)),
+            Column('scp_username', String(32)),
+            Column('readypgm', String(1024)),
+            Column('readypgm_args', String(1024), default=""),
+            Column('hostname', String(64)),
+            Column('bootconf', String(1024)),
+            Column('bootpgm', String(1024)),
+            Column('bootpgm_args', String(1024), default=""),
+            Column('securitygroups', String(1024)),
+            Column('deps', String(1024)),
+            Column('instance_id', String(64), index=True),
+            Column('iaas_url', String(64)),
+            Column('iaas_key', String(64)),
+            Column('iaas_secret', String(64)),
+            Column('state', Integer, default=0, index=True),
+            Column('last_error', sqlalchemy.types.Text()),
+            Column('terminatepgm', String(1024)),
+            Column('terminatepgm_args', String(1024), default=""),
+            Column('iaas_launch', Boolean),
+            Column('pgm_timeout', Integer, default=1200),
+            Column('local_exe', Boolean, default=False),
+            Column('last_ready', types.TIMESTAMP()),
+            Column('last_check', types.TIMESTAMP()),
+            Column('attr_layer_id', Integer, ForeignKey('attrlayer.id')),
+            Column('run_name', String(64), index=True),
+            )
+
+        attrbag_table = Table('attrbag', md,
+            Column('id', Integer, Sequence('extra_id_seq'), primary_key=True),
+            Column('key', String(50)),
+            Column('value', String(50)),
+            Column('service_id', Integer, ForeignKey('service.id'), index=True),
+            Column('layer_id', Integer, ForeignKey('attrlayer.id'), index=True),
+            Column('run_name', String(64), index=True),
+            )
+
+        iaas_history_table = Table('iaas_history', md,
+            Column('id', Integer, Sequence('event_id_seq'), primary_key=True),
+            Column('instance_id', String(64), index=True),
+            Column('timestamp', types.TIMESTAMP(), default=datetime.now()),
+            Column('service_id', Integer, ForeignKey('service.id'), index=True),
+            Column('run_name', String(64), index=True),
+            )
+
+        # an append only journal of what happened to each service.  the state columns of the service table say
+        # where a service is, the journal says how it got there and how long each step took
+        service_event_table = Table('service_event', md,
+            Column('id', Integer, Sequence('service_event_id_seq'), primary_key=True),
+            Column('run_name', String(64), index=True),
+            Column('service_name', String(64), index=True),
+            Column('stage', String(16)),
+            Column('event', String(16)),
+            Column('timestamp', Float),
+            Column('detail', sqlalchemy.types.Text()),
+            )
+
+        mapper(IaaSHistoryObject, iaas_history_table)
+        mapper(BagAttrsObject, attrbag_table)
+        mapper(AttrLayerObject, attrlayer_table, properties={
+            'attrs': relation(BagAttrsObject)})
+        mapper(ServiceObject, service_table, properties={
+            'attrs': relation(BagAttrsObject), 'history': relation(IaaSHistoryObject, backref="service"),
+            'attr_layer': relation(AttrLayerObject)})
+        mapper(LevelObject, level_table, properties={
+            'services': relation(ServiceObject)})
+        mapper(BootObject, boot_table, properties={
+            'levels': relation(LevelObject)})
+
+        if tuple([c.name for c in service_table.columns]) != g_service_columns:
+            raise APIUsageException("g_service_columns does not match the service table")
+        metadata = md
+    finally:
+        g_orm_lock.release()
+
+# the columns of the service table.  they are listed here rather than read from the table so that ServiceRecord can
+# be defined without loading SQLAlchemy
+g_service_columns = ("id", "name", "level_id", "image", "iaas", "allocation", "keyname", "localkey", "username",
+    "scp_username", "readypgm", "readypgm_args", "hostname", "bootconf", "bootpgm", "bootpgm_args", "securitygroups",
+    "deps", "instance_id", "iaas_url", "iaas_key", "iaas_secret", "state", "last_error", "terminatepgm",
+    "terminatepgm_args", "iaas_launch", "pgm_timeout", "local_exe", "last_ready", "last_check", "attr_layer_id",
+    "run_name")
+# the columns that change while a run is going.  the rest only change when the plan is loaded from its conf files
+g_service_state_columns = ("state", "hostname", "instance_id", "last_error", "last_ready", "last_check")
+# the state columns whose changes are journaled.  the times of the last ready checks change with every status and
+# are only written to the service row, at checkpoints
+g_service_journal_columns = ("state", "hostname", "instance_id", "last_error")
+
+
+def _detail_to_value(column, detail):
+    if column == "state" and detail is not None:
+        return int(detail)
+    return detail
+
+
+class ServiceRecord(object):
+    """
+    The in memory state of one service.  The boot, ready and terminate paths work on these rather than on mapped
+    ServiceObjects.  A record is a single slotted object with no attribute instrumentation, no session bookkeeping
+    and no attrs relation behind it, which adds up for plans with thousands of services.  Records are read with
+    plain selects by CloudInitDDB.get_service_records() and written back by CloudInitDDB.save_record().
+    """
+    __slots__ = g_service_columns + ("attrs", "layer", "_new_attrs")
+
+    def __init__(self, row, attrs=None, layer=None):
+        """
+        row: anything with the service columns as attributes, a select result row or a ServiceObject
+
+        attrs: a list of the (key, value) pairs that belong to this service alone, like the output of its boot program
+
+        layer: a dict of the attrs from the deps files.  It is shared by every replica of the service section and
+        must not be changed.
+        """
+        for c in g_service_columns:
+            setattr(self, c, getattr(row, c))
+        if attrs is None:
+            attrs = []
+        self.attrs = attrs
+        if layer is None:
+            layer = {}
+        self.layer = layer
+        self._new_attrs = []
+
+    def get_all_attrs(self):
+        """The (key, value) pairs of the layer followed by those of the service"""
+        return self.layer.items() + self.attrs
+
+    def add_attr(self, key, value):
+        self.attrs.append((key, value))
+        self._new_attrs.append((key, value))
+
+
+class BootRecord(object):
+    """
+    The boot row of a run and its levels, as read by CloudInitDDB.load_from_db().  It can be given to
+    get_service_records() in place of a BootObject.
+    """
+    __slots__ = ("id", "topconf", "status", "run_name", "levels")
+
+    def __init__(self, row, levels):
+        for c in ("id", "topconf", "status", "run_name"):
+            setattr(self, c, getattr(row, c))
+        self.levels = levels
+
+
+class LevelRecord(object):
+    __slots__ = ("id", "order", "conf_file", "name")
+
+    def __init__(self, row):
+        for c in self.__slots__:
+            setattr(self, c, getattr(row, c))
+
+
+class IaaSHistoryRecord(object):
+    """One VM launched for a service, as read by CloudInitDDB.get_iaas_history().  service is its ServiceRecord"""
+    __slots__ = ("id", "instance_id", "timestamp", "service_id", "run_name", "service")
+
+    def __init__(self, row, service):
+        for c in ("id", "instance_id", "timestamp", "service_id", "run_name"):
+            setattr(self, c, getattr(row, c))
+        self.service = service
 
 class CloudConfSection(object):
 
@@ -392,26 +559,297 @@ class CloudConfSection(object):
 
 class CloudInitDDB(object):
 
-    def __init__(self, dburl, module=None):
+    def __init__(self, dburl, module=None, run_name=None):
+        """
+        dburl: any SQLAlchemy url
+
+        run_name: the run this object reads and writes when the db is a store shared by many runs.  Every row is
+        tagged with its run.  None is for a db that holds a single run (the rows have no run name).
+        """
 
         self._cloudconf_sections = {}
+        self._run_name = run_name
+
+        _load_orm()
+        import sqlalchemy
+        from sqlalchemy import event
+        from sqlalchemy.orm import sessionmaker
 
         if module is None:
             self._engine = sqlalchemy.create_engine(dburl)
         else:
             self._engine = sqlalchemy.create_engine(dburl, module=module)
+        if run_name is not None and self._engine.dialect.name == "sqlite":
+            # a shared store is written by many processes at once.  with a write ahead log readers are not blocked
+            # by a writer
+            self._engine.execute("PRAGMA journal_mode=WAL")
         metadata.create_all(self._engine)
+        self._upgrade_tables()
+        self._query_count = 0
+        event.listen(self._engine, "before_cursor_execute", self._count_query)
         self._Session = sessionmaker(bind=self._engine)
         self._session = self._Session()
 
+        self._events = []
+        self._attr_rows = []
+        # service id -> the journaled column values, and the records changed since the last checkpoint
+        self._journaled = {}
+        self._dirty = {}
+
+        self._db_file = None
+        if dburl.find("sqlite:///") == 0:
+            self._db_file = dburl[len("sqlite:///"):]
+        self._file_stamp = None
+
+    def _upgrade_tables(self):
+        """
+        create_all() does not touch tables that already exist.  Add any column or index that a db made by an older
+        version is missing so that it can still be loaded.
+        """
+        from sqlalchemy.engine.reflection import Inspector
+
+        inspector = Inspector.from_engine(self._engine)
+        for table in metadata.sorted_tables:
+            have = [c['name'] for c in inspector.get_columns(table.name)]
+            for col in table.columns:
+                if col.name in have:
+                    continue
+                col_type = col.type.compile(dialect=self._engine.dialect)
+                self._engine.execute('ALTER TABLE %s ADD COLUMN "%s" %s' % (table.name, col.name, col_type))
+            have = [i['name'] for i in inspector.get_indexes(table.name)]
+            for idx in table.indexes:
+                if idx.name not in have:
+                    idx.create(self._engine)
+
+    def _in_run(self, table):
+        """A where clause that limits a statement on table to the rows of this run"""
+        return table.c.run_name == self._run_name
+
+    def _count_query(self, conn, cursor, statement, parameters, context, executemany):
+        self._query_count = self._query_count + 1
+
+    def get_query_count(self):
+        """The number of statements sent to the db since it was opened (or since reset_query_count())"""
+        return self._query_count
+
+    def reset_query_count(self):
+        self._query_count = 0
+
     def db_obj_add(self, obj):
         self._session.add(obj)
 
     def db_commit(self):
+        """
+        A checkpoint: bring the rows of the services changed since the last one up to date, write out the journal
+        and commit.  A checkpoint event is journaled for each of those services, get_service_records() only replays
+        the events after it.
+        """
+        for rec in self._dirty.values():
+            values = {}
+            for c in g_service_state_columns:
+                values[c] = getattr(rec, c)
+            self._session.execute(service_table.update().where(service_table.c.id == rec.id), values)
+            self.add_event(rec.name, None, "checkpoint", flush=False)
+        self._dirty = {}
+        self.flush_events()
+
+    def flush_events(self):
+        """Write out the buffered journal and attrs and commit, without a checkpoint"""
+        self._write_events()
         self._session.commit()
+        self._file_stamp = self._get_file_stamp()
+
+    def _get_file_stamp(self):
+        if not self._db_file:
+            return None
+        try:
+            st = os.stat(self._db_file)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def get_db_file(self):
+        """The path of the db when it is a sqlite file, otherwise None"""
+        return self._db_file
+
+    def is_stale(self):
+        """
+        True when the db file was changed (or removed) by someone other than this object since it was last loaded
+        or committed.  Objects held in memory for a long time use this to know when they must reload.
+        """
+        if not self._db_file:
+            return False
+        stamp = self._get_file_stamp()
+        return stamp is None or stamp != self._file_stamp
+
+    def get_service_records(self, bo):
+        """
+        Return a list of ServiceRecords for each level of bo, in level order.  Two selects are made no matter how
+        many services there are and no ServiceObjects are loaded.  Replicas of one service section share a single
+        dict of the attrs read from the section's deps files.
+        """
+        if not bo.levels:
+            return []
+        levels = {}
+        for l in bo.levels:
+            levels[l.id] = []
+        attrs = {}
+        layers = {}
+        sel = attrbag_table.select().where(self._in_run(attrbag_table)).order_by(attrbag_table.c.id)
+        for r in self._session.execute(sel):
+            if r.layer_id is not None:
+                layers.setdefault(r.layer_id, {})[r.key] = r.value
+            else:
+                attrs.setdefault(r.service_id, []).append((r.key, r.value))
+
+        records = {}
+        sel = service_table.select().where(service_table.c.level_id.in_(levels.keys())).order_by(service_table.c.id)
+        for r in self._session.execute(sel):
+            rec = ServiceRecord(r, attrs.get(r.id), layers.get(r.attr_layer_id))
+            levels[r.level_id].append(rec)
+            records[(self._run_name, rec.name)] = rec
+        self._replay_into(records)
+        return [levels[l.id] for l in bo.levels]
+
+    def _replay_into(self, records, all_runs=False, track=True):
+        """
+        Apply the journal written since the last checkpoint of each service to records, a dict of (run name, service
+        name) to ServiceRecord read from the service rows.  When track is set these are the records the run works
+        on, those changed this way are written to their rows at the next checkpoint.
+        """
+        sel = service_event_table.select().where(service_event_table.c.event.in_(g_service_journal_columns + ("checkpoint",)))
+        if not all_runs:
+            sel = sel.where(self._in_run(service_event_table))
+        pending = {}
+        for e in self._session.execute(sel.order_by(service_event_table.c.id)):
+            key = (e.run_name, e.service_name)
+            if e.event == "checkpoint":
+                pending.pop(key, None)
+            else:
+                pending.setdefault(key, []).append(e)
+        for (key, rec) in records.items():
+            for e in pending.get(key, []):
+                setattr(rec, e.event, _detail_to_value(e.event, e.detail))
+            if not track:
+                continue
+            if key in pending:
+                self._dirty[rec.id] = rec
+            self._journaled[rec.id] = tuple([getattr(rec, c) for c in g_service_journal_columns])
+
+    def save_record(self, rec, stage=None):
+        """
+        Record the run time state of a ServiceRecord, and any attrs added to it.  Each changed state column is
+        appended to the journal, tagged with stage, and that is all that is written: the journal goes out in batches
+        (see add_event()) and the service row is only brought up to date at the next checkpoint (db_commit()).  The
+        state survives a process that dies between checkpoints as far as its journal was written, it is replayed
+        onto the row when the run is loaded.
+        """
+        journaled = self._journaled.get(rec.id)
+        values = tuple([getattr(rec, c) for c in g_service_journal_columns])
+        for (i, c) in enumerate(g_service_journal_columns):
+            if journaled is None or journaled[i] != values[i]:
+                detail = values[i]
+                if detail is not None:
+                    detail = str(detail)
+                self.add_event(rec.name, stage, c, detail, flush=False)
+        self._journaled[rec.id] = values
+        self._dirty[rec.id] = rec
+
+        if rec._new_attrs:
+            self._attr_rows.extend([{'key': k, 'value': v, 'service_id': rec.id, 'run_name': self._run_name} for (k, v) in rec._new_attrs])
+            rec._new_attrs = []
+        self._flush_if_due()
+
+    def save_status(self, bo):
+        """Write the status of a BootRecord (or BootObject) back to the db and commit"""
+        self._session.execute(boot_table.update().where(boot_table.c.id == bo.id), {'status': bo.status})
+        self.db_commit()
+
+    def add_iaas_history(self, rec, instance_id):
+        # a launched VM is committed right away, along with the journal so far, so that it is never lost track of
+        self._session.execute(iaas_history_table.insert(), {'instance_id': instance_id, 'service_id': rec.id, 'timestamp': datetime.now(), 'run_name': self._run_name})
+        self.flush_events()
+
+    def get_last_instance_ids(self):
+        """Return a dict of service db id to the id of the last VM launched for that service in this run"""
+        from sqlalchemy import select
+
+        sel = select([iaas_history_table.c.service_id, iaas_history_table.c.instance_id]).where(self._in_run(iaas_history_table)).order_by(iaas_history_table.c.id)
+        d = {}
+        for r in self._session.execute(sel):
+            d[r.service_id] = r.instance_id
+        return d
+
+    def add_event(self, service_name, stage, event, detail=None, flush=True):
+        """
+        Append an event to the journal.  Events are buffered in memory and written, with one insert and one commit,
+        once g_event_batch_size of them are waiting or the oldest has waited g_event_flush_period seconds.
+        """
+        self._events.append({'run_name': self._run_name, 'service_name': service_name, 'stage': stage, 'event': event, 'timestamp': time.time(), 'detail': detail})
+        if flush:
+            self._flush_if_due()
+
+    def _flush_if_due(self):
+        if not self._events and not self._attr_rows:
+            return
+        if len(self._events) >= g_event_batch_size or not self._events or time.time() - self._events[0]['timestamp'] >= g_event_flush_period:
+            self.flush_events()
+
+    def _write_events(self):
+        if self._attr_rows:
+            self._session.execute(attrbag_table.insert(), self._attr_rows)
+            self._attr_rows = []
+        if not self._events:
+            return
+        self._session.execute(service_event_table.insert(), self._events)
+        self._events = []
+
+    def get_events(self, service_name=None, all_runs=False):
+        """
+        Return the journal of this run (or of every run in the db) in the order it was written.  Each row has
+        run_name, service_name, stage, event, timestamp (seconds since the epoch) and detail.  The checkpoint
+        markers are left out.
+        """
+        self._write_events()
+        sel = service_event_table.select().where(service_event_table.c.event != "checkpoint")
+        if not all_runs:
+            sel = sel.where(self._in_run(service_event_table))
+        if service_name is not None:
+            sel = sel.where(service_event_table.c.service_name == service_name)
+        return self._session.execute(sel.order_by(service_event_table.c.id)).fetchall()
+
+    def replay_events(self):
+        """
+        Derive the state of each service of this run from the journal alone.  A dict of service name to
+        (state, last_error, timestamp of the last event) is returned.
+        """
+        states = {}
+        for e in self.get_events():
+            (state, last_error, ts) = states.get(e.service_name, (cloudinitd.service_state_initial, None, None))
+            if e.event == "state":
+                state = int(e.detail)
+            elif e.event == "last_error":
+                last_error = e.detail
+            states[e.service_name] = (state, last_error, e.timestamp)
+        return states
+
+    def close(self):
+        if self._events or self._dirty or self._attr_rows:
+            self.db_commit()
+        self._session.close()
+        self._engine.dispose()
 
     def load_from_db(self):
-        bo = self._session.query(BootObject).first()
+        """
+        Return a BootRecord of the run, read with two selects.  Mapped objects are only made when a plan is loaded
+        into the db by load_from_conf().
+        """
+        r = self._session.execute(boot_table.select().where(self._in_run(boot_table)).order_by(boot_table.c.id)).first()
+        if r is None:
+            raise APIUsageException("There is no run %s in the db" % (self._run_name))
+        sel = level_table.select().where(level_table.c.boot_id == r.id).order_by(level_table.c.id)
+        bo = BootRecord(r, [LevelRecord(l) for l in self._session.execute(sel)])
+        self._file_stamp = self._get_file_stamp()
 
         # need to re-read topconf to get globals. should these go to DB instead?
         parser = ConfigParser.ConfigParser()
@@ -465,25 +903,45 @@ class CloudInitDDB(object):
 
         _load_globals_from_config(parser)
 
+        # we can delete bootobject, levels and the deps file layers if they exist.  the services are unhooked from
+        # the old levels and layers with a single update instead of being loaded one at a time, those that are
+        # still in the plan are hooked back up to the new ones below
+        for b in self._session.query(BootObject).filter(BootObject.run_name == self._run_name).all():
+            for l in b.levels:
+                self._session.expunge(l)
+            self._session.expunge(b)
+        for layer in self._session.query(AttrLayerObject).filter(AttrLayerObject.run_name == self._run_name).all():
+            self._session.expunge(layer)
+        self._session.execute(service_table.update().where(self._in_run(service_table)).values(level_id=None, attr_layer_id=None))
+        self._session.execute(attrbag_table.delete().where(self._in_run(attrbag_table)).where(attrbag_table.c.layer_id != None))
+        self._session.execute(attrlayer_table.delete().where(self._in_run(attrlayer_table)))
+        self._session.execute(level_table.delete().where(self._in_run(level_table)))
+        self._session.execute(boot_table.delete().where(self._in_run(boot_table)))
+
+        # every service already in the db is fetched with one query
+        self._services_by_name = {}
+        for svc_db in self._session.query(ServiceObject).filter(ServiceObject.run_name == self._run_name):
+            self._services_by_name[svc_db.name] = svc_db
+        self._layers = {}
+
         lvl_dict = {}
         levels = parser.items("runlevels")
-        for l in levels:
-            (key, val) = l
+        try:
+            for l in levels:
+                (key, val) = l
+
+                # if the key has the word level in it we do something otherwise we log a warning
+                ndx = key.find("level")
+                if ndx == 0:
+                    level_file = os.path.join(self._confdir, val)
+                    (level, order) = self.build_level(key, level_file)
+                    lvl_dict[order] = level
+        except:
+            self._session.rollback()
+            raise
 
-            # if the key has the word level in it we do something otherwise we log a warning
-            ndx = key.find("level")
-            if ndx == 0:
-                level_file = os.path.join(self._confdir, val)
-                (level, order) = self.build_level(key, level_file)
-                lvl_dict[order] = level
-
-        # we can delete bootobject and levels if they exist
-        all_bo = self._session.query(BootObject).all()
-        for b in all_bo:
-            for l in b.levels:
-                self._session.delete(l)
-            self._session.delete(b)
         bo = BootObject(conf_file)
+        bo.run_name = self._run_name
         x = lvl_dict.keys()
         x.sort()
         for k in x:
@@ -492,7 +950,19 @@ class CloudInitDDB(object):
             bo.levels.append(lvl)
 
         self._session.add(bo)
-        self._session.commit()
+
+        # the layer attrs go in with one executemany once the layers have their ids
+        self._session.flush()
+        rows = []
+        for (layer, attrs) in self._layers.values():
+            if layer is None:
+                continue
+            rows.extend([{'key': k, 'value': v, 'layer_id': layer.id, 'run_name': self._run_name} for (k, v) in attrs])
+        if rows:
+            self._session.execute(attrbag_table.insert(), rows)
+        self.db_commit()
+        self._services_by_name = None
+        self._layers = None
         self.bo = bo
         return bo
 
@@ -507,6 +977,7 @@ class CloudInitDDB(object):
 
         order = int(level_name.replace("level", ""))
         level = LevelObject(level_file, level_name, order)
+        level.run_name = self._run_name
         for s in sections:
             ndx = s.find("svc-")
             if ndx == 0:
@@ -518,25 +989,106 @@ class CloudInitDDB(object):
                     count = 1
                 name = s[4:]
 
+                # the deps files are read and stored once for all of the replicas, and for every other section
+                # that lists the same files
+                deps_files = tuple(_get_deps_files(parser, s, context_dir, level_file))
+                layer = None
+                if deps_files in self._layers:
+                    layer = self._layers[deps_files][0]
+                elif deps_files:
+                    attrs = _read_deps_files(deps_files)
+                    if attrs:
+                        layer = AttrLayerObject(",".join([os.path.basename(f) for f in deps_files])[:64])
+                        layer.run_name = self._run_name
+                        self._session.add(layer)
+                    self._layers[deps_files] = (layer, attrs)
+
                 for i in range(0, count):
                     l_name = name
                     if count > 1:
                         l_name = name + "-%d" % (i)
 
-                    try:
-                        svc_db = self._session.query(ServiceObject).filter(ServiceObject.name==l_name).first()
-                    except:
-                        svc_db = None
+                    svc_db = self._services_by_name.get(l_name)
                     if not svc_db:
                         svc_db = ServiceObject()
                         svc_db.new(l_name)
+                        svc_db.run_name = self._run_name
                         self._session.add(svc_db)
+                        self._services_by_name[l_name] = svc_db
                     svc_db._load_from_conf(parser, s, self, context_dir, self._cloudconf_sections, level_file)
+                    svc_db.attr_layer = layer
                     level.services.append(svc_db)
 
         return (level, order)
 
 
-    def get_iaas_history(self):
-        bo = self._session.query(IaaSHistoryObject).all()
-        return bo
+    def get_iaas_history(self, all_runs=False, orphans=False):
+        """
+        Return an IaaSHistoryRecord for every VM launched, oldest first, each with the ServiceRecord of its service.
+        The same few selects are made no matter how many VMs and services there are.
+
+        all_runs: return the history of every run in a shared store rather than just this one
+
+        orphans: only return the VMs that may be orphaned: those that are no longer the VM of their service and
+        those of services that never got past launching
+        """
+        from sqlalchemy import select, or_
+
+        # the service rows may be behind the journal, which is replayed onto them below
+        self.flush_events()
+        h = iaas_history_table
+        svc_ids = select([h.c.service_id])
+        if not all_runs:
+            svc_ids = svc_ids.where(self._in_run(h))
+
+        attrs = {}
+        layers = {}
+        layer_ids = select([service_table.c.attr_layer_id]).where(service_table.c.id.in_(svc_ids))
+        sel = attrbag_table.select().where(or_(attrbag_table.c.service_id.in_(svc_ids), attrbag_table.c.layer_id.in_(layer_ids))).order_by(attrbag_table.c.id)
+        for r in self._session.execute(sel):
+            if r.layer_id is not None:
+                layers.setdefault(r.layer_id, {})[r.key] = r.value
+            else:
+                attrs.setdefault(r.service_id, []).append((r.key, r.value))
+
+        services = {}
+        by_name = {}
+        sel = service_table.select().where(service_table.c.id.in_(svc_ids))
+        for r in self._session.execute(sel):
+            rec = ServiceRecord(r, attrs.get(r.id), layers.get(r.attr_layer_id))
+            services[r.id] = rec
+            by_name[(r.run_name, r.name)] = rec
+        self._replay_into(by_name, all_runs=all_runs, track=False)
+
+        sel = h.select()
+        if not all_runs:
+            sel = sel.where(self._in_run(h))
+        l = []
+        for r in self._session.execute(sel.order_by(h.c.id)):
+            s = services[r.service_id]
+            if orphans and s.instance_id is not None and s.instance_id == r.instance_id and s.state != cloudinitd.service_state_initial:
+                continue
+            l.append(IaaSHistoryRecord(r, s))
+        return l
+
+    def has_run(self):
+        from sqlalchemy import select, func
+
+        sel = select([func.count(boot_table.c.id)]).where(self._in_run(boot_table))
+        return self._session.execute(sel).scalar() > 0
+
+    def get_run_names(self):
+        """Return the names of all of the runs in a shared store"""
+        from sqlalchemy import select, distinct
+
+        sel = select([distinct(boot_table.c.run_name)]).where(boot_table.c.run_name != None).order_by(boot_table.c.run_name)
+        return [r[0] for r in self._session.execute(sel)]
+
+    def delete_run(self):
+        """Remove every row of this run"""
+        self._events = []
+        self._attr_rows = []
+        self._dirty = {}
+        for table in [service_event_table, attrbag_table, iaas_history_table, service_table, attrlayer_table, level_table, boot_table]:
+            self._session.execute(table.delete().where(self._in_run(table)))
+        self.db_commit()
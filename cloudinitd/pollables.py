@@ -11,12 +11,13 @@ pollables are complete, that bootlevel is complete and the next bootlevel can be
 The SVCContainer class in the services.py file is another type of pollable.  It is customized to use three
 internal pollables of specific purpose.
 """
-from boto.exception import EC2ResponseError
 import logging
 import select
 import subprocess
 import time
-from threading import Thread
+import heapq
+import threading
+import weakref
 import datetime
 from cloudinitd.exceptions import TimeoutException, IaaSException, APIUsageException, ProcessException, MultilevelException, PollableException
 import cloudinitd
@@ -29,6 +30,44 @@ import socket
 
 
 
+g_process_slots = None
+# reentrant because a slot can be given back by the garbage collector at any point
+g_process_slots_lock = threading.RLock()
+# weak references to the pollables holding a slot while there is a limit, a pollable that is dropped before it
+# is polled to the end gives its slot back when it is collected
+g_slot_holders = set()
+
+# how often, in seconds, a VM is still polled while an instance event source is set (see cb_iaas)
+g_event_fallback_poll_period = 30.0
+
+def set_max_processes(n):
+    """
+    Limit the number of programs run by PopenExecutablePollable objects at the same time across the whole
+    process.  Pollables past the limit wait (while still being polled) for one to finish.  0 or None means no limit.
+    """
+    global g_process_slots
+    g_process_slots = n or None
+
+def _slot_dropped(slot):
+    g_process_slots_lock.acquire()
+    try:
+        g_slot_holders.discard(slot)
+    finally:
+        g_process_slots_lock.release()
+
+def _get_process_slot(pollable):
+    """Return the slot taken by pollable, or None when they are all taken"""
+    g_process_slots_lock.acquire()
+    try:
+        if len(g_slot_holders) >= g_process_slots:
+            return None
+        slot = weakref.ref(pollable, _slot_dropped)
+        g_slot_holders.add(slot)
+        return slot
+    finally:
+        g_process_slots_lock.release()
+
+
 class Pollable(object):
 
     def __init__(self, timeout=0, done_cb=None):
@@ -53,6 +92,14 @@ class Pollable(object):
     def pre_start(self):
         pass
 
+    def pre_poll(self):
+        """
+        Called on pollables that have not yet been started when their owner runs in pipelined mode.  It gives the
+        object a chance to do work that does not depend on anything else before it is actually started.  Returns
+        True when there is nothing (left) to do.  It must never raise.
+        """
+        return True
+
     def poll(self):
         if self._timeout == 0:
             return False
@@ -79,13 +126,242 @@ class NullPollable(Pollable):
     def poll(self):
         return True
 
-class HostnameCheckThread(Thread):
-    def __init__(self, host_poller):
-        Thread.__init__(self)
-        self.host_poller = host_poller
+class FallbackPollable(Pollable):
+    """
+    Run a cheap pollable first.  If it fails the pollable returned by fallback_factory() is started in its place
+    and this object succeeds or fails with it.
+    """
+
+    def __init__(self, pollable, fallback_factory, log=logging, timeout=0, done_cb=None):
+        Pollable.__init__(self, timeout, done_cb=done_cb)
+        self._pollable = pollable
+        self._fallback_factory = fallback_factory
+        self._fallback = None
+        self._log = log
+        self._done = False
+
+    def start(self):
+        Pollable.start(self)
+        self._pollable.start()
+
+    def poll(self):
+        if self._exception:
+            raise self._exception
+        if self._done:
+            return True
+        Pollable.poll(self)
+
+        if self._fallback is None:
+            try:
+                rc = self._pollable.poll()
+            except Exception, ex:
+                cloudinitd.log(self._log, logging.INFO, "the first check failed, falling back: %s" % (str(ex)))
+                self._fallback = self._fallback_factory()
+                self._fallback.start()
+                rc = False
+            if rc:
+                self._done = True
+                self._execute_done_cb()
+                return True
+            if self._fallback is None:
+                return False
+
+        try:
+            rc = self._fallback.poll()
+        except Exception, ex:
+            self._exception = ex
+            raise
+        if rc:
+            self._done = True
+            self._execute_done_cb()
+        return rc
+
+    def used_fallback(self):
+        return self._fallback is not None
+
+    def get_fallback(self):
+        return self._fallback
+
+    def cancel(self):
+        if self._fallback is not None:
+            self._fallback.cancel()
+        else:
+            self._pollable.cancel()
+
+class HostnameWatchers(object):
+    """
+    A few threads that update the VMs of every InstanceHostnamePollable in the process until they leave the pending
+    states.  The pollables are kept in a heap by the time they are next due, so the number of threads does not
+    grow with the number of VMs.  A thread takes every due pollable whose VM shares an update key (see
+    cb_iaas.get_update_key) and updates them with one describe call.  The threads are started when there is
+    something to watch and end when there is nothing left.
+    """
+
+    def __init__(self, count):
+        self._count = count
+        self._thread_count = 0
+        self._heap = []
+        self._seq = 0
+        # pollable -> the seq of its entry in the heap, entries with another seq are stale and are dropped
+        self._due = {}
+        # the pollables a thread is working on, and those of them that were woken meanwhile
+        self._busy = set()
+        self._woken = set()
+        self._cond = threading.Condition()
+
+    def _push(self, poller, delay):
+        self._seq = self._seq + 1
+        self._due[poller] = self._seq
+        heapq.heappush(self._heap, (time.time() + delay, self._seq, poller))
+        while self._thread_count < min(self._count, len(self._due)):
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self._thread_count = self._thread_count + 1
+        self._cond.notify()
+
+    def set_count(self, count):
+        self._cond.acquire()
+        try:
+            self._count = count
+        finally:
+            self._cond.release()
+
+    def watch(self, poller, delay):
+        """Call poller._watch() in delay seconds, and again each time it returns a delay"""
+        self._cond.acquire()
+        try:
+            self._push(poller, delay)
+        finally:
+            self._cond.release()
+
+    def wake(self, poller):
+        """Call poller._watch() now rather than when it is due"""
+        self._cond.acquire()
+        try:
+            if poller in self._busy:
+                self._woken.add(poller)
+            elif poller in self._due:
+                self._push(poller, 0.0)
+        finally:
+            self._cond.release()
+
+    def _next(self):
+        self._cond.acquire()
+        try:
+            while True:
+                wait = None
+                if self._heap:
+                    (due, seq, poller) = self._heap[0]
+                    if self._due.get(poller) != seq:
+                        heapq.heappop(self._heap)
+                        continue
+                    wait = due - time.time()
+                    if wait <= 0:
+                        heapq.heappop(self._heap)
+                        del self._due[poller]
+                        self._busy.add(poller)
+                        return self._take_batch(poller)
+                elif not self._due:
+                    self._thread_count = self._thread_count - 1
+                    return None
+                self._cond.wait(wait)
+        finally:
+            self._cond.release()
+
+    def _take_batch(self, first):
+        """Return first along with the other due pollers whose VMs can be described in the same call"""
+        batch = [first]
+        key = first._get_update_key()
+        if key is None:
+            return batch
+        # VMs launched together come due a moment apart, take them in one call rather than a trail of small ones
+        now = time.time() + g_hostname_batch_window
+        for (due, seq, poller) in self._heap:
+            if len(batch) >= g_hostname_batch_size:
+                break
+            if due > now or self._due.get(poller) != seq or poller._get_update_key() != key:
+                continue
+            # the heap entry is now stale and is dropped when it reaches the top
+            del self._due[poller]
+            self._busy.add(poller)
+            batch.append(poller)
+        return batch
 
-    def run(self):
-        self.host_poller._thread_poll()
+    def _run(self):
+        while True:
+            pollers = self._next()
+            if pollers is None:
+                return
+            updated = _update_together(pollers)
+            for poller in pollers:
+                delay = None
+                try:
+                    delay = poller._watch(updated=poller in updated)
+                except Exception, ex:
+                    # the poller is no longer watched, this thread carries on with the others
+                    cloudinitd.log(poller._log, logging.ERROR, "watching the VM failed: %s" % (str(ex)), tb=traceback)
+                    poller._watched.set()
+                self._cond.acquire()
+                try:
+                    self._busy.discard(poller)
+                    if poller in self._woken:
+                        self._woken.discard(poller)
+                        if delay is not None:
+                            delay = 0.0
+                    if delay is not None:
+                        self._push(poller, delay)
+                finally:
+                    self._cond.release()
+
+def _update_together(pollers):
+    """
+    Update the VMs of pollers that share an update key with one describe call.  The set of pollers whose VM was
+    updated is returned, the others update their own VM.
+    """
+    pollers = [p for p in pollers if not p._done]
+    if len(pollers) < 2:
+        return set()
+    try:
+        instances = set(update_instances([p.get_instance() for p in pollers]))
+    except Exception, ex:
+        cloudinitd.log(pollers[0]._log, logging.DEBUG, "the describe of %d VMs failed, updating them one at a time: %s" % (len(pollers), str(ex)))
+        return set()
+    return set([p for p in pollers if p.get_instance() in instances])
+
+# the number of threads in the HostnameWatchers, see set_hostname_watcher_count()
+g_hostname_watcher_count = 4
+# the most VMs updated by one describe call
+g_hostname_batch_size = 100
+# how many seconds early a VM may be updated so that it shares a describe call
+g_hostname_batch_window = 0.5
+g_hostname_watchers = None
+g_hostname_watchers_lock = threading.Lock()
+
+def set_hostname_watcher_count(n):
+    """
+    Set the number of threads that watch pending VMs across the whole process.  Each thread makes one describe
+    call at a time, for all of the due VMs of an IaaS connection when the IaaS allows it.
+    """
+    global g_hostname_watcher_count
+    g_hostname_watcher_count = max(1, n)
+    g_hostname_watchers_lock.acquire()
+    try:
+        if g_hostname_watchers is not None:
+            g_hostname_watchers.set_count(g_hostname_watcher_count)
+    finally:
+        g_hostname_watchers_lock.release()
+
+def get_hostname_watchers():
+    global g_hostname_watchers
+
+    g_hostname_watchers_lock.acquire()
+    try:
+        if g_hostname_watchers is None:
+            g_hostname_watchers = HostnameWatchers(g_hostname_watcher_count)
+        return g_hostname_watchers
+    finally:
+        g_hostname_watchers_lock.release()
 
 class InstanceTerminatePollable(Pollable):
 
@@ -184,8 +460,12 @@ class InstanceHostnamePollable(Pollable):
         self._log = log
         self._done = False
         self.exception = None
-        self._thread = None
         self._ok_states = ["networking", "pending", "scheduling", "spawning", "launching"]
+        self._event_source = None
+        self._poll_period = 1.0
+        # set while the watchers are not updating the VM
+        self._watched = threading.Event()
+        self._watched.set()
 
 
     def pre_start(self):
@@ -201,9 +481,27 @@ class InstanceHostnamePollable(Pollable):
     def start(self):
         self.pre_start()
         Pollable.start(self)
+        # subscribe before the first update so that no change is missed in between
+        self._event_source = get_instance_event_source()
+        if self._event_source:
+            self._event_source.subscribe(self.get_instance_id(), self._instance_event)
+            # the events say when to look, polling only catches the ones that were lost
+            self._poll_period = g_event_fallback_poll_period
         self._update()
-        self._thread = HostnameCheckThread(self)
-        self._thread.start()
+        if self._instance.get_state() in self._ok_states:
+            self._watched.clear()
+            get_hostname_watchers().watch(self, self._poll_period)
+        else:
+            self._unsubscribe()
+
+    def _instance_event(self, instance_id, state):
+        cloudinitd.log(self._log, logging.DEBUG, "%s was reported to be %s" % (instance_id, state))
+        get_hostname_watchers().wake(self)
+
+    def _unsubscribe(self):
+        if self._event_source:
+            self._event_source.unsubscribe(self.get_instance_id(), self._instance_event)
+            self._event_source = None
 
     def poll(self):
         if self.exception:
@@ -217,8 +515,10 @@ class InstanceHostnamePollable(Pollable):
         state = self._instance.get_state()
         cloudinitd.log(self._log, logging.DEBUG, "Current iaas state in poll for %s is %s" % (self.get_instance_id(), state))
         if state == "running":
+            # the watcher that saw it running is about to let go of the VM.  do not hold up the poll loop for it
+            if not self._watched.wait(0.1):
+                return False
             self._done = True
-            self._thread.join()
             self._execute_done_cb()
             return True
         if state not in self._ok_states:
@@ -230,10 +530,10 @@ class InstanceHostnamePollable(Pollable):
 
     def cancel(self):
         self._done = True
+        get_hostname_watchers().wake(self)
         if self._instance:
             self._instance.cancel()
-        if self._thread:
-            self._thread.join(3.0)
+        self._watched.wait(3.0)
 
     def get_instance_id(self):
         return self._instance.get_id()
@@ -241,6 +541,10 @@ class InstanceHostnamePollable(Pollable):
     def get_instance(self):
         return self._instance
 
+    def set_instance(self, instance):
+        """Use an already launched VM (like one from the warm pool) instead of launching a new one"""
+        self._instance = instance
+
     def get_hostname(self):
         return self._instance.get_hostname()
 
@@ -250,7 +554,9 @@ class InstanceHostnamePollable(Pollable):
     def _update(self):
         try:
             self._instance.update()
-        except EC2ResponseError, ecex:
+        except Exception, ecex:
+            if not is_ec2_response_error(ecex):
+                raise
             # We allow this error to occur once.  It takes ec2 some time
             # to be sure of the instance id
             if self._poll_error_count > self._max_id_error_count:
@@ -259,22 +565,40 @@ class InstanceHostnamePollable(Pollable):
                 raise
             self._poll_error_count = self._poll_error_count + 1
 
-    def _thread_poll(self, poll_period=1.0):
-        done = False
-        while not self._done and not done:
+    def _get_update_key(self):
+        try:
+            return get_update_key(self._instance)
+        except Exception:
+            # the VM is updated on its own
+            return None
+
+    def _watch(self, updated=False):
+        """
+        One update of the VM, made by the watcher threads.  updated is True when the VM was already updated along
+        with others.  Return the seconds until the next one, or None once the VM has left the pending states or the
+        pollable is done.
+        """
+        finished = True
+        try:
             try:
-                if self._instance.get_state() not in self._ok_states:
-                    cloudinitd.log(self._log, logging.DEBUG, "%s polling thread done" % (self.get_instance_id()))
-                    done = True
-                # because update is called in start we will sleep first
-                else:
-                    time.sleep(poll_period)
-                    self._update()
-                    cloudinitd.log(self._log, logging.DEBUG, "Current iaas state in thread for %s is %s" % (self.get_instance_id(), self._instance.get_state()))
+                if not self._done:
+                    if not updated:
+                        self._update()
+                    state = self._instance.get_state()
+                    cloudinitd.log(self._log, logging.DEBUG, "Current iaas state in watcher for %s is %s" % (self.get_instance_id(), state))
+                    if state in self._ok_states:
+                        finished = False
+                        return self._poll_period
+                    cloudinitd.log(self._log, logging.DEBUG, "%s watch done" % (self.get_instance_id()))
+                self._unsubscribe()
             except Exception, ex:
                 cloudinitd.log(self._log, logging.ERROR, str(ex), tb=traceback)
                 self.exception = IaaSException(ex)
-                done = True
+                self._unsubscribe()
+        finally:
+            if finished:
+                self._watched.set()
+        return None
 
 class PopenExecutablePollable(Pollable):
     """
@@ -299,6 +623,7 @@ class PopenExecutablePollable(Pollable):
         self._callback = callback
         self._time_delay = datetime.timedelta(seconds=10)
         self._last_run = None
+        self._slot = None
 
     def get_stderr(self):
         """Get and reset the current stderr buffer from any (and all) execed programs.  Good for logging"""
@@ -330,10 +655,12 @@ class PopenExecutablePollable(Pollable):
             Pollable.poll(self)
             return self._poll()
         except TimeoutException, toex:
+            self._free_slot()
             self._exception = toex
             cloudinitd.log(self._log, logging.ERROR, str(toex), tb=traceback)
             raise
         except Exception, ex:
+            self._free_slot()
             cloudinitd.log(self._log, logging.ERROR, str(ex), tb=traceback)
             self._exception = ProcessException(self, ex, self._stdout_str, self._stderr_str)
             raise self._exception
@@ -342,8 +669,13 @@ class PopenExecutablePollable(Pollable):
         if self._done or not self._started:
             return
         # kill it and set the error count to past the max so that it is not retried
-        self._p.terminate()
         self._error_count = self._allowed_errors
+        if self._p is None:
+            # still waiting for a process slot, make sure it never starts
+            self._exception = ProcessException(self, Exception("canceled before it was run"), self._stdout_str, self._stderr_str)
+            return
+        self._free_slot()
+        self._p.terminate()
 
     def _execute_cb(self, action, msg):
         if not self._callback:
@@ -359,10 +691,16 @@ class PopenExecutablePollable(Pollable):
             self._last_run = None
             self._execute_cb(cloudinitd.callback_action_transition, "retrying the command")
             self._run()
+        if self._p is None:
+            # waiting for a process slot
+            self._run()
+            if self._p is None:
+                return False
 
         rc = self._poll_process()
         if rc is None:
             return False
+        self._free_slot()
         self._log.info("process return code %d" % (rc))
         if rc != 0:
             self._error_count = self._error_count + 1
@@ -419,19 +757,195 @@ class PopenExecutablePollable(Pollable):
         return self._stderr_eof and self._stdout_eof
 
     def _run(self):
+        self._p = None
+        if g_process_slots is not None and self._slot is None:
+            self._slot = _get_process_slot(self)
+            if self._slot is None:
+                return
         cloudinitd.log(self._log, logging.DEBUG, "running the command %s" % (str(self._cmd)))
-        self._p = subprocess.Popen(self._cmd, shell=True, stdin=open(os.devnull), stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        try:
+            self._p = subprocess.Popen(self._cmd, shell=True, stdin=open(os.devnull), stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        except:
+            self._free_slot()
+            raise
+
+    def _free_slot(self):
+        """Give back the process slot, if this pollable holds one"""
+        g_process_slots_lock.acquire()
+        try:
+            if self._slot is not None:
+                g_slot_holders.discard(self._slot)
+                self._slot = None
+        finally:
+            g_process_slots_lock.release()
 
     def get_command(self):
         return self._cmd
 
+class ArtifactDistributor(object):
+    """
+    Keeps track of which hosts already hold a copy of a program (by digest) so that replicas can copy it from
+    each other instead of each getting its own upload from the launch host.  The launch host sends a given
+    program to a single host (again only if that copy fails) and every host that has it serves at most fanout
+    others at a time, so the number of copies multiplies by about fanout+1 per round.
+    """
+    def __init__(self, fanout=2):
+        self._fanout = fanout
+        self._holders = {}
+        self._uploading = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, digest, host, direct=False):
+        """
+        Ask for a source to copy digest onto host from.  Returns (True, source) when the copy can begin, a source of
+        None meaning the launch host.  Returns (False, None) when the caller should ask again later.
+        """
+        self._lock.acquire()
+        try:
+            holders = self._holders.setdefault(digest, {})
+            if not direct and host not in holders:
+                for (h, active) in holders.items():
+                    if h != host and active < self._fanout:
+                        holders[h] = active + 1
+                        return (True, h)
+            # a host that already holds it (several services on one VM) finds it in its own cache
+            if direct or host in holders or (not holders and self._uploading.get(digest, 0) == 0):
+                self._uploading[digest] = self._uploading.get(digest, 0) + 1
+                return (True, None)
+            return (False, None)
+        finally:
+            self._lock.release()
+
+    def release(self, digest, host, source, success):
+        """Return the slot handed out by acquire.  On success host becomes a source for others"""
+        self._lock.acquire()
+        try:
+            holders = self._holders.setdefault(digest, {})
+            if source is None:
+                self._uploading[digest] = self._uploading.get(digest, 1) - 1
+            elif source in holders:
+                holders[source] = holders[source] - 1
+            if success and host not in holders:
+                holders[host] = 0
+        finally:
+            self._lock.release()
+
+    def get_holders(self, digest):
+        return self._holders.get(digest, {}).keys()
+
+
+class ArtifactStagePollable(Pollable):
+    """
+    Stage a program on a host with the help of an ArtifactDistributor.  The copy command is not run until the
+    distributor hands out a source.  cmd_factory is called with that source (a host name or None for the launch
+    host) and must return the command to run.  If a copy from another host fails it is tried once more straight
+    from the launch host.
+    """
+    def __init__(self, distributor, digest, host, cmd_factory, log=logging, timeout=600, callback=None, done_cb=None):
+        Pollable.__init__(self, timeout, done_cb=done_cb)
+        self._distributor = distributor
+        self._digest = digest
+        self._host = host
+        self._cmd_factory = cmd_factory
+        self._log = log
+        self._callback = callback
+        self._poller = None
+        self._source = None
+        self._started = False
+        self._done = False
+        self._tried_direct = False
+
+    def get_source(self):
+        return self._source
+
+    def start(self):
+        Pollable.start(self)
+        self._started = True
+        self._try_start()
+
+    def _try_start(self, direct=False):
+        (ok, source) = self._distributor.acquire(self._digest, self._host, direct=direct)
+        if not ok:
+            return
+        self._source = source
+        cloudinitd.log(self._log, logging.DEBUG, "staging %s on %s from %s" % (self._digest, self._host, str(source)))
+        self._poller = PopenExecutablePollable(self._cmd_factory(source), log=self._log, allowed_errors=1, callback=self._callback, timeout=self._timeout)
+        self._poller.start()
+
+    def poll(self):
+        if self._exception:
+            raise self._exception
+        if not self._started:
+            raise APIUsageException("You must call start before calling poll.")
+        if self._done:
+            return True
+        try:
+            Pollable.poll(self)
+            if not self._poller:
+                self._try_start()
+                return False
+            rc = self._poller.poll()
+        except Exception, ex:
+            if self._poller:
+                self._poller = self._copy_failed(ex)
+                if self._poller:
+                    return False
+            self._exception = ex
+            raise
+        if not rc:
+            return False
+        self._distributor.release(self._digest, self._host, self._source, True)
+        self._done = True
+        self._execute_done_cb()
+        return True
+
+    def _copy_failed(self, ex):
+        self._distributor.release(self._digest, self._host, self._source, False)
+        if self._source is None or self._tried_direct or isinstance(ex, TimeoutException):
+            return None
+        cloudinitd.log(self._log, logging.WARN, "copying from %s failed, uploading from the launch host: %s" % (self._source, str(ex)))
+        self._tried_direct = True
+        self._try_start(direct=True)
+        return self._poller
+
+    def cancel(self):
+        if self._done or not self._poller:
+            return
+        self._poller.cancel()
+        # give the fan out slot back now, the copy will never finish
+        self._distributor.release(self._digest, self._host, self._source, False)
+        self._exception = ProcessException(self, Exception("canceled"), self.get_stdout(), self.get_stderr())
+        self._poller = None
+
+    def get_stdout(self):
+        if not self._poller:
+            return ""
+        return self._poller.get_stdout()
+
+    def get_stderr(self):
+        if not self._poller:
+            return ""
+        return self._poller.get_stderr()
+
+    def get_output(self):
+        return self.get_stderr() + os.linesep + self.get_stdout()
+
+    def get_command(self):
+        if not self._poller:
+            return None
+        return self._poller.get_command()
+
+
 class MultiLevelPollable(Pollable):
     """
     This pollable object monitors a set of pollable levels.  Each level is a list of pollable objects.   When all
     pollables in a list are complete, the next level is polled.  When all levels are completed this pollable is
     considered complete
+
+    When pipeline is True the pollables in the levels that have not yet been started are given a chance to do
+    their independent work early via pre_poll().
     """
-    def __init__(self, log=logging, timeout=0, callback=None, continue_on_error=False):
+    def __init__(self, log=logging, timeout=0, callback=None, continue_on_error=False, pipeline=False):
         Pollable.__init__(self, timeout)
         self.levels = []
         self.level_times = []
@@ -450,6 +964,7 @@ class MultiLevelPollable(Pollable):
         self.last_exception = None
         self._canceled = False
         self._current_level_start = None
+        self._pipeline = pipeline
 
     def get_level(self):
         return self.level_ndx + 1
@@ -520,6 +1035,9 @@ class MultiLevelPollable(Pollable):
                     self._level_error_polls.append(p)
                     cloudinitd.log(self._log, logging.ERROR, "Multilevel poll error %s" % (str(ex)), traceback)
 
+        if self._pipeline:
+            self._pre_poll_levels()
+
         if done:
             # see if the level had an error
             cb_action = cloudinitd.callback_action_complete
@@ -552,6 +1070,11 @@ class MultiLevelPollable(Pollable):
             self._start()
         return False
 
+    def _pre_poll_levels(self):
+        for level in self.levels[self.level_ndx+1:]:
+            for p in level:
+                p.pre_poll()
+
     def _execute_cb(self, action, lvl):
         if not self._callback:
             return
@@ -586,7 +1109,146 @@ class MultiLevelPollable(Pollable):
             lvl = self.levels[i]
             for p in lvl:
                 p.cancel()
+        # in pipelined mode the later levels may have work in flight
+        if self._pipeline:
+            for lvl in self.levels[self.level_ndx+1:]:
+                for p in lvl:
+                    p.cancel()
+
+        self._canceled = True
+
+
+class ParallelLevelPollable(MultiLevelPollable):
+    """
+    A MultiLevelPollable that does not wait for a level to complete before starting the pollables of the next
+    one.  It is meant for checks, like status, that have no ordering requirement.  At most max_parallel pollables
+    are run at once (0 means no limit) and they are started in level order.  Level callbacks are still made in
+    level order: a level is reported once all of its pollables and all of the levels before it are done.
 
+    When depends_on is given, depends_on(p) returns the pollables that p must wait for.  p is started once all of
+    them have finished, successfully or not.  They must be in the same or earlier levels.
+    """
+    def __init__(self, log=logging, timeout=0, callback=None, continue_on_error=False, max_parallel=0, depends_on=None):
+        MultiLevelPollable.__init__(self, log=log, timeout=timeout, callback=callback, continue_on_error=continue_on_error)
+        self._max_parallel = max_parallel
+        self._depends_on = depends_on
+        self._waiting = []
+        self._running = []
+        self._level_pending = []
+        self._level_start_times = []
+        self._level_errors = []
+
+    def _callback_level(self, ndx):
+        if self._reversed:
+            return len(self.levels) - ndx - 1
+        return ndx
+
+    def start(self):
+        Pollable.start(self)
+        if self.level_ndx >= 0:
+            return
+
+        self.level_ndx = 0
+        for ndx in range(0, len(self.levels)):
+            self._level_pending.append(len(self.levels[ndx]))
+            self._level_start_times.append(None)
+            self._level_errors.append(([], []))
+            for p in self.levels[ndx]:
+                self._waiting.append((ndx, p))
+        self._start_waiting()
+        self._report_levels()
+
+    def _is_blocked(self, p):
+        if not self._depends_on:
+            return False
+        unfinished = [q for (ndx, q) in self._waiting + self._running]
+        for d in self._depends_on(p):
+            if d is not p and d in unfinished:
+                return True
+        return False
+
+    def _start_waiting(self):
+        for (ndx, p) in self._waiting[:]:
+            if self._max_parallel and len(self._running) >= self._max_parallel:
+                break
+            if self._is_blocked(p):
+                continue
+            self._waiting.remove((ndx, p))
+            if self._level_start_times[ndx] is None:
+                self._level_start_times[ndx] = datetime.datetime.now()
+                self._execute_cb(cloudinitd.callback_action_started, self._callback_level(ndx))
+            try:
+                p.start()
+                self._running.append((ndx, p))
+            except Exception, ex:
+                self._pollable_failed(ndx, p, ex)
+
+    def _pollable_failed(self, ndx, p, ex):
+        self._exception_occurred = True
+        self.last_exception = PollableException(p, ex)
+        self._level_errors[ndx][0].append(self.last_exception)
+        self._level_errors[ndx][1].append(p)
+        self._level_pending[ndx] = self._level_pending[ndx] - 1
+        cloudinitd.log(self._log, logging.ERROR, "Multilevel poll error %s" % (str(ex)), traceback)
+
+    def poll(self):
+        if self.exception and not self._continue_on_error:
+            raise self.exception
+        if self.level_ndx < 0:
+            raise APIUsageException("You must call start before calling poll.")
+        if self._done:
+            return True
+        Pollable.poll(self)
+
+        for (ndx, p) in self._running[:]:
+            try:
+                rc = p.poll()
+            except Exception, ex:
+                self._running.remove((ndx, p))
+                self._pollable_failed(ndx, p, ex)
+                continue
+            if rc:
+                self._running.remove((ndx, p))
+                self._level_pending[ndx] = self._level_pending[ndx] - 1
+        self._start_waiting()
+        return self._report_levels()
+
+    def _report_levels(self):
+        while self.level_ndx < len(self.levels) and self._level_pending[self.level_ndx] == 0:
+            ndx = self.level_ndx
+            end_time = datetime.datetime.now()
+            start_time = self._level_start_times[ndx] or end_time
+            self.level_times.append(end_time - start_time)
+
+            cb_action = cloudinitd.callback_action_complete
+            (error_exs, error_polls) = self._level_errors[ndx]
+            if error_polls:
+                cb_action = cloudinitd.callback_action_error
+                exception = MultilevelException(error_exs, error_polls, ndx)
+                self.last_exception = exception
+                if not self._continue_on_error:
+                    self._execute_cb(cloudinitd.callback_action_error, self._callback_level(ndx))
+                    self.exception = exception
+                    raise exception
+                self._all_level_error_exs.append(error_exs)
+
+            self._execute_cb(cb_action, self._callback_level(ndx))
+            self.level_ndx = self.level_ndx + 1
+
+        if self.level_ndx == len(self.levels):
+            self._done = True
+            return True
+        return False
+
+    def cancel(self):
+        if self._canceled:
+            return
+        for (ndx, p) in self._running:
+            p.cancel()
+        # whatever has not been started never will be
+        while self._waiting:
+            (ndx, p) = self._waiting.pop(0)
+            self._pollable_failed(ndx, p, Exception("canceled before it was started"))
         self._canceled = True
 
 
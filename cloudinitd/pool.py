@@ -0,0 +1,223 @@
+"""
+A warm pool of idle VMs.  Services claim a VM from the pool when they boot instead of launching a new one and
+waiting for it to reach the running state.  The pool is kept in its own database, <db dir>/cloudinitd-pool.db,
+so that it is shared by every run using that directory.  VMs are pooled by everything that goes into launching
+them: the cloud and its credentials, the image, the allocation, the key name and the security groups.
+"""
+import datetime
+import hashlib
+import logging
+import os
+import stat
+import threading
+import traceback
+
+import cloudinitd
+import cloudinitd.persistence
+from cloudinitd.cb_iaas import iaas_get_con
+
+
+# the service values that decide what VM is launched
+g_template_keys = ["iaas", "iaas_url", "iaas_key", "iaas_secret", "image", "allocation", "keyname", "securitygroups", "localkey"]
+
+
+class PoolInstanceObject(object):
+
+    def __init__(self, pool_key, instance_id, template):
+        self.pool_key = pool_key
+        self.instance_id = instance_id
+        for k in g_template_keys:
+            setattr(self, k, template.get_dep(k))
+
+
+# like the run tables the pool table is only made, by _load_orm(), when a pool is opened
+pool_metadata = None
+pool_table = None
+
+
+def _load_orm():
+    global pool_metadata, pool_table
+
+    cloudinitd.persistence.g_orm_lock.acquire()
+    try:
+        if pool_metadata is not None:
+            return
+        from sqlalchemy import Table, Column, Integer, String, MetaData, Sequence, types
+        from sqlalchemy.orm import mapper
+
+        md = MetaData()
+        pool_table = Table('pool_instance', md,
+            Column('id', Integer, Sequence('pool_id_seq'), primary_key=True),
+            Column('pool_key', String(64)),
+            Column('instance_id', String(64)),
+            Column('image', String(32)),
+            Column('allocation', String(64)),
+            Column('iaas', String(32)),
+            Column('iaas_url', String(64)),
+            Column('iaas_key', String(64)),
+            Column('iaas_secret', String(64)),
+            Column('keyname', String(32)),
+            Column('securitygroups', String(1024)),
+            Column('localkey', String(1024)),
+            Column('timestamp', types.TIMESTAMP(), default=datetime.datetime.now),
+            )
+        mapper(PoolInstanceObject, pool_table)
+        pool_metadata = md
+    finally:
+        cloudinitd.persistence.g_orm_lock.release()
+
+
+class PoolTemplate(object):
+    """
+    Everything needed to launch a VM for a service, copied out of the service so that it can be used from another
+    thread.  It stands in for the service when talking to the IaaS.
+    """
+
+    def __init__(self, values, name="pool"):
+        self._values = values
+        self.name = name
+
+    def get_dep(self, key):
+        return self._values.get(key)
+
+    def get_key(self):
+        vals = [str(self._values.get(k)) for k in g_template_keys]
+        return hashlib.sha1("/".join(vals)).hexdigest()
+
+
+def make_template(svc):
+    values = {}
+    for k in g_template_keys:
+        values[k] = svc.get_dep(k)
+    return PoolTemplate(values, name=svc.name)
+
+
+class WarmPool(object):
+
+    def __init__(self, db_dir, size, log=logging):
+        """
+        db_dir: the directory holding the pool database (the same one the runs use)
+
+        size: the number of idle VMs to keep in each pool that a service claims from
+        """
+        _load_orm()
+        import sqlalchemy
+        from sqlalchemy.orm import sessionmaker
+
+        path = os.path.join(db_dir, "cloudinitd-pool.db")
+        # the pool holds IaaS secrets.  the file is made private before sqlite writes anything to it, an empty file
+        # is an empty database.  a pool db left by an older version is made private too
+        fd = os.open(path, os.O_CREAT | os.O_RDWR, stat.S_IRUSR | stat.S_IWUSR)
+        os.close(fd)
+        os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
+        self._engine = sqlalchemy.create_engine("sqlite:///%s" % (path))
+        pool_metadata.create_all(self._engine)
+        self._Session = sessionmaker(bind=self._engine)
+        self._size = size
+        self._log = log
+        self._templates = {}
+        self._threads = []
+
+    @cloudinitd.LogEntryDecorator
+    def claim(self, svc):
+        """
+        Take an idle VM suitable for svc out of the pool.  None is returned if there is none.  VMs that are no
+        longer pending or running are dropped from the pool along the way.
+        """
+        template = make_template(svc)
+        key = template.get_key()
+        self._templates[key] = template
+
+        session = self._Session()
+        try:
+            rows = session.query(PoolInstanceObject).filter_by(pool_key=key).order_by(PoolInstanceObject.id).all()
+            if not rows:
+                return None
+            con = iaas_get_con(template)
+            found = con.find_instances([r.instance_id for r in rows])
+            for r in rows:
+                inst = found.get(r.instance_id)
+                # another process may have claimed it since the query
+                taken = session.query(PoolInstanceObject).filter_by(id=r.id).delete()
+                session.commit()
+                if taken != 1:
+                    continue
+                if inst is None or inst.get_state() not in ["pending", "running"]:
+                    cloudinitd.log(self._log, logging.INFO, "dropping %s from the pool, it is no longer usable" % (r.instance_id))
+                    continue
+                cloudinitd.log(self._log, logging.INFO, "%s claimed the pooled VM %s" % (svc.name, r.instance_id))
+                return inst
+            return None
+        finally:
+            session.close()
+
+    @cloudinitd.LogEntryDecorator
+    def replenish(self):
+        """
+        Start topping up every pool claimed from through this object (since the last call) to size idle VMs.  The
+        VMs are launched from background threads, wait() returns once they have all been requested.
+        """
+        for (key, template) in self._templates.items():
+            t = threading.Thread(target=self._fill, args=(key, template))
+            t.start()
+            self._threads.append(t)
+        self._templates = {}
+
+    def _fill(self, key, template):
+        session = self._Session()
+        try:
+            have = session.query(PoolInstanceObject).filter_by(pool_key=key).count()
+            if have >= self._size:
+                return
+            con = iaas_get_con(template)
+            for i in range(have, self._size):
+                inst = con.run_instance()
+                session.add(PoolInstanceObject(key, inst.get_id(), template))
+                session.commit()
+                cloudinitd.log(self._log, logging.INFO, "added %s to the pool" % (inst.get_id()))
+        except Exception, ex:
+            cloudinitd.log(self._log, logging.WARN, "failed to fill the pool: %s" % (str(ex)), tb=traceback)
+        finally:
+            session.close()
+
+    def wait(self):
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    @cloudinitd.LogEntryDecorator
+    def get_instances(self):
+        """Return the records of every idle VM in the pool"""
+        session = self._Session()
+        try:
+            rows = session.query(PoolInstanceObject).order_by(PoolInstanceObject.id).all()
+            session.expunge_all()
+            return rows
+        finally:
+            session.close()
+
+    @cloudinitd.LogEntryDecorator
+    def drain(self):
+        """Terminate every idle VM in the pool and empty it"""
+        session = self._Session()
+        try:
+            groups = {}
+            for r in session.query(PoolInstanceObject).all():
+                if r.pool_key not in groups:
+                    values = dict([(k, getattr(r, k)) for k in g_template_keys])
+                    groups[r.pool_key] = (PoolTemplate(values), [])
+                groups[r.pool_key][1].append(r)
+
+            for (template, rows) in groups.values():
+                try:
+                    con = iaas_get_con(template)
+                    found = con.find_instances([r.instance_id for r in rows])
+                    con.terminate_instances(found.values())
+                except Exception, ex:
+                    cloudinitd.log(self._log, logging.WARN, "failed to terminate the pooled VMs: %s" % (str(ex)), tb=traceback)
+                    continue
+                for r in rows:
+                    session.delete(r)
+            session.commit()
+        finally:
+            session.close()
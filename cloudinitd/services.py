@@ -1,4 +1,6 @@
 
+import datetime
+import hashlib
 import pipes
 import shlex
 import traceback
@@ -6,19 +8,123 @@ import urllib
 import re
 import tempfile
 import string
+import tarfile
 
 import simplejson as json
 
 import cb_iaas
 from cloudinitd.global_deps import get_global
-from cloudinitd.persistence import BagAttrsObject, IaaSHistoryObject
-from cloudinitd.pollables import MultiLevelPollable, InstanceHostnamePollable, PopenExecutablePollable, InstanceTerminatePollable, PortPollable, Pollable
-import bootfabtasks
+from cloudinitd.pollables import MultiLevelPollable, InstanceHostnamePollable, PopenExecutablePollable, InstanceTerminatePollable, PortPollable, Pollable, ArtifactDistributor, ArtifactStagePollable, FallbackPollable, ParallelLevelPollable
 from cloudinitd.exceptions import APIUsageException, ConfigException, ServiceException, MultilevelException
 from cloudinitd.statics import *
 from cloudinitd.cb_iaas import *
 
 
+g_file_digests = {}
+
+
+class AttrBag(object):
+    """
+    The attr bag of a service.  Lookups fall through to a dict that is shared by every replica of the service
+    section and never written to.  Only the values that belong to this service, or that expand differently for
+    it, are kept in its own dict.
+    """
+    __slots__ = ("_base", "_own")
+
+    def __init__(self, base=None):
+        if base is None:
+            base = {}
+        self._base = base
+        self._own = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._own[key]
+        except KeyError:
+            return self._base[key]
+
+    def __setitem__(self, key, value):
+        self._own[key] = value
+
+    def __contains__(self, key):
+        return key in self._own or key in self._base
+
+    def keys(self):
+        keys = self._base.keys()
+        for k in self._own.keys():
+            if k not in self._base:
+                keys.append(k)
+        return keys
+
+
+def get_service_refs(s):
+    """
+    Return a list of (service name, attr name) for every ${svc.attr} reference made by the ServiceRecord s.  The
+    service name is empty for references to s itself and is "global" for global variables.
+    """
+    pattern = re.compile('\$\{(.*?)\.(.*?)\}')
+    vals = [s.hostname, s.bootpgm, s.bootpgm_args, s.readypgm, s.readypgm_args, s.terminatepgm, s.terminatepgm_args]
+    vals = vals + [v for (k, v) in s.get_all_attrs()]
+    refs = []
+    for val in vals:
+        if not val:
+            continue
+        for ref in pattern.findall(str(val)):
+            if ref not in refs:
+                refs.append(ref)
+    return refs
+
+
+def get_file_digest(path):
+    """
+    Return the sha1 hex digest of a local file, or None if there is no such file.  Digests are kept for the
+    life of the process and are only recomputed when the file changes.
+    """
+    global g_file_digests
+
+    if not path or not os.path.isfile(path):
+        return None
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime)
+    if key not in g_file_digests:
+        h = hashlib.sha1()
+        f = open(path, "rb")
+        try:
+            while True:
+                b = f.read(1024 * 1024)
+                if not b:
+                    break
+                h.update(b)
+        finally:
+            f.close()
+        g_file_digests[key] = h.hexdigest()
+    return g_file_digests[key]
+
+def bundle_files(members, prefix="conf_", dir=None):
+    """
+    Pack a list of (name, path) pairs into one compressed tarball so they can be sent to a VM in a single
+    transfer.  Returns (tarball_path, digest).  The digest only covers the names and contents of the files
+    so the same rendered files always get the same digest.
+    """
+    h = hashlib.sha1()
+    (fd, bundle) = tempfile.mkstemp(prefix=prefix, suffix=".tar.gz", dir=dir)
+    os.close(fd)
+    tar = tarfile.open(bundle, "w:gz")
+    try:
+        for (name, path) in members:
+            f = open(path, "rb")
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            h.update("%s %d\n" % (name, len(data)))
+            h.update(data)
+            tar.add(path, arcname=name)
+    finally:
+        tar.close()
+    return (bundle, h.hexdigest())
+
+
 class BootTopLevel(object):
     """
     This class is the top level boot description. It holds the parent Multilevel boot object which contains a set
@@ -27,15 +133,38 @@ class BootTopLevel(object):
     used for querying dependencies
     """
 
-    def __init__(self, level_callback=None, service_callback=None, log=logging, boot=True, ready=True, terminate=False, continue_on_error=False):
+    def __init__(self, level_callback=None, service_callback=None, log=logging, boot=True, ready=True, terminate=False, continue_on_error=False, pipeline=False, fanout=0, ready_max_age=None, parallel=0, pool=None, resume=False):
         self.services = {}
         self._log = log
-        self._multi_top = MultiLevelPollable(log=log, callback=level_callback, continue_on_error=continue_on_error)
+        if parallel and ready and not boot and not terminate:
+            # a ready check configures nothing so the levels need not wait on each other
+            self._multi_top = ParallelLevelPollable(log=log, callback=level_callback, continue_on_error=continue_on_error, max_parallel=parallel)
+        elif parallel and boot:
+            # a booting service only has to wait for the services whose attributes it uses
+            self._multi_top = ParallelLevelPollable(log=log, callback=level_callback, continue_on_error=continue_on_error, max_parallel=parallel, depends_on=self._get_dep_services)
+        else:
+            self._multi_top = MultiLevelPollable(log=log, callback=level_callback, continue_on_error=continue_on_error, pipeline=pipeline)
         self._continue_on_error = continue_on_error
         self._service_callback = service_callback
         self._boot = boot
         self._ready = ready
         self._terminate = terminate
+        self._pipeline = pipeline
+        self._distributor = None
+        if fanout:
+            self._distributor = ArtifactDistributor(fanout)
+        self._ready_max_age = ready_max_age
+        self._pool = pool
+        self._resume = resume
+
+    def get_distributor(self):
+        return self._distributor
+
+    def _get_dep_services(self, svc):
+        return [self.services[name] for name in svc.get_dep_service_names() if name in self.services]
+
+    def get_pool(self):
+        return self._pool
 
     @cloudinitd.LogEntryDecorator
     def reverse_order(self):
@@ -79,7 +208,7 @@ class BootTopLevel(object):
         return self._multi_top.poll()
 
     @cloudinitd.LogEntryDecorator
-    def new_service(self, s, db, boot=None, ready=None, terminate=None, log=None, logfile=None, run_name=None):
+    def new_service(self, s, db, boot=None, ready=None, terminate=None, log=None, logfile=None, run_name=None, keep_vm=False):
 
         if s.name in self.services.keys():
             raise APIUsageException("A service by the name of %s is already know to this boot configuration.  Please check your config files and try another name" % (s.name))
@@ -98,7 +227,7 @@ class BootTopLevel(object):
         self._logfile = logfile
 
         # logname = <log dir>/<runname>/s.name
-        svc = SVCContainer(db, s, self, log=log, callback=self._service_callback, boot=boot, ready=ready, terminate=terminate, logfile=self._logfile, run_name=run_name)
+        svc = SVCContainer(db, s, self, log=log, callback=self._service_callback, boot=boot, ready=ready, terminate=terminate, logfile=self._logfile, run_name=run_name, pipeline=self._pipeline, ready_max_age=self._ready_max_age, resume=self._resume, keep_vm=keep_vm)
         self.services[s.name] = svc
         return svc
 
@@ -148,11 +277,11 @@ class SVCContainer(Pollable):
     that consists of up to 3 other pollable types  a level pollable is used to keep the other MultiLevelPollable moving in order
     """
 
-    def __init__(self, db, s, top_level, boot=True, ready=True, terminate=False, log=logging, callback=None, reload=False, logfile=None, run_name=None):
+    def __init__(self, db, s, top_level, boot=True, ready=True, terminate=False, log=logging, callback=None, reload=False, logfile=None, run_name=None, pipeline=False, ready_max_age=None, resume=False, keep_vm=False):
         Pollable.__init__(self)
 
         self._log = log
-        self._attr_bag = {}
+        self._attr_bag = AttrBag(s.layer)
         self._myname = s.name
 
         # we need to separate out pollables.  bootconf and ready cannot be run until the instances has a hostname
@@ -165,6 +294,11 @@ class SVCContainer(Pollable):
         self._db = db
         self._top_level = top_level
         self._logfile = logfile
+        self._pipeline = pipeline
+        self._ready_max_age = ready_max_age
+        self._resume = resume
+        self._keep_vm = keep_vm
+        self._iaas_state = None
 
         # if we are reloading we need to examine the current state to see where things let off
         if reload:
@@ -175,7 +309,6 @@ class SVCContainer(Pollable):
         self._stagedir = "%s/%s" % (get_remote_working_dir(), self.name)
         self._validate_and_reinit(boot=boot, ready=ready, terminate=terminate, callback=callback, repair=reload)
 
-        self._db.db_commit()
         self._restart_limit = 2
         self._restart_count = 0
 
@@ -194,10 +327,19 @@ class SVCContainer(Pollable):
         self.last_exception = None
         self.exception_list = []
         self._port_poller = None
+        self._stage_poller = None
+        self._early_pollables = None
+        self._fast_poller = None
 
     @cloudinitd.LogEntryDecorator
     def _validate_and_reinit(self, boot=True, ready=True, terminate=False, callback=None, repair=False):
-        if boot and self._s.state == cloudinitd.service_state_contextualized and not terminate:
+        # a service booted again on the VM it has (see keep_vm in CloudInitD) runs its boot program again there
+        self._on_own_vm = self._keep_vm and boot and not terminate and self._s.hostname and self._s.state != cloudinitd.service_state_terminated
+        if self._on_own_vm and self._s.state == cloudinitd.service_state_contextualized:
+            self._s.state = cloudinitd.service_state_launched
+
+        # a resumed boot picks up where the service left off, a contextualized service only gets its ready check
+        if boot and self._s.state == cloudinitd.service_state_contextualized and not terminate and not self._resume:
             raise APIUsageException("trying to boot an already contextualized service and not terminating %s %s %s" % (str(boot), str(self._s.state), str(terminate)))
 
         #if self._s.contextualized == 0 and not boot and not terminate and repair:
@@ -225,6 +367,13 @@ class SVCContainer(Pollable):
 
         self._boot_output_file = None
         self._port_poller = None
+        self._stage_poller = None
+        self._fast_poller = None
+
+        # pipelined work done before this service's level is started
+        self._early_pollables = None
+        self._early_started = False
+        self._early_done = False
 
         self._ssh_port = 22
 
@@ -239,7 +388,7 @@ class SVCContainer(Pollable):
         if self._s.image:
             self._s.hostname = None
 #        self._s.instance_id = None
-        self._db.db_commit()
+        self._save()
         cloudinitd.log(self._log, logging.DEBUG, "%s terminate done callback completed" % (self.name))
 
     @cloudinitd.LogEntryDecorator
@@ -288,6 +437,9 @@ class SVCContainer(Pollable):
         if not self._do_boot:
             cloudinitd.log(self._log, logging.INFO, "%s not doing boot, returning early" % (self.name))
             return
+        if self._on_own_vm:
+            cloudinitd.log(self._log, logging.INFO, "%s booting again on %s" % (self.name, self._s.hostname))
+            return
 
         if self._s.image:
             cloudinitd.log(self._log, logging.INFO, "%s launching IaaS %s" % (self.name, self._s.image))
@@ -303,30 +455,111 @@ class SVCContainer(Pollable):
             msg = "A warning has issued regarding your plan.  Please check the log file: %s" % (emsg)
             self._execute_callback(cloudinitd.callback_action_transition, msg)
 
+        pool = self._get_pool()
+        if self._hostname_poller and pool and not self._hostname_poller.get_instance():
+            instance = pool.claim(self)
+            if instance:
+                self._hostname_poller.set_instance(instance)
+                self.new_iaas_instance(instance)
+                self._execute_callback(cloudinitd.callback_action_transition, "Claimed the pooled VM %s for %s" % (instance.get_id(), self.name))
+
         self._term_host_pollers.pre_start()
 
         if self._hostname_poller:
             self._s.instance_id = self._hostname_poller.get_instance_id()
             self._execute_callback(cloudinitd.callback_action_transition, "Have instance id %s for %s" % (self._s.instance_id, self.name))
-            self._s.state = cloudinitd.service_state_launched
-            self._db.db_commit()
+            if self._s.state != cloudinitd.service_state_contextualized or not self._resume:
+                self._s.state = cloudinitd.service_state_launched
+            self._save()
 
         self._iass_started = True
         if self._do_boot:
             self._execute_callback(cloudinitd.callback_action_started, "Started IaaS work for %s" % (self.name))
 
     @cloudinitd.LogEntryDecorator
-    def _make_pollers(self):
-        if self._do_boot or self._do_ready:
-            self._do_attr_bag()
+    def pre_poll(self):
+        """
+        In pipelined mode this is called while earlier levels are still running.  Everything that does not need
+        the attributes of other services is done here: waiting for the hostname, waiting for the ssh port, the
+        first ssh check and uploading the boot program.  Any error is left in the pollers so that it is reported
+        when the level of this service is actually started.
+        """
+        if not self._pipeline or self._running or self._early_done:
+            return True
+        try:
+            rc = self._pre_poll()
+        except Exception, ex:
+            cloudinitd.log(self._log, logging.INFO, "%s early work stopped, it will be finished when its level starts: %s" % (self.name, str(ex)))
+            rc = True
+        if rc:
+            self._early_done = True
+        return rc
 
-        self._ready_poller = None
-        self._boot_poller = None
-        self._terminate_poller = None
-        self._rmdir_poller = None
+    @cloudinitd.LogEntryDecorator
+    def _pre_poll(self):
+        # only fresh boots are pipelined.  restarts and terminates stay in level order
+        if not self._do_boot or self._do_terminate:
+            return True
 
-        self._pollables = MultiLevelPollable(log=self._log)
+        if self._term_host_pollers:
+            if not self._early_started:
+                if not self._iass_started:
+                    self.pre_start_iaas()
+                self._early_started = True
+                self._term_host_pollers.start()
+            if not self._term_host_pollers.poll():
+                return False
+            self._term_host_pollers = None
+
+        if self._early_pollables is None:
+            hostname = self._s.hostname
+            if not hostname or hostname.find("${") >= 0:
+                # the hostname depends on another service
+                return True
+            pollers = self._make_access_pollers()
+            if self._s.bootpgm and self._s.state != cloudinitd.service_state_contextualized and self._s.bootpgm.find("${") < 0:
+                cloudinitd.log(self._log, logging.DEBUG, "%s staging the boot pgm early" % (self.name))
+                self._stage_poller = self._make_stage_poller()
+                pollers.append(self._stage_poller)
+            if not pollers:
+                return True
+            self._early_pollables = MultiLevelPollable(log=self._log)
+            for p in pollers:
+                self._early_pollables.add_level([p])
+            self._early_pollables.start()
+
+        return self._early_pollables.poll()
+
+    def _get_distributor(self):
+        if self._top_level is None or self._s.local_exe:
+            return None
+        return self._top_level.get_distributor()
+
+    def _get_pool(self):
+        if self._top_level is None:
+            return None
+        return self._top_level.get_pool()
+
+    @cloudinitd.LogEntryDecorator
+    def _make_stage_poller(self):
+        """
+        Return a poller that uploads the boot program ahead of the boot.  When the run distributes programs
+        between VMs the source of the copy is picked by the distributor.
+        """
+        distributor = self._get_distributor()
+        digest = get_file_digest(self._expand_attr(self._s.bootpgm))
+        if distributor and digest:
+            host = self._expand_attr(self._s.hostname)
+            return ArtifactStagePollable(distributor, digest, host, self._get_stage_cmd, log=self._log, timeout=self._s.pgm_timeout, callback=self._context_cb)
+        cmd = self._get_stage_cmd()
+        return PopenExecutablePollable(cmd, log=self._log, allowed_errors=0, callback=self._context_cb, timeout=self._s.pgm_timeout)
 
+    @cloudinitd.LogEntryDecorator
+    def _make_access_pollers(self):
+        """
+        Return the list of pollers that check the VM can be reached: the ssh port poller and the first ssh check
+        """
+        pollers = []
         if self._s.state == cloudinitd.service_state_contextualized:
             allowed_es_ssh = 1
         elif self._s.local_exe:
@@ -337,21 +570,54 @@ class SVCContainer(Pollable):
         if (self._do_boot or self._do_ready) and not self._s.local_exe:
             cloudinitd.log(self._log, logging.DEBUG, "Adding the port poller to %s " % (self._s.hostname))
             self._port_poller = PortPollable(self._expand_attr(self._s.hostname), self._ssh_port, retry_count=allowed_es_ssh, log=self._log, timeout=self._s.pgm_timeout)
-            self._pollables.add_level([self._port_poller])
+            pollers.append(self._port_poller)
         if self._do_boot:
             # add the ready command no matter what
             cmd = self._get_ssh_ready_cmd()
             cloudinitd.log(self._log, logging.DEBUG, "Adding a ssh poller %s " % (cmd))
             self._ssh_poller = PopenExecutablePollable(cmd, log=self._log, callback=self._context_cb, timeout=self._s.pgm_timeout, allowed_errors=16)
-            self._pollables.add_level([self._ssh_poller])
+            pollers.append(self._ssh_poller)
+        return pollers
+
+    @cloudinitd.LogEntryDecorator
+    def _make_pollers(self):
+        if self._do_boot or self._do_ready:
+            self._do_attr_bag()
+
+        self._ready_poller = None
+        self._boot_poller = None
+        self._terminate_poller = None
+        self._rmdir_poller = None
+
+        self._pollables = MultiLevelPollable(log=self._log)
+
+        if self._use_fast_ready():
+            cloudinitd.log(self._log, logging.INFO, "%s passed the full ready check at %s, trying a port probe first" % (self.name, str(self._s.last_ready)))
+            probe = PortPollable(self._expand_attr(self._s.hostname), self._ssh_port, retry_count=0, log=self._log, timeout=self._s.pgm_timeout)
+            self._fast_poller = FallbackPollable(probe, self._make_full_ready_poller, log=self._log)
+            self._pollables.add_level([self._fast_poller])
+            self._pollables.start()
+            return
+
+        if self._early_pollables:
+            # the pipelined pollers may still be running, they simply become the first level
+            self._pollables.add_level([self._early_pollables])
+        else:
+            self._stage_poller = None
+            for p in self._make_access_pollers():
+                self._pollables.add_level([p])
 
+        if self._do_boot:
             # if already contextualized, dont do it again (could be problematic).  we probably need to make a rule
             # the contextualization programs MUST handle multiple executions, but we can be as helpful as possible
             if self._s.state == cloudinitd.service_state_contextualized:
                 cloudinitd.log(self._log, logging.DEBUG, "%s is already contextualized" % (self.name))
             else:
                 if self._s.bootpgm:
-                    cmd = self._get_boot_cmd()
+                    if self._stage_poller is None and self._get_distributor():
+                        self._stage_poller = self._make_stage_poller()
+                        self._pollables.add_level([self._stage_poller])
+                    cmd = self._get_boot_cmd(staged=self._stage_poller is not None)
                     cloudinitd.log(self._log, logging.DEBUG, "%s running the boot pgm command %s" % (self.name, cmd))
                     self._boot_poller = PopenExecutablePollable(cmd, log=self._log, allowed_errors=0, callback=self._context_cb, timeout=self._s.pgm_timeout, done_cb=self.context_done_cb)
                     self._pollables.add_level([self._boot_poller])
@@ -362,20 +628,106 @@ class SVCContainer(Pollable):
             cloudinitd.log(self._log, logging.DEBUG, "%s skipping the boot" % (self.name))
 
         if self._do_ready:
-            cmd = self._get_ssh_ready_cmd()
-            self._ssh_poller2 = PopenExecutablePollable(cmd, log=self._log, callback=self._context_cb, allowed_errors=2)
-            self._pollables.add_level([self._ssh_poller2])
-            if self._s.readypgm:
-                cmd = self._get_readypgm_cmd()
-                cloudinitd.log(self._log, logging.DEBUG, "%s running the ready pgm command %s" % (self.name, cmd))
-                self._ready_poller = PopenExecutablePollable(cmd, log=self._log, allowed_errors=1, callback=self._context_cb, timeout=self._s.pgm_timeout)
-                self._pollables.add_level([self._ready_poller])
-            else:
-                cloudinitd.log(self._log, logging.DEBUG, "%s has no ready program" % (self.name))
+            for p in self._make_ready_pollers():
+                self._pollables.add_level([p])
         else:
             cloudinitd.log(self._log, logging.DEBUG, "%s skipping the readypgm" % (self.name))
         self._pollables.start()
 
+    @cloudinitd.LogEntryDecorator
+    def _make_ready_pollers(self):
+        """
+        Return the list of pollers that make up the full ready check: a ssh check and the ready program
+        """
+        cmd = self._get_ssh_ready_cmd()
+        self._ssh_poller2 = PopenExecutablePollable(cmd, log=self._log, callback=self._context_cb, allowed_errors=2)
+        pollers = [self._ssh_poller2]
+        if self._s.readypgm:
+            cmd = self._get_readypgm_cmd()
+            cloudinitd.log(self._log, logging.DEBUG, "%s running the ready pgm command %s" % (self.name, cmd))
+            self._ready_poller = PopenExecutablePollable(cmd, log=self._log, allowed_errors=1, callback=self._context_cb, timeout=self._s.pgm_timeout)
+            pollers.append(self._ready_poller)
+        else:
+            cloudinitd.log(self._log, logging.DEBUG, "%s has no ready program" % (self.name))
+        return pollers
+
+    @cloudinitd.LogEntryDecorator
+    def _make_full_ready_poller(self):
+        self._execute_callback(cloudinitd.callback_action_transition, "%s did not answer the port probe, running the full ready check" % (self.name))
+        mlp = MultiLevelPollable(log=self._log)
+        for p in self._make_access_pollers() + self._make_ready_pollers():
+            mlp.add_level([p])
+        return mlp
+
+    def get_resume_instance_id(self, history_ids):
+        """
+        Return the id of the VM that a resumed boot should pick back up, or None if a VM must be launched.  The VM
+        recorded for the service is used, or failing that the last one launched for it (the boot may have died
+        between the launch and recording it).  history_ids maps service db ids to their last launched VM.
+        """
+        if not self._resume or not self._do_boot or not self._hostname_poller or self._hostname_poller.get_instance():
+            return None
+        if self._s.state == cloudinitd.service_state_terminated:
+            return None
+        if self._s.instance_id:
+            return self._s.instance_id
+        return history_ids.get(self._s.id)
+
+    def reattach(self, instance_id, instance):
+        """
+        Use an already launched VM found by a resumed boot.  A VM that the IaaS no longer knows about or that is
+        terminated is ignored and a new one will be launched.  A VM in any other state may still come back, so
+        rather than launching a second one an IaaSException is raised.
+        """
+        state = None
+        if instance is not None:
+            state = str(instance.get_state()).lower()
+        if state not in [None, "pending", "running", "shutting-down", "terminated"]:
+            raise IaaSException("%s cannot reattach to %s, its state is %s" % (self.name, instance_id, state))
+        if state not in ["pending", "running"]:
+            cloudinitd.log(self._log, logging.INFO, "%s cannot reattach to %s, its state is %s.  A new VM will be launched" % (self.name, instance_id, str(state)))
+            if self._s.state != cloudinitd.service_state_initial:
+                self._s.state = cloudinitd.service_state_initial
+                self._s.hostname = None
+                self._save()
+            return False
+        self._hostname_poller.set_instance(instance)
+        self._execute_callback(cloudinitd.callback_action_transition, "Reattached %s to the VM %s" % (self.name, instance_id))
+        return True
+
+    def set_iaas_state(self, state):
+        """Record the state of the VM as found by a status check made for many services at once"""
+        self._iaas_state = state
+
+    def wants_fast_ready(self):
+        """
+        True when this is a status check that may skip the full ready check because the last one passed less
+        than ready_max_age seconds ago
+        """
+        if self._ready_max_age is None or not self._do_ready or self._do_boot or self._do_terminate:
+            return False
+        if self._s.local_exe or self._s.state != cloudinitd.service_state_contextualized or not self._s.last_ready:
+            return False
+        return datetime.datetime.now() - self._s.last_ready <= datetime.timedelta(seconds=self._ready_max_age)
+
+    def _use_fast_ready(self):
+        if not self.wants_fast_ready():
+            return False
+        if self._s.instance_id and str(self._iaas_state).lower() not in ["running", "active"]:
+            cloudinitd.log(self._log, logging.INFO, "%s the VM state is %s, running the full ready check" % (self.name, str(self._iaas_state)))
+            return False
+        return True
+
+    @cloudinitd.LogEntryDecorator
+    def _record_ready(self):
+        now = datetime.datetime.now()
+        self._s.last_check = now
+        if self._fast_poller is not None and not self._fast_poller.used_fallback():
+            self._execute_callback(cloudinitd.callback_action_transition, "%s answered the port probe, the full ready check passed at %s" % (self.name, str(self._s.last_ready)))
+        else:
+            self._s.last_ready = now
+        self._save()
+
     @cloudinitd.LogEntryDecorator
     def _get_fab_command(self):
         fabexec = "fab"
@@ -388,11 +740,10 @@ class SVCContainer(Pollable):
             fabopts = os.environ['CLOUDINITD_FAB_OPTS']
         except:
             fabopts = ""
-        fabfile = str(bootfabtasks.__file__).strip()
-        cloudinitd.log(self._log, logging.DEBUG, "raw fabfileis: |%s|" % (fabfile))
-        if fabfile[-4:] == ".pyc":
-            fabfile = fabfile[0:-4] + ".py"
-            cloudinitd.log(self._log, logging.DEBUG, "modfiled fabfile is: %s" % (fabfile))
+        # the fab file is found next to this module rather than imported, importing fabric is slow and only the
+        # fab program run below needs it
+        fabfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bootfabtasks.py")
+        cloudinitd.log(self._log, logging.DEBUG, "fabfile is: %s" % (fabfile))
         key_str = ""
         if self._s.localkey:
             key_str = "-i %s" % (self._s.localkey)
@@ -446,7 +797,7 @@ class SVCContainer(Pollable):
         key_str = ""
         if self._s.localkey:
             key_str = "-i %s" % (self._s.localkey)
-        cmd = sshexec + "  -n -T -o BatchMode=yes -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -o PasswordAuthentication=no %s %s%s" % (key_str, user, host)
+        cmd = sshexec + "  -n -T -o BatchMode=yes -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -o PasswordAuthentication=no %s %s %s%s" % (get_ssh_control_opts(), key_str, user, host)
         return cmd
 
     @cloudinitd.LogEntryDecorator
@@ -480,6 +831,17 @@ class SVCContainer(Pollable):
             rc = self._expand_attr(rc)
         return rc
 
+    @cloudinitd.LogEntryDecorator
+    def get_dep_service_names(self):
+        """
+        Return the names of the other services whose attributes this service uses through ${svc.attr} references
+        """
+        names = []
+        for (svc_name, attr_name) in get_service_refs(self._s):
+            if svc_name and svc_name != "global" and svc_name != self.name and svc_name not in names:
+                names.append(svc_name)
+        return names
+
     @cloudinitd.LogEntryDecorator
     def get_dep_keys(self):
         # first parse through the known ones, then hit the attr bag
@@ -527,10 +889,14 @@ class SVCContainer(Pollable):
 
     @cloudinitd.LogEntryDecorator
     def _do_attr_bag(self):
-
-        for bao in self._s.attrs:
-            val = bao.value
-            self._attr_bag[bao.key] = self._expand_attr(val)
+        self._attr_bag = AttrBag(self._s.layer)
+        for (key, val) in self._s.layer.items():
+            # values without a ${} come back as they went in and are left to the shared layer
+            exp_val = self._expand_attr(val)
+            if exp_val is not val:
+                self._attr_bag[key] = exp_val
+        for (key, val) in self._s.attrs:
+            self._attr_bag[key] = self._expand_attr(val)
 
     @cloudinitd.LogEntryDecorator
     def restart(self, boot, ready, terminate, callback=None):
@@ -571,7 +937,9 @@ class SVCContainer(Pollable):
 
             if self._term_host_pollers and not self._iass_started:
                 self.pre_start_iaas()
-            self._term_host_pollers.start()
+            # in pipelined mode the terminate and hostname pollers may already be complete
+            if self._term_host_pollers:
+                self._term_host_pollers.start()
             self._execute_callback(cloudinitd.callback_action_started, "Started %s" % (self.name))
         except Exception, ex:
             self._running = False
@@ -579,8 +947,22 @@ class SVCContainer(Pollable):
                 cloudinitd.log(self._log, logging.ERROR, str(ex), tb=traceback)
                 raise
 
+    def _get_stage(self):
+        if self._do_boot:
+            return "boot"
+        if self._do_terminate:
+            return "terminate"
+        return "ready"
+
+    def _save(self):
+        self._db.save_record(self._s, stage=self._get_stage())
+
     @cloudinitd.LogEntryDecorator
     def _execute_callback(self, state, msg, ex=None):
+        # a status check journals nothing but changes to the service (see save_record), a run that is monitored
+        # does not grow its journal with every check
+        if self._do_boot or self._do_terminate:
+            self._db.add_event(self.name, self._get_stage(), state, msg)
         self.last_exception = ex
         self.exception_list.append(ex)
         if not self._callback:
@@ -609,36 +991,49 @@ class SVCContainer(Pollable):
             msg = ""
             stdout = ""
             stderr = ""
-            if self._ssh_poller in multiex.pollable_list:
+            failed_list = multiex.pollable_list
+            if self._early_pollables and self._early_pollables in failed_list:
+                early_ex = self._early_pollables.last_exception
+                if isinstance(early_ex, MultilevelException):
+                    failed_list = failed_list + early_ex.pollable_list
+            if self._fast_poller and self._fast_poller in failed_list:
+                fast_ex = self._fast_poller.get_exception()
+                if isinstance(fast_ex, MultilevelException):
+                    failed_list = failed_list + fast_ex.pollable_list
+            if self._stage_poller in failed_list:
+                msg = "Service %s error uploading the boot program to %s" % (self._myname, self._s.hostname)
+                stdout = self._stage_poller.get_stdout()
+                stderr = self._stage_poller.get_stderr()
+            if self._ssh_poller in failed_list:
                 msg = "Service %s error getting ssh access to %s" % (self._myname, self._s.hostname)
                 stdout = self._ssh_poller.get_stdout()
                 stderr = self._ssh_poller.get_stderr()
-            if self._ssh_poller2 in multiex.pollable_list:
+            if self._ssh_poller2 in failed_list:
                 msg = "Service %s error getting ssh access to %s." % (self._myname, self._s.hostname)
                 stdout = self._ssh_poller2.get_stdout()
                 stderr = self._ssh_poller2.get_stderr()
-            if self._boot_poller in multiex.pollable_list:
+            if self._boot_poller in failed_list:
                 msg = "Service %s error configuring for boot: %s\n%s" % (self._myname, self._s.hostname, msg)
                 stdout = self._boot_poller.get_stdout()
                 stderr = self._boot_poller.get_stderr()
-            if self._ready_poller in multiex.pollable_list:
+            if self._ready_poller in failed_list:
                 msg = "Service %s error running ready program: %s\n%s" % (self._myname, self._s.hostname, msg)
                 stdout = self._ready_poller.get_stdout()
                 stderr = self._ready_poller.get_stderr()
-            if self._shutdown_poller in multiex.pollable_list:
+            if self._shutdown_poller in failed_list:
                 msg = "Service %s error running shutdown on iaas: %s\n%s" % (self._myname, self._s.hostname, msg)
                 stdout = ""
                 stderr = ""
-            if self._rmdir_poller in multiex.pollable_list:
+            if self._rmdir_poller in failed_list:
                 msg = "Service %s error running rmdir program on: %s\n%s" % (self._myname, self._s.hostname, msg)
                 stdout = self._rmdir_poller.get_stdout()
                 stderr = self._rmdir_poller.get_stderr()
-            if self._terminate_poller in multiex.pollable_list:
+            if self._terminate_poller in failed_list:
                 msg = "Service %s error running terminate program on: %s\n%s" % (self._myname, self._s.hostname, msg)
                 stdout = self._terminate_poller.get_stdout()
                 stderr = self._terminate_poller.get_stderr()
 
-            if self._port_poller in multiex.pollable_list:
+            if self._port_poller in failed_list:
                 msg = "the poller that attempted to connect to the ssh port on %s failed for %s\n%s" % (self._s.hostname, self._myname, msg)
                 stdout = ""
                 stderr = ""
@@ -650,7 +1045,7 @@ class SVCContainer(Pollable):
         except Exception, ex:
             cloudinitd.log(self._log, logging.ERROR, "%s" % (str(ex)), traceback)
             self._s.last_error = str(ex)
-            self._db.db_commit()
+            self._save()
             self._running = False
             if not self._execute_callback(cloudinitd.callback_action_error, str(ex), ex):
                 raise ServiceException(ex, self)
@@ -686,6 +1081,8 @@ class SVCContainer(Pollable):
             rc = self._pollables.poll()
             if rc:
                 self._running = False
+                if self._do_ready:
+                    self._record_ready()
                 self._execute_done_cb()  # on parent object for timings mostly
                 self._execute_callback(cloudinitd.callback_action_complete, "Service Complete")
                 poller_list = [self._ssh_poller, self._ssh_poller2, self._boot_poller, ]
@@ -715,20 +1112,19 @@ class SVCContainer(Pollable):
             return
         for k in j_doc.keys():
             self._attr_bag[k] = j_doc[k]
-            bao = BagAttrsObject(k, j_doc[k])
-            self._s.attrs.append(bao)
+            self._s.add_attr(k, j_doc[k])
 
     @cloudinitd.LogEntryDecorator
     def context_done_cb(self, poller):
         self._read_boot_output()
         self._s.state = cloudinitd.service_state_contextualized
-        self._db.db_commit()
+        self._save()
         cloudinitd.log(self._log, logging.DEBUG, "%s hit context_done_cb callback" % (self.name))
 
     @cloudinitd.LogEntryDecorator
     def _hostname_poller_done(self, poller):
         self._s.hostname = self._hostname_poller.get_hostname()
-        self._db.db_commit()
+        self._save()
         self._execute_callback(cloudinitd.callback_action_transition, "Have hostname %s" % self._s.hostname)
         cloudinitd.log(self._log, logging.DEBUG, "%s hit _hostname_poller_done callback instance %s" % (self.name, self._s.instance_id))
 
@@ -762,12 +1158,22 @@ class SVCContainer(Pollable):
         if readypgm_args:
             readypgm_args = urllib.quote(readypgm_args)
 
-        cmd = self._get_fab_command() + " 'readypgm:hosts=%s,pgm=%s,args=%s,stagedir=%s,local_exe=%s'" % (host, readypgm, readypgm_args, self._stagedir, str(self._s.local_exe))
+        cmd = self._get_fab_command() + " 'readypgm:hosts=%s,pgm=%s,args=%s,stagedir=%s,local_exe=%s,digest=%s,cachedir=%s'" % (host, readypgm, readypgm_args, self._stagedir, str(self._s.local_exe), get_file_digest(readypgm), get_remote_cache_dir())
         cloudinitd.log(self._log, logging.DEBUG, "Using ready pgm command %s" % (cmd))
         return cmd
 
     @cloudinitd.LogEntryDecorator
-    def _get_boot_cmd(self):
+    def _get_stage_cmd(self, peer=None):
+        host = self._expand_attr(self._s.hostname)
+        bootpgm = self._expand_attr(self._s.bootpgm)
+        if peer and self._s.username:
+            peer = "%s@%s" % (self._s.username, peer)
+        cmd = self._get_fab_command() + " 'stagepgm:hosts=%s,pgm=%s,stagedir=%s,remotedir=%s,local_exe=%s,digest=%s,cachedir=%s,peer=%s'" % (host, bootpgm, self._stagedir, get_remote_working_dir(), str(self._s.local_exe), get_file_digest(bootpgm), get_remote_cache_dir(), peer)
+        cloudinitd.log(self._log, logging.DEBUG, "Using stage pgm command %s" % (cmd))
+        return cmd
+
+    @cloudinitd.LogEntryDecorator
+    def _get_boot_cmd(self, staged=False):
         host = self._expand_attr(self._s.hostname)
 
         bootpgm = self._expand_attr(self._s.bootpgm)
@@ -788,7 +1194,24 @@ class SVCContainer(Pollable):
                 cloudinitd.log(self._log, logging.WARN, "Failed to convert bootconf to env file", tb=traceback)
                 bootenv_file = None
 
-        cmd = self._get_fab_command() + " 'bootpgm:hosts=%s,pgm=%s,args=%s,conf=%s,env_conf=%s,output=%s,stagedir=%s,remotedir=%s,local_exe=%s'" % (host, bootpgm, bootpgm_args,  bootconf, bootenv_file, self._boot_output_file, self._stagedir, get_remote_working_dir(), str(self._s.local_exe))
+        # remote configs go over as a single compressed bundle which is skipped if the VM already has it
+        confbundle = None
+        confdigest = None
+        if bootconf and not self._s.local_exe:
+            members = [("bootconf.json", bootconf)]
+            if bootenv_file:
+                members.append(("bootenv.sh", bootenv_file))
+            if self._logfile is None:
+                dir = None
+            else:
+                dir = os.path.dirname(self._logfile)
+            (confbundle, confdigest) = bundle_files(members, prefix=self.name + "_conf_", dir=dir)
+            for (name, path) in members:
+                os.remove(path)
+            bootconf = None
+            bootenv_file = None
+
+        cmd = self._get_fab_command() + " 'bootpgm:hosts=%s,pgm=%s,args=%s,conf=%s,env_conf=%s,output=%s,stagedir=%s,remotedir=%s,local_exe=%s,staged=%s,digest=%s,cachedir=%s,confbundle=%s,confdigest=%s'" % (host, bootpgm, bootpgm_args,  bootconf, bootenv_file, self._boot_output_file, self._stagedir, get_remote_working_dir(), str(self._s.local_exe), str(staged), get_file_digest(bootpgm), get_remote_cache_dir(), confbundle, confdigest)
         cloudinitd.log(self._log, logging.DEBUG, "Using boot pgm command %s" % (cmd))
         return cmd
 
@@ -801,7 +1224,7 @@ class SVCContainer(Pollable):
         if terminatepgm_args:
             terminatepgm_args = urllib.quote(terminatepgm_args)
 
-        cmd = self._get_fab_command() + " readypgm:hosts=%s,pgm=%s,args=%s,stagedir=%s,local_exe=%s" % (host, terminatepgm, terminatepgm_args, self._stagedir, str(self._s.local_exe))
+        cmd = self._get_fab_command() + " readypgm:hosts=%s,pgm=%s,args=%s,stagedir=%s,local_exe=%s,digest=%s,cachedir=%s" % (host, terminatepgm, terminatepgm_args, self._stagedir, str(self._s.local_exe), get_file_digest(terminatepgm), get_remote_cache_dir())
         cloudinitd.log(self._log, logging.DEBUG, "Using terminate pgm command %s" % (cmd))
         return cmd
 
@@ -874,13 +1297,12 @@ class SVCContainer(Pollable):
             self._pollables.cancel()
         if self._term_host_pollers:
             self._term_host_pollers.cancel()
+        if self._early_pollables:
+            self._early_pollables.cancel()
 
     @cloudinitd.LogEntryDecorator
     def new_iaas_instance(self, instance):
-        h = IaaSHistoryObject(instance.get_id())
-        self._db.db_obj_add(h)
-        self._db.db_commit()
-        self._s.history.append(h)
+        self._db.add_iaas_history(self._s, instance.get_id())
 
     @cloudinitd.LogEntryDecorator
     def generate_attr_doc(self):
@@ -16,3 +16,13 @@ def get_remote_working_dir():
         return os.environ[REMOTE_WORKING_DIR_ENV_STR]
     return REMOTE_WORKING_DIR
 
+def get_remote_cache_dir():
+    return get_remote_working_dir() + "/cache"
+
+SSH_CONTROL_DIR_ENV_STR = "CLOUDINITD_SSH_CONTROL_DIR"
+
+def get_ssh_control_opts():
+    """ssh options to share one master connection per host, empty unless a control directory is set in the env"""
+    if SSH_CONTROL_DIR_ENV_STR not in os.environ:
+        return ""
+    return "-o ControlMaster=auto -o ControlPersist=600 -o ControlPath=%s/%%r@%%h:%%p" % (os.environ[SSH_CONTROL_DIR_ENV_STR])
@@ -29,13 +29,98 @@ import uuid
 import time
 import logging
 import stat
+import threading
 import cb_iaas
-from cloudinitd.exceptions import APIUsageException, ServiceException
+import cloudinitd.pollables
+from cloudinitd.exceptions import APIUsageException, ServiceException, IaaSException
 from cloudinitd.persistence import CloudInitDDB
+from cloudinitd.pool import WarmPool
 from cloudinitd.services import BootTopLevel
 import cloudinitd
 
 
+g_db_cache = None
+
+def enable_db_cache():
+    """
+    Keep every run db that is opened in memory, along with its loaded plan, so that later CloudInitD objects for
+    the same run skip reopening and reloading it.  A cached run is reloaded when its db file is changed by
+    another process.  This is meant for long running processes like 'cloudinitd serve'.
+    """
+    global g_db_cache
+    if g_db_cache is None:
+        g_db_cache = {}
+
+def flush_db_cache():
+    """Commit the cached runs and forget the ones whose db file is gone"""
+    global g_db_cache
+    if g_db_cache is None:
+        return
+    for db_path in g_db_cache.keys():
+        db = g_db_cache[db_path]
+        if not os.path.exists(db_path):
+            db.close()
+            del g_db_cache[db_path]
+            continue
+        db.db_commit()
+
+def _open_db(db_path, config_file):
+    global g_db_cache
+    dburl = "sqlite:///%s" % (db_path)
+    if g_db_cache is None:
+        db = CloudInitDDB(dburl)
+        os.chmod(db_path, stat.S_IRUSR | stat.S_IWUSR)
+    else:
+        db = g_db_cache.get(db_path)
+        if db is not None and (config_file or db.is_stale()):
+            db.close()
+            db = None
+        if db is None:
+            db = CloudInitDDB(dburl)
+            os.chmod(db_path, stat.S_IRUSR | stat.S_IWUSR)
+            g_db_cache[db_path] = db
+    if config_file:
+        bo = db.load_from_conf(config_file)
+    else:
+        bo = db.load_from_db()
+    return (db, bo)
+
+def _open_shared_db(dburl, run_name, config_file, fail_if_db_present):
+    db = CloudInitDDB(dburl, run_name=run_name)
+    try:
+        exists = db.has_run()
+        if config_file is None and not exists:
+            raise APIUsageException("There is no run %s in %s.  New runs must be given a config file" % (run_name, dburl))
+        if fail_if_db_present and exists:
+            raise APIUsageException("Already exists: '%s' in %s" % (run_name, dburl))
+        if db.get_db_file():
+            os.chmod(db.get_db_file(), stat.S_IRUSR | stat.S_IWUSR)
+        if config_file:
+            bo = db.load_from_conf(config_file)
+        else:
+            bo = db.load_from_db()
+    except:
+        db.close()
+        raise
+    return (db, bo)
+
+def list_runs(db_dir, dburl=None):
+    """
+    Return the names of the runs kept in db_dir, or in the shared store at dburl when it is given
+    """
+    if dburl:
+        db = CloudInitDDB(dburl)
+        try:
+            return db.get_run_names()
+        finally:
+            db.close()
+    names = []
+    for f in sorted(os.listdir(db_dir)):
+        if f.find("cloudinitd-") == 0 and f[-3:] == ".db" and f != "cloudinitd-pool.db":
+            names.append(f[len("cloudinitd-"):-3])
+    return names
+
+
 class CloudInitD(object):
     """
         This class is the top level boot description. It holds the parent Multilevel boot object which contains a set
@@ -44,7 +129,7 @@ class CloudInitD(object):
         used for querying dependencies
     """
 
-    def __init__(self, db_dir, config_file=None, db_name=None, log_level="warn", logdir=None, level_callback=None, service_callback=None, boot=True, ready=True, terminate=False, continue_on_error=False, fail_if_db_present=False):
+    def __init__(self, db_dir, config_file=None, db_name=None, log_level="warn", logdir=None, level_callback=None, service_callback=None, boot=True, ready=True, terminate=False, continue_on_error=False, fail_if_db_present=False, pipeline=False, fanout=0, ready_max_age=None, parallel=0, services=None, pool_size=0, dburl=None, resume=False, keep_vm=None):
         """
         db_dir:     a path to a directories where databases can be stored.
 
@@ -83,6 +168,56 @@ class CloudInitD(object):
 
         fail_if_db_present=False: instructs the constructor that the caller expects DB present already
 
+        pipeline=False: while a level is running, do the work of the services in later levels that does
+                        not depend on other services (waiting for hostnames and ssh, uploading the
+                        boot programs).  Only the steps that need attributes of other services wait
+                        for the previous level to complete.
+
+        fanout=0: when non zero a boot program shared by several services is
+                  uploaded from here only once.  The other VMs copy it from a
+                  VM that already has it, each VM serving at most fanout copies
+                  at a time.
+
+        ready_max_age=None: when checking the status of a booted plan
+                  (boot=False, ready=True) a service whose full ready check
+                  passed less than this many seconds ago is only checked
+                  with one describe call per IaaS connection and a probe
+                  of its ssh port.  The ssh check and the ready program
+                  are only run if that cheap check fails.
+
+        parallel=0: when checking the status of a booted plan run the
+                  checks of up to this many services at once, without
+                  waiting for the services of earlier levels to finish.
+                  When booting, up to this many services are booted at
+                  once and a service only waits for the services whose
+                  attributes it uses.  It is ignored when terminating.
+
+        services=None: a list of service names.  When given only these
+                  services are booted, checked or terminated.  The other
+                  services of the plan are loaded so that their attributes
+                  can be used, but are otherwise left alone.
+
+        keep_vm=None: a list of service names.  When booting, these
+                  services are not given new VMs.  Their boot programs
+                  are run again on the VMs they have, so that they pick
+                  up new attributes of the services they use.  This
+                  holds even when terminate is set.
+
+        pool_size=0: when booting, services take an idle VM from the warm
+                  pool kept under db_dir instead of launching one.  Once
+                  the boot is complete each pool that was used is topped up
+                  to pool_size idle VMs in the background.
+
+        dburl=None: a SQLAlchemy url of a store shared by many runs.  When
+                  given the run is kept there under its run name instead
+                  of in a file of its own under db_dir.
+
+        resume=False: when booting a run that is already in the db, pick
+                  up where an interrupted boot left off.  Services are
+                  given back the VMs that were launched for them, if they
+                  are still pending or running, instead of new ones, and
+                  contextualized services only get their ready check.
+
         When this object is configured with a config_file a new sqlite
         database is created under @db_dir and a new name is picked for it.
         the data base ends up being called <db_dir>/cloudinitd-<name>.db,
@@ -104,38 +239,52 @@ class CloudInitD(object):
         if not db_name:
             db_name = str(uuid.uuid4()).split("-")[0]
 
-        db_file = "cloudinitd-%s.db" % db_name
-        db_path = os.path.join("/", db_dir, db_file)
-        self._db_path = db_path
-        if config_file is None:
-            if not os.path.exists(db_path):
-                raise APIUsageException("Path to the db does not exist %s.  New dbs must be given a config file" % (db_path))
+        db_path = None
+        if not dburl:
+            db_file = "cloudinitd-%s.db" % db_name
+            db_path = os.path.join("/", db_dir, db_file)
+            if config_file is None:
+                if not os.path.exists(db_path):
+                    raise APIUsageException("Path to the db does not exist %s.  New dbs must be given a config file" % (db_path))
 
-        if fail_if_db_present and os.path.exists(db_path):
-            raise APIUsageException("Already exists: '%s'" % db_path)
+            if fail_if_db_present and os.path.exists(db_path):
+                raise APIUsageException("Already exists: '%s'" % db_path)
+        self._db_path = db_path
 
         (self._log, logfile) = cloudinitd.make_logger(log_level, db_name, logdir=logdir)
 
         self._started = False
+        self._resume = resume
+        self._reattached = False
         self.run_name = db_name
-        dburl = "sqlite:///%s" % (db_path)
 
-        self._db = CloudInitDDB(dburl)
-        os.chmod(db_path, stat.S_IRUSR | stat.S_IWUSR)
-        if config_file:
-            self._bo = self._db.load_from_conf(config_file)
+        if dburl:
+            (self._db, self._bo) = _open_shared_db(dburl, db_name, config_file, fail_if_db_present)
         else:
-            self._bo = self._db.load_from_db()
+            (self._db, self._bo) = _open_db(db_path, config_file)
+        self._records = self._db.get_service_records(self._bo)
+
+        self._pool = None
+        if pool_size and boot:
+            self._pool = WarmPool(db_dir, pool_size, log=self._log)
 
         self._levels = []
-        self._boot_top = BootTopLevel(log=self._log, level_callback=self._mp_cb, service_callback=self._svc_cb, boot=boot, ready=ready, terminate=terminate, continue_on_error=continue_on_error)
-        for level in self._bo.levels:
+        self._boot_top = BootTopLevel(log=self._log, level_callback=self._mp_cb, service_callback=self._svc_cb, boot=boot, ready=ready, terminate=terminate, continue_on_error=continue_on_error, pipeline=pipeline, fanout=fanout, ready_max_age=ready_max_age, parallel=parallel, pool=self._pool, resume=resume)
+        for level in self._records:
             level_list = []
-            for s in level.services:
+            for s in level:
                 try:
                     (s_log, logfile) = cloudinitd.make_logger(log_level, self.run_name, logdir=logdir, servicename=s.name)
 
-                    svc = self._boot_top.new_service(s, self._db, log=s_log, logfile=logfile, run_name=self.run_name)
+                    if services is not None and s.name not in services:
+                        svc = self._boot_top.new_service(s, self._db, boot=False, ready=False, terminate=False, log=s_log, logfile=logfile, run_name=self.run_name)
+                        svc._do_attr_bag()
+                        continue
+
+                    if keep_vm is not None and s.name in keep_vm:
+                        svc = self._boot_top.new_service(s, self._db, terminate=False, log=s_log, logfile=logfile, run_name=self.run_name, keep_vm=True)
+                    else:
+                        svc = self._boot_top.new_service(s, self._db, log=s_log, logfile=logfile, run_name=self.run_name)
 
                     # if boot is not set we assume it was already booted and we expand
                     if not boot:
@@ -157,6 +306,7 @@ class CloudInitD(object):
         self._exception = None
         self._last_exception = None
         self._exception_list = []
+        self._failed_services = []
 
     @cloudinitd.LogEntryDecorator
     def find_dep(self, service_name, key):
@@ -165,10 +315,22 @@ class CloudInitD(object):
     @cloudinitd.LogEntryDecorator
     def get_db_file(self):
         """
-        Return the path to the db file in use.
+        Return the path to the db file in use.  None when the run is kept in a shared store.
         """
         return self._db_path
 
+    @cloudinitd.LogEntryDecorator
+    def remove_db(self):
+        """
+        Delete the record of this run: its db file, or its rows in a shared store.
+        """
+        if self._db_path is None:
+            self._db.delete_run()
+            return
+        if not os.path.exists(self._db_path):
+            raise APIUsageException("That DB does not seem to exist: %s" % (self._db_path))
+        os.remove(self._db_path)
+
     @cloudinitd.LogEntryDecorator
     def _mp_cb(self, mp, action, level_ndx):
         if self._level_callback:
@@ -180,6 +342,8 @@ class CloudInitD(object):
         rc = cloudinitd.callback_return_default
         if action == cloudinitd.callback_action_error:
             self._exception = svc.last_exception
+            if svc.name not in self._failed_services:
+                self._failed_services.append(svc.name)
         if self._service_callback:
             rc = self._service_callback(self, CloudService(self, svc), action, msg)
         return rc
@@ -260,7 +424,9 @@ class CloudInitD(object):
         rc = self._boot_top.poll()
         if rc:
             self._bo.status = 1
-            self._db.db_commit()
+            self._db.save_status(self._bo)
+            if self._pool:
+                self._pool.replenish()
         return rc
 
     @cloudinitd.LogEntryDecorator
@@ -283,66 +449,138 @@ class CloudInitD(object):
         contextualized, and call the ready program for all services.
         """
 
+        self._check_iaas_states()
+        self._reattach_instances()
         self._boot_top.start()
         self._started = True
 
+    @cloudinitd.LogEntryDecorator
+    def _check_iaas_states(self):
+        """
+        Look up the VM state of every service that may skip its full ready check.  One describe call is made per
+        IaaS connection.  A service whose VM cannot be looked up is given no state and gets the full check.
+        """
+        groups = {}
+        for (name, svc) in self._boot_top.get_services():
+            if not svc.wants_fast_ready() or not svc._s.instance_id:
+                continue
+            hash_str = _get_iaas_con_key(svc)
+            if hash_str not in groups:
+                groups[hash_str] = []
+            groups[hash_str].append(svc)
+
+        for svcs in groups.values():
+            ids = [svc._s.instance_id for svc in svcs]
+            try:
+                con = cb_iaas.iaas_get_con(svcs[0])
+                inst_dict = con.find_instances(ids)
+            except Exception, ex:
+                cloudinitd.log(self._log, logging.WARN, "Failed to look up the instances %s: %s" % (str(ids), str(ex)))
+                continue
+            for svc in svcs:
+                inst = inst_dict.get(svc._s.instance_id)
+                if inst is None:
+                    svc.set_iaas_state("missing")
+                else:
+                    svc.set_iaas_state(inst.get_state())
+
+    @cloudinitd.LogEntryDecorator
+    def _reattach_instances(self):
+        """
+        When resuming, look up the VMs that the interrupted boot launched and hand them back to their services.
+        One describe call is made per IaaS connection.  If a lookup fails the resume is aborted, otherwise every
+        VM of that connection would look gone and be launched again.
+        """
+        if not self._resume or self._reattached:
+            return
+        history_ids = self._db.get_last_instance_ids()
+        groups = {}
+        for (name, svc) in self._boot_top.get_services():
+            instance_id = svc.get_resume_instance_id(history_ids)
+            if not instance_id:
+                continue
+            hash_str = _get_iaas_con_key(svc)
+            if hash_str not in groups:
+                groups[hash_str] = []
+            groups[hash_str].append((svc, instance_id))
+
+        for pairs in groups.values():
+            ids = [instance_id for (svc, instance_id) in pairs]
+            try:
+                con = cb_iaas.iaas_get_con(pairs[0][0])
+                inst_dict = con.find_instances(ids)
+            except Exception, ex:
+                msg = "Failed to look up the instances %s, the resume cannot continue: %s" % (str(ids), str(ex))
+                cloudinitd.log(self._log, logging.ERROR, msg)
+                raise IaaSException(msg)
+            for (svc, instance_id) in pairs:
+                svc.reattach(instance_id, inst_dict.get(instance_id))
+        self._reattached = True
+
     @cloudinitd.LogEntryDecorator
     def pre_start_iaas(self):
-        bo = self._bo
-        for level in bo.levels:
-            for s in level.services:
+        self._reattach_instances()
+        for level in self._records:
+            for s in level:
                 svc = self._boot_top.get_service(s.name)
                 svc.pre_start_iaas()
 
     @cloudinitd.LogEntryDecorator
-    def boot_validate(self):
-        bo = self._bo
-        connnections = {}
-        for level in bo.levels:
-            for s in level.services:
+    def boot_validate(self, warnings=None):
+        """
+        Check the plan without launching anything.  A list of (service, exception) is returned with an entry for
+        every problem found.  The checks that need no network (ssh keys, users, image ids) are made for every
+        service in one pass.  Then the credentials of every IaaS connection the plan uses are checked with a cheap
+        authenticated call, all of the connections at the same time.
+
+        warnings: when a list is given a (service, message) is appended to it for each thing in the plan that
+        looks wrong but does not stop it from booting (an unusual image id, an option the IaaS ignores).
+        """
+        exception_list = []
+        groups = {}
+        for level in self._records:
+            for s in level:
                 svc = self._boot_top.get_service(s.name)
+                try:
+                    (rc, msg) = cb_iaas.iaas_validate(svc, self._log)
+                except Exception, ex:
+                    exception_list.append((svc, ex,))
+                    continue
+                if rc != 0 and warnings is not None:
+                    warnings.append((svc, msg,))
 
-                cb_iaas.iaas_validate(svc, self._log)
+                hash_str = _get_iaas_con_key(svc)
+                if hash_str not in groups:
+                    groups[hash_str] = []
+                groups[hash_str].append(svc)
 
-                hash_str = ""
+        failures = {}
+        def _check(hash_str, svc):
+            try:
                 iaas_url = svc.get_dep("iaas_url")
-                if iaas_url:
-                    hash_str = hash_str + iaas_url
-                hash_str = hash_str + "/"
-                iaas = svc.get_dep("iaas")
-                if iaas:
-                    hash_str = hash_str + iaas
-                hash_str = hash_str + "/"
                 key = svc.get_dep("iaas_key")
-                if key:
-                    hash_str = hash_str + key
-                hash_str = hash_str + "/"
                 secret = svc.get_dep("iaas_secret")
-                if secret:
-                    hash_str = hash_str + secret
-
-                if hash_str not in connnections.keys():
-                    con = cb_iaas.iaas_get_con(svc, key=key, secret=secret, iaasurl=iaas_url)
-                    #con = cb_iaas.iaas_get_con(svc)
-                    connnections[hash_str] = (con, [svc])
-                else:
-                    (con, svc_list) = connnections[hash_str]
-                    svc_list.append(svc)
-
-        exception_list = []
-        for (con, svc_list) in connnections.values():
-            try:
-                con.get_all_instances()
+                con = cb_iaas.iaas_get_con(svc, key=key, secret=secret, iaasurl=iaas_url)
+                con.check_auth()
             except Exception, ex:
-                # this means that there is a problem connection with all the associated services
-                names = ""
-                d = ""
-                for svc in svc_list:
-                    exception_list.append((svc, ex,))
-                    names = names + d + svc.name
-                    d = ","
-                msg = "The following services have problems with their IaaS configuration.  Please check the launch plan to verify the iaas configuration is correct. %s || %s" % (names, str(ex))
-                cloudinitd.log(self._log, logging.ERROR, msg)
+                failures[hash_str] = ex
+
+        threads = []
+        for (hash_str, svc_list) in groups.items():
+            t = threading.Thread(target=_check, args=(hash_str, svc_list[0]))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        for (hash_str, ex) in failures.items():
+            # this means that there is a problem connection with all the associated services
+            svc_list = groups[hash_str]
+            for svc in svc_list:
+                exception_list.append((svc, ex,))
+            names = ",".join([svc.name for svc in svc_list])
+            msg = "The following services have problems with their IaaS configuration.  Please check the launch plan to verify the iaas configuration is correct. %s || %s" % (names, str(ex))
+            cloudinitd.log(self._log, logging.ERROR, msg)
         return exception_list
 
     @cloudinitd.LogEntryDecorator
@@ -364,21 +602,60 @@ class CloudInitD(object):
         return self._last_exception
 
     @cloudinitd.LogEntryDecorator
-    def get_iaas_history(self):
-        ha = self._db.get_iaas_history()
+    def get_failed_services(self):
+        """
+        Return the names of the services that reported an error since this object was created.
+        """
+        return self._failed_services[:]
+
+    @cloudinitd.LogEntryDecorator
+    def get_dependent_services(self, service_names):
+        """
+        Return the given services along with every service that uses their attributes, directly or through other
+        services.  This is the part of the plan that must be redone when the given services are rebooted.  The
+        names are returned in level order.
+        """
+        consumers = {}
+        for (name, svc) in self._boot_top.get_services():
+            for dep in svc.get_dep_service_names():
+                consumers.setdefault(dep, []).append(name)
+
+        subtree = {}
+        todo = list(service_names)
+        while todo:
+            name = todo.pop()
+            if name in subtree:
+                continue
+            subtree[name] = True
+            todo.extend(consumers.get(name, []))
 
         l = []
-        for h in ha:
-            svc = SVCContainer(self._db, h.service, None, log=self._log, boot=False, ready=True, terminate=False)
-            con = cb_iaas.iaas_get_con(svc)
-            try:
-                inst = con.find_instance(h.instance_id)
-            except:
-                inst = None
-            i = IaaSHistory(inst, h.instance_id, svc)
-            l.append(i)
+        for level in self._records:
+            for s in level:
+                if s.name in subtree:
+                    l.append(s.name)
         return l
 
+    @cloudinitd.LogEntryDecorator
+    def get_iaas_history(self, orphans=False):
+        """
+        Return an IaaSHistory object for every VM ever launched by this run.  History rows are grouped by the
+        IaaS credentials of their service so that a single connection and a single describe call is made per
+        group instead of one per row.
+
+        orphans=True: only return the VMs that the run no longer considers its own (replaced, or launched by a
+                      service that has since been reset).
+        """
+        return _get_iaas_history(self._db, self._log, orphans=orphans)
+
+    @cloudinitd.LogEntryDecorator
+    def terminate_iaas_history(self, history_list):
+        """
+        Terminate the VMs associated with a list of IaaSHistory objects (as returned by get_iaas_history()).  One
+        terminate call is made per IaaS connection.
+        """
+        terminate_iaas_history(history_list)
+
     @cloudinitd.LogEntryDecorator
     def get_json_doc(self):
         return self._boot_top.get_json_doc()
@@ -388,17 +665,192 @@ class CloudInitD(object):
         return self._boot_top.get_level_runtime(level_ndx-1)
 
 
+class MultiRunDriver(object):
+    """
+    Drive many CloudInitD runs from a single poll loop so that N runs take about as long as the slowest one rather
+    than the sum of them all.  The runs share IaaS connections and, when max_processes is set, a process-wide limit
+    on the number of boot/ready/terminate programs run at once.
+
+    Each run must already be started (start() or shutdown()) before it is polled here.
+    """
+
+    def __init__(self, cloudinitds=None, max_processes=0):
+        self._runs = []
+        self._done = {}
+        self._exceptions = {}
+        cb_iaas.enable_connection_cache()
+        cloudinitd.pollables.set_max_processes(max_processes)
+        if cloudinitds:
+            for cb in cloudinitds:
+                self.add(cb)
+
+    @cloudinitd.LogEntryDecorator
+    def add(self, cb):
+        self._runs.append(cb)
+        self._done[cb.run_name] = False
+        self._exceptions[cb.run_name] = None
+
+    @cloudinitd.LogEntryDecorator
+    def get_runs(self):
+        return self._runs[:]
+
+    @cloudinitd.LogEntryDecorator
+    def poll(self):
+        """
+        Poll every run that is not yet complete once.  A run that raises is considered complete and its
+        exception can be fetched with get_exception().  Returns True when all runs are complete.
+        """
+        all_done = True
+        for cb in self._runs:
+            if self._done[cb.run_name]:
+                continue
+            try:
+                rc = cb.poll()
+            except Exception, ex:
+                cloudinitd.log(cb._log, logging.ERROR, "run %s failed: %s" % (cb.run_name, str(ex)))
+                self._exceptions[cb.run_name] = ex
+                rc = True
+            if rc:
+                self._done[cb.run_name] = True
+            else:
+                all_done = False
+        return all_done
+
+    @cloudinitd.LogEntryDecorator
+    def block_until_complete(self, poll_period=0.1):
+        done = False
+        while not done:
+            done = self.poll()
+            if not done:
+                time.sleep(poll_period)
+        for cb in self._runs:
+            cb._db.db_commit()
+
+    @cloudinitd.LogEntryDecorator
+    def cancel(self):
+        for cb in self._runs:
+            if not self._done[cb.run_name]:
+                cb.cancel()
+
+    @cloudinitd.LogEntryDecorator
+    def get_exception(self, run_name):
+        """Return the exception that stopped the run, or None"""
+        return self._exceptions[run_name]
+
+
+def _get_iaas_con_key(svc):
+    """
+    Build a string that uniquely identifies the IaaS connection a service would use.  Services with the same key
+    can share a connection.
+    """
+    hash_str = ""
+    iaas_url = svc.get_dep("iaas_url")
+    if iaas_url:
+        hash_str = hash_str + iaas_url
+    hash_str = hash_str + "/"
+    iaas = svc.get_dep("iaas")
+    if iaas:
+        hash_str = hash_str + iaas
+    hash_str = hash_str + "/"
+    key = svc.get_dep("iaas_key")
+    if key:
+        hash_str = hash_str + key
+    hash_str = hash_str + "/"
+    secret = svc.get_dep("iaas_secret")
+    if secret:
+        hash_str = hash_str + secret
+    return hash_str
+
+
+def _get_iaas_history(db, log, all_runs=False, orphans=False):
+    ha = db.get_iaas_history(all_runs=all_runs, orphans=orphans)
+
+    svcs = {}
+    groups = {}
+    rows = []
+    for h in ha:
+        s = h.service
+        if s.id not in svcs:
+            svcs[s.id] = SVCContainer(db, s, None, log=log, boot=False, ready=True, terminate=False, run_name=s.run_name)
+        svc = svcs[s.id]
+        hash_str = _get_iaas_con_key(svc)
+        if hash_str not in groups:
+            groups[hash_str] = (svc, [])
+        groups[hash_str][1].append(h.instance_id)
+        rows.append((h, svc, hash_str))
+
+    found = {}
+    for hash_str in groups:
+        (svc, ids) = groups[hash_str]
+        con = cb_iaas.iaas_get_con(svc)
+        try:
+            inst_dict = con.find_instances(ids)
+        except Exception, ex:
+            cloudinitd.log(log, logging.WARN, "Failed to look up the instances %s: %s" % (str(ids), str(ex)))
+            inst_dict = {}
+        found[hash_str] = (con, inst_dict)
+
+    l = []
+    for (h, svc, hash_str) in rows:
+        (con, inst_dict) = found[hash_str]
+        inst = inst_dict.get(h.instance_id)
+        i = IaaSHistory(inst, h.instance_id, svc, con=con)
+        l.append(i)
+    return l
+
+
+def get_fleet_iaas_history(dburl, log=logging, orphans=False):
+    """
+    Return an IaaSHistory object for every VM launched by any run kept in the shared store at dburl.  The history
+    of every run is read with a single query.
+
+    orphans=True: only return the VMs that their run no longer considers its own.
+    """
+    db = CloudInitDDB(dburl)
+    try:
+        return _get_iaas_history(db, log, all_runs=True, orphans=orphans)
+    finally:
+        db.close()
+
+
+def terminate_iaas_history(history_list):
+    """
+    Terminate the VMs associated with a list of IaaSHistory objects.  One terminate call is made per IaaS
+    connection.
+    """
+    cons = {}
+    for h in history_list:
+        if h._inst is None:
+            continue
+        key = id(h._con)
+        if key not in cons:
+            cons[key] = (h._con, [])
+        cons[key][1].append(h._inst)
+
+    for (con, instances) in cons.values():
+        if con is None:
+            for i in instances:
+                i.terminate()
+        else:
+            con.terminate_instances(instances)
+
+
 class IaaSHistory(object):
 
-    def __init__(self, inst, id, svc):
+    def __init__(self, inst, id, svc, con=None):
         self._inst = inst
         self._id = id
         self._svc = svc
+        self._con = con
 
     @cloudinitd.LogEntryDecorator
     def get_service_name(self):
         return self._svc.name
 
+    @cloudinitd.LogEntryDecorator
+    def get_run_name(self):
+        return self._svc.run_name
+
     @cloudinitd.LogEntryDecorator
     def get_context_state(self):
         return self._svc._s.state
@@ -53,7 +53,7 @@ setup(name='cloudinitd',
       packages=[ 'cloudinitd', 'cloudinitd.cli', 'cloudinitd.nosetests', 'tests' ],
        entry_points = {
         'console_scripts': [
-            'cloudinitd = cloudinitd.cli.boot:main',
+            'cloudinitd = cloudinitd.cli.daemon:main',
         ],
 
       },